@@ -0,0 +1,355 @@
+'''Batch Store
+
+Keeps production state across restarts. Every stage start and end is
+appended to a write-ahead log as the full state of the batch after the
+change. A background writer collects log records into groups and fsyncs each
+group once, so routes never wait on the disk. Every so often the writer
+snapshots all batches into SQLite and truncates the log.
+
+Recovery loads the latest snapshot, replays the log records written after it
+and takes the tanks held by in-flight batches out of the tank pool.
+'''
+from datetime import datetime
+import gc
+import json
+import os
+import sqlite3
+import threading
+import time
+import brewery as bh
+
+WAL_FILE = 'batches.wal'
+SNAPSHOT_FILE = 'batches.db'
+
+
+# Stages kept for each batch, with their start, duration and end
+STORED_STAGES = [bh.BREW_STAGE_HOT_BREW,
+                 bh.BREW_STAGE_FERMENTATION,
+                 bh.BREW_STAGE_CONDITIONING,
+                 bh.BREW_STAGE_BOTTLING,
+                 bh.BREW_STAGE_STORAGE,
+                 bh.BREW_STAGE_DISPACTH
+                ]
+ROW_COLUMNS = ['gyle', 'recipe', 'volume', 'stage',
+               'hot_brew_duration', 'fermentation_duration', 'conditioning_duration',
+               'bottling_duration', 'tanks'] + \
+              ['{}_{}'.format(field, stage) for stage in STORED_STAGES
+               for field in ('start', 'duration', 'end')] + \
+              ['bottles', 'kegs']
+# Position of the bottles column, rows written before it was added end here
+BOTTLES_COLUMN = ROW_COLUMNS.index('bottles')
+
+
+def timestamp(t):
+    return t.timestamp() if isinstance(t, datetime) else None
+
+def batch_row(b):
+    '''
+    Serializes the state of a batch to a flat row, see ROW_COLUMNS
+    '''
+    p = b.product
+    row = [b.gyle, p.recipe, b.volume, b.current_brew_stage,
+           p.hot_brew_duration, p.fermentation_duration, p.conditioning_duration,
+           p.bottling_duration,
+           ','.join(tank.name for tank in b.brew_tanks)]
+    for stage in STORED_STAGES:
+        record = b.brew_stage.get(stage)
+        start = timestamp(record.start_time) if record is not None else None
+        if start is None:
+            row += [None, None, None]
+        else:
+            row += [start, record.duration, timestamp(record.end_time)]
+    bottling = b.brew_stage.get(bh.BREW_STAGE_BOTTLING)
+    row += [bottling.bottles, bottling.kegs] if bottling is not None else [0, 0]
+    return row
+
+def batch_from_row(row, tanks):
+    '''
+    Rebuilds a batch from a batch_row.
+
+    tanks: name -> Brew_tank of the brewery
+    '''
+    p = bh.Product(row[1], row[4], row[5], row[6], row[7])
+    b = bh.Batch(row[0], p)
+    b.volume = row[2]
+    b.current_brew_stage = row[3]
+    fromtimestamp = datetime.fromtimestamp
+    for i, stage in enumerate(STORED_STAGES):
+        start = row[9 + 3 * i]
+        if start is not None:
+            record = b.brew_stage[stage]
+            record.start_time = fromtimestamp(start)
+            record.duration = row[10 + 3 * i]
+            end = row[11 + 3 * i]
+            if end is not None:
+                record.end_time = fromtimestamp(end)
+    if len(row) > BOTTLES_COLUMN and (row[BOTTLES_COLUMN] or row[BOTTLES_COLUMN + 1]):
+        record = b.brew_stage[bh.BREW_STAGE_BOTTLING]
+        record.bottles = row[BOTTLES_COLUMN]
+        record.kegs = row[BOTTLES_COLUMN + 1]
+    if row[8]:
+        b.brew_tanks = [tanks[name] for name in row[8].split(',') if name in tanks]
+    return b
+
+class Batch_store:
+    '''
+    Write-ahead log and snapshots of a Brewery_state
+
+    directory: where the log and snapshot are kept
+    group_commit_interval: seconds the writer waits to collect a group of
+                           records before writing and fsyncing them
+    snapshot_interval: log records between snapshots
+    '''
+    def __init__(self, directory, group_commit_interval=0.01, snapshot_interval=10000):
+        os.makedirs(directory, exist_ok=True)
+        self.wal_path = os.path.join(directory, WAL_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.group_commit_interval = group_commit_interval
+        self.snapshot_interval = snapshot_interval
+        self.state = None
+        self.groups_written = 0
+        self._sequence = 0
+        self._written_sequence = 0
+        self._snapshot_sequence = 0
+        self._pending = []
+        self._snapshot_requested = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._wal = None
+        return
+
+    def open(self, state):
+        '''
+        Recovers state from disk, then starts logging its changes
+        '''
+        self.state = state
+        self.recover(state)
+        self._wal = open(self.wal_path, 'a')
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='batch-store', daemon=True)
+        self._thread.start()
+        bh.add_stage_listener(self.stage_changed)
+        return
+
+    def close(self):
+        '''
+        Stops logging, writing out any pending records
+        '''
+        bh.remove_stage_listener(self.stage_changed)
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        return
+
+    def stage_changed(self, event, batch, stage):
+        '''
+        Stage listener, queues a log record of the batch's new state
+        '''
+        if not self.state.owns(batch):
+            return
+        row = batch_row(batch)
+        with self._cond:
+            self._sequence += 1
+            self._pending.append(json.dumps([self._sequence] + row))
+            self._cond.notify()
+        return
+
+    def flush(self):
+        '''
+        Waits until every record queued so far is on disk
+        '''
+        with self._cond:
+            target = self._sequence
+            while self._written_sequence < target and self._running:
+                self._cond.wait(0.1)
+        return
+
+    def request_snapshot(self):
+        with self._cond:
+            self._snapshot_requested = True
+            self._cond.notify()
+        return
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending and not self._snapshot_requested:
+                    self._cond.wait()
+                running = self._running
+            if running and self.group_commit_interval:
+                # let more records join the group
+                time.sleep(self.group_commit_interval)
+
+            with self._cond:
+                group = self._pending
+                self._pending = []
+                sequence = self._sequence
+                snapshot = self._snapshot_requested
+                self._snapshot_requested = False
+
+            if group:
+                self._wal.write('\n'.join(group) + '\n')
+                self._wal.flush()
+                os.fsync(self._wal.fileno())
+                self.groups_written += 1
+            with self._cond:
+                self._written_sequence = sequence
+                self._cond.notify_all()
+
+            if snapshot or sequence - self._snapshot_sequence >= self.snapshot_interval:
+                self._snapshot(sequence)
+            if not running:
+                return
+
+    def _snapshot(self, sequence):
+        '''
+        Writes every batch to the snapshot and empties the log. Runs on the
+        writer thread once all records up to sequence are on disk, so the
+        log holds nothing newer than the snapshot. Batches that change while
+        being read have log records after sequence that are replayed on
+        recovery.
+        '''
+        rows = [batch_row(b) for b in self.state.batch_list()]
+        db = sqlite3.connect(self.snapshot_path)
+        try:
+            with db:
+                # recreated each time, so snapshots taken before columns were
+                # added are replaced
+                db.execute('DROP TABLE IF EXISTS batches')
+                db.execute('CREATE TABLE batches ({} PRIMARY KEY, {})'.format(
+                    ROW_COLUMNS[0], ', '.join(ROW_COLUMNS[1:])))
+                db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+                db.executemany('INSERT INTO batches VALUES ({})'.format(
+                    ', '.join('?' * len(ROW_COLUMNS))), rows)
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('sequence', ?)", (sequence,))
+        finally:
+            db.close()
+        self._wal.truncate(0)
+        self._wal.seek(0)
+        self._snapshot_sequence = sequence
+        return
+
+    def recover(self, state):
+        '''
+        Rebuilds state from the snapshot and the log. Returns the number of
+        batches recovered.
+        '''
+        # the cyclic garbage collector would otherwise rescan the growing
+        # heap many times over while hundreds of thousands of objects are
+        # created
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._recover(state)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _recover(self, state):
+        tanks = {t.name: t for t in state.tank_pool.tank_pool}
+        rows = {}
+        sequence = 0
+        if os.path.isfile(self.snapshot_path):
+            db = sqlite3.connect(self.snapshot_path)
+            try:
+                row = db.execute("SELECT value FROM meta WHERE key = 'sequence'").fetchone()
+                sequence = row[0] if row else 0
+                for row in db.execute('SELECT * FROM batches'):
+                    rows[row[0]] = row
+            finally:
+                db.close()
+        self._snapshot_sequence = sequence
+
+        if os.path.isfile(self.wal_path):
+            with open(self.wal_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the log
+                        break
+                    if record[0] > self._snapshot_sequence:
+                        rows[record[1]] = record[1:]
+                        sequence = max(sequence, record[0])
+
+        held = []
+        for row in rows.values():
+            b = batch_from_row(row, tanks)
+            state.add_batch(b)
+            held += b.brew_tanks
+        for tank in held:
+            state.tank_pool.get_free_tank(name=tank.name, fermenter=tank.fermenter)
+        self._sequence = self._written_sequence = sequence
+        return len(rows)
+
+def test_batch_store(directory='batch_store_test', batches=100000):
+    '''
+    Unit test, also measures recovery time
+    '''
+    import shutil
+    shutil.rmtree(directory, ignore_errors=True)
+    start = datetime(2020, 1, 1)
+
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    store = Batch_store(directory, group_commit_interval=0.001)
+    store.open(state)
+    for gyle in range(20):
+        state.new_batch(str(gyle), bh.Product('Pilsner'), start, 3)
+    state.transition('3', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, start, 4,
+                     tank_name='Albert')
+    state.transition('5', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_BOTTLING, start, 3,
+                     need_tank=False)
+    def bottled(b):
+        b.brew_stage[bh.BREW_STAGE_BOTTLING].bottles = 1200
+        b.brew_stage[bh.BREW_STAGE_BOTTLING].kegs = 4
+    state.transition('5', bh.BREW_STAGE_BOTTLING, bh.BREW_STAGE_STORAGE, start, 0,
+                     need_tank=False, update=bottled)
+    store.flush()
+    assert store.groups_written < 23
+    store.close()
+
+    recovered = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    store = Batch_store(directory)
+    assert store.recover(recovered) == 20
+    b = recovered.batches['3']
+    assert b.current_brew_stage == bh.BREW_STAGE_FERMENTATION
+    assert b.brew_tanks[0].name == 'Albert' and 'Albert' not in recovered.tank_pool.tanks
+    assert b.brew_stage[bh.BREW_STAGE_HOT_BREW].end_time
+    record = recovered.batches['5'].brew_stage[bh.BREW_STAGE_BOTTLING]
+    assert (record.bottles, record.kegs) == (1200, 4)
+
+    # snapshot of many historical batches plus a log tail
+    recovered = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    store = Batch_store(directory, group_commit_interval=0.001, snapshot_interval=10 * batches)
+    store.open(recovered)
+    for gyle in range(20, batches):
+        recovered.new_batch(str(gyle), bh.Product('Dunkel'), start, 3)
+    store.request_snapshot()
+    store.flush()
+    recovered.transition('4', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, start, 4,
+                         tank_name='Camilla')
+    store.close()
+
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    begin = time.perf_counter()
+    count = Batch_store(directory).recover(state)
+    elapsed = time.perf_counter() - begin
+    print('recovered {} batches in {:.3f}s'.format(count, elapsed))
+    assert count == batches
+    assert elapsed < 1.0
+    assert state.batches['4'].current_brew_stage == bh.BREW_STAGE_FERMENTATION
+    assert state.find_gyles(tank='Camilla') == ['4']
+    shutil.rmtree(directory, ignore_errors=True)
+    return elapsed
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_batch_store()
@@ -0,0 +1,488 @@
+'''Benchmark
+
+Reproducible benchmarks of the brewhouse hot paths. Synthetic sales files in
+the Barnabys_sales_fabricated_data.csv layout are generated from a fixed seed
+for each size, together with synthetic tank pools and batch populations. The
+results are written as JSON so runs can be compared for regressions.
+
+The startup benchmark starts the web server in a new process and times the
+first response, with the sales modules imported before the app as they used
+to be ('eager') and on first use ('lazy').
+
+The batch memory benchmark measures the memory retained per batch with the
+batch layout from before __slots__ ('legacy') and the current one.
+
+    python benchmark.py [--sizes 10000,100000] [--batches 100000]
+                        [--concurrency 8] [--requests 200] [--startup-runs 5]
+                        [--output results.json]
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import brewery as bh
+import brewery_sites as bsite
+import sales_predictor as sp
+
+# Sales file sizes in rows
+DEFAULT_SIZES = [10000, 100000, 1000000, 10000000]
+
+# Where generated data is kept between runs
+DATA_DIRECTORY = 'benchmark_data'
+
+# Routes driven through the Flask test client
+BENCHMARK_ROUTES = ['/',
+                    '/salesprediction',
+                    '/viewbrewing',
+                    '/viewbrewing?recipe=Pilsner&page=1',
+                    '/api/batches?stage=Fermentation&page=1',
+                    '/metrics'
+                   ]
+
+SALES_RECIPES = list(sp.PREDICTED_RECIPES.values())
+
+# Starts the web server for the startup benchmark: port, mode, warm up
+STARTUP_SCRIPT = '''
+import logging, sys
+if sys.argv[2] == 'eager':
+    import sales_forecaster, sales_predictor
+import brewhouse
+brewhouse.logger = logging.getLogger('brewhouse.benchmark')
+brewhouse.logger.addHandler(logging.NullHandler())
+brewhouse.logger.propagate = False
+brewhouse.init_brewery()
+if sys.argv[3] == '1':
+    brewhouse.start_warm_up(port=int(sys.argv[1]))
+brewhouse.app.run(port=int(sys.argv[1]), threaded=True)
+'''
+
+
+def generate_sales_file(rows, directory=DATA_DIRECTORY, seed=0, months=12):
+    '''
+    Writes a synthetic sales csv of rows orders spread over months from
+    November 2018, reusing the file if it was generated before. Returns its
+    path.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'sales_{}_{}.csv'.format(rows, seed))
+    if os.path.isfile(path):
+        return path
+
+    rng = np.random.default_rng(seed)
+    first_day = np.datetime64('2018-11-01')
+    days = ((np.datetime64('2018-11') + months).astype('datetime64[D]') - first_day).astype(int)
+    dates = pd.to_datetime(first_day + rng.integers(0, days, rows).astype('timedelta64[D]'))
+    number = pd.Series(np.arange(1, rows + 1)).astype(str)
+    orders = pd.DataFrame({'Invoice Number': 'SO' + number.str.zfill(5),
+                           'Customer': 'Customer ' + pd.Series(rng.integers(1, 40, rows)).astype(str),
+                           'Date Required': dates.strftime(sp.DATE_FORMAT),
+                           'Recipe': np.array(SALES_RECIPES)[rng.integers(0, len(SALES_RECIPES), rows)],
+                           'Gyle Number': 'GYLE' + number,
+                           'Quantity ordered': rng.integers(1, 20, rows) * 25
+                          })
+    orders.sort_values('Date Required', kind='stable', key=lambda d: pd.to_datetime(d, format=sp.DATE_FORMAT),
+                       inplace=True)
+    orders.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return path
+
+def generate_tank_pool(tanks, seed=0):
+    '''
+    Returns a Brewery_tank_pool of tanks with a mix of volumes and uses
+    '''
+    rng = np.random.default_rng(seed)
+    tank_pool = bh.Brewery_tank_pool('benchmark')
+    for i in range(tanks):
+        use = i % 3
+        tank_pool.add(bh.Brew_tank('Tank{}'.format(i), int(rng.choice([680, 800, 1000])),
+                                   use != 2, use != 0))
+    return tank_pool
+
+def generate_brewery_state(batches, tanks=200, seed=0):
+    '''
+    Returns a Brewery_state with batches spread over the recipes and the
+    brewing stages
+    '''
+    rng = np.random.default_rng(seed)
+    state = bh.Brewery_state(generate_tank_pool(tanks, seed))
+    start = datetime(2020, 1, 1)
+    recipes = list(sp.PREDICTED_RECIPES)
+    for gyle, (recipe, stage) in enumerate(zip(rng.integers(0, len(recipes), batches),
+                                               rng.integers(0, 4, batches))):
+        gyle = str(gyle)
+        state.new_batch(gyle, bh.Product(recipes[recipe]), start, 3)
+        if stage >= 1:
+            state.transition(gyle, bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, start, 4,
+                             need_tank=False)
+        if stage >= 2:
+            state.transition(gyle, bh.BREW_STAGE_FERMENTATION, bh.BREW_STAGE_CONDITIONING, start, 2,
+                             need_tank=False)
+        if stage >= 3:
+            state.transition(gyle, bh.BREW_STAGE_CONDITIONING, bh.BREW_STAGE_BOTTLING, start, 3,
+                             need_tank=False)
+    return state
+
+def time_function(name, fn, params, repeat=5):
+    '''
+    Calls fn repeat times and returns a result record of the timings in
+    seconds
+    '''
+    timings = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - begin)
+    return {'name': name,
+            'params': params,
+            'runs': repeat,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings)
+           }
+
+def benchmark_sales(sizes, repeat):
+    results = []
+    for rows in sizes:
+        path = generate_sales_file(rows)
+        # fewer repeats for the largest files
+        runs = max(1, repeat if rows <= 1000000 else repeat // 5)
+        results.append(time_function('get_month_on_month_sales',
+                                     lambda: sp.get_month_on_month_sales(path),
+                                     {'rows': rows}, runs))
+        results.append(time_function('get_predicted_sales',
+                                     lambda: sp.get_predicted_sales(path, 'none'),
+                                     {'rows': rows}, runs))
+    return results
+
+def benchmark_tanks(tanks, repeat, cycles=10000):
+    tank_pool = generate_tank_pool(tanks)
+
+    def take_and_return():
+        for i in range(cycles):
+            tank = tank_pool.get_free_tank(volume=(600, 750, 900)[i % 3], fermenter=i % 2 == 0)
+            if tank is not None:
+                tank_pool.add(tank)
+    record = time_function('get_free_tank', take_and_return,
+                           {'tanks': tanks, 'cycles': cycles}, repeat)
+    record['per_call'] = record['median'] / cycles
+    return [record]
+
+class Legacy_product:
+    '''
+    Product as it was laid out before __slots__
+    '''
+    def __init__(self, recipe, hot_brew_time=0, fermentation_time=0, conditioning_time=0):
+        self.recipe = recipe
+        self.hot_brew_duration = hot_brew_time
+        self.fermentation_duration = fermentation_time
+        self.conditioning_duration = conditioning_time
+
+class Legacy_stage:
+    def __init__(self, stage, gyle, start=0, duration=0):
+        self.stage = stage
+        self.gyle = gyle
+        self.duration = duration
+        self.start_time = start
+        self.end_time = 0
+
+class Legacy_bottling(Legacy_stage):
+    def __init__(self, stage, gyle, start=0, duration=0):
+        super().__init__(stage, gyle, start, duration)
+        self.bottles = 0
+
+class Legacy_batch:
+    '''
+    Batch as it was laid out before __slots__, with a record for every
+    stage created up front
+    '''
+    def __init__(self, gyle, product):
+        self.gyle = gyle
+        self.product = product
+        self.volume = 0
+        self.brew_tanks = []
+        self.current_brew_stage = bh.BREW_STAGE_NONE
+        self.brew_stage_log = [bh.BREW_STAGE_NONE,]
+        self.brew_stage = {bh.BREW_STAGE_HOT_BREW     : Legacy_stage(bh.BREW_STAGE_HOT_BREW, gyle),
+                           bh.BREW_STAGE_FERMENTATION : Legacy_stage(bh.BREW_STAGE_FERMENTATION, gyle),
+                           bh.BREW_STAGE_CONDITIONING : Legacy_stage(bh.BREW_STAGE_CONDITIONING, gyle),
+                           bh.BREW_STAGE_BOTTLING     : Legacy_bottling(bh.BREW_STAGE_BOTTLING, gyle),
+                           bh.BREW_STAGE_STORAGE      : Legacy_stage(bh.BREW_STAGE_STORAGE, gyle),
+                           bh.BREW_STAGE_DISPACTH     : Legacy_stage(bh.BREW_STAGE_DISPACTH, gyle)
+                          }
+
+    def start_brew_stage(self, stage, gyle, start, duration):
+        self.current_brew_stage = stage
+        record = self.brew_stage[stage]
+        record.gyle = gyle
+        record.start_time = start
+        record.duration = duration
+
+    def end_brew_stage(self, stage, gyle):
+        self.brew_stage[stage].end_time = datetime.now()
+
+def batch_memory(batch, product, batches):
+    '''
+    Returns the bytes retained by batches made with batch and product that
+    have been through hot brew, fermentation, conditioning and bottling
+    '''
+    import gc
+    import tracemalloc
+    start = datetime(2020, 1, 1)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    tracemalloc.start()
+    try:
+        history = {}
+        for gyle in range(batches):
+            b = batch(gyle, product('Pilsner', 3, 4, 2))
+            for stage in (bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION,
+                          bh.BREW_STAGE_CONDITIONING, bh.BREW_STAGE_BOTTLING):
+                b.start_brew_stage(stage, gyle, start, 3)
+                b.end_brew_stage(stage, gyle)
+            history[gyle] = b
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        if gc_enabled:
+            gc.enable()
+    return retained
+
+def benchmark_batch_memory(batches):
+    '''
+    Memory retained per batch that has been through hot brew, fermentation,
+    conditioning and bottling, with the legacy layout of one dict per object
+    and every stage record created up front, and with the current layout
+    '''
+    results = []
+    for layout, batch, product in (('legacy', Legacy_batch, Legacy_product),
+                                   ('current', bh.Batch, bh.Product)):
+        retained = batch_memory(batch, product, batches)
+        results.append({'name': 'batch_memory',
+                        'params': {'layout': layout, 'batches': batches},
+                        'bytes': retained,
+                        'bytes_per_batch': retained / batches
+                       })
+    return results
+
+def setup_brewhouse(state, sales_file):
+    '''
+    Points the brewhouse app at a synthetic state and sales file. Returns
+    the brewhouse module.
+    '''
+    import brewhouse
+    logger = logging.getLogger('brewhouse.benchmark')
+    logger.propagate = False
+    logger.setLevel(logging.WARNING)
+    brewhouse.logger = logger
+    brewhouse.brewery_sites.close()
+    site = bsite.Brewery_site('benchmark', state.tank_pool, state)
+    brewhouse.brewery_sites = bsite.Brewery_sites({site.name: site})
+    site.open()
+    brewhouse.sales_file = sales_file
+    brewhouse.response_cache.bump()
+    return brewhouse
+
+def benchmark_brew_status(brewhouse, batches, repeat):
+    results = []
+    state = brewhouse.brewery_sites.default.state
+    for name, kwargs in (('all', {}),
+                         ('recipe', {'beer': 'Pilsner'}),
+                         ('recipe_stage_page', {'beer': 'Pilsner', 'stage': bh.BREW_STAGE_FERMENTATION,
+                                                'page': 1})):
+        results.append(time_function('brew_status', lambda: brewhouse.brew_status(state=state, **kwargs),
+                                     {'batches': batches, 'filter': name}, repeat))
+    return results
+
+def benchmark_routes(brewhouse, concurrency, requests_per_route):
+    '''
+    Drives each route from concurrency threads, each with its own test
+    client. Returns latency percentiles and throughput per route.
+    '''
+    results = []
+    for route in BENCHMARK_ROUTES:
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(concurrency)
+
+        def worker(count):
+            client = brewhouse.app.test_client()
+            mine = []
+            barrier.wait()
+            for _ in range(count):
+                begin = time.perf_counter()
+                response = client.get(route)
+                mine.append(time.perf_counter() - begin)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+            with lock:
+                latencies.extend(mine)
+
+        per_thread = max(1, requests_per_route // concurrency)
+        threads = [threading.Thread(target=worker, args=(per_thread,)) for _ in range(concurrency)]
+        begin = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - begin
+        latencies.sort()
+        results.append({'name': 'route',
+                        'params': {'route': route, 'concurrency': concurrency},
+                        'requests': len(latencies),
+                        'errors': len(errors),
+                        'requests_per_second': len(latencies) / elapsed,
+                        'p50': latencies[len(latencies) // 2],
+                        'p95': latencies[int(len(latencies) * 0.95)],
+                        'p99': latencies[int(len(latencies) * 0.99)],
+                        'max': latencies[-1]
+                       })
+    return results
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_response(url, timeout=60):
+    '''
+    Polls url until it answers. Returns the time of the response.
+    '''
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                response.read()
+            return time.perf_counter()
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.005)
+
+def time_startup(mode, warm_up=False, route='/salesprediction'):
+    '''
+    Starts the web server and returns the seconds to its first response, and
+    then to its first response from route
+    '''
+    port = free_port()
+    begin = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT, str(port), mode,
+                               '1' if warm_up else '0'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first = wait_for_response('http://127.0.0.1:{}/'.format(port))
+        if warm_up:
+            # as a request arriving a while after the server started would
+            time.sleep(2)
+        begin_route = time.perf_counter()
+        wait_for_response('http://127.0.0.1:{}{}'.format(port, route))
+        return first - begin, time.perf_counter() - begin_route
+    finally:
+        server.terminate()
+        server.wait()
+
+def benchmark_startup(runs):
+    '''
+    Time to first response with the sales modules imported at start up
+    ('eager', as before) and on first use ('lazy'), and the first sales
+    prediction request with and without the warm up
+    '''
+    results = []
+    for mode, warm_up in (('eager', False), ('lazy', False), ('lazy', True)):
+        timings = [time_startup(mode, warm_up) for _ in range(runs)]
+        results.append({'name': 'startup',
+                        'params': {'mode': mode, 'warm_up': warm_up},
+                        'runs': runs,
+                        'first_response': statistics.median(t[0] for t in timings),
+                        'first_sales_prediction': statistics.median(t[1] for t in timings)
+                       })
+    return results
+
+def run_benchmarks(sizes=DEFAULT_SIZES, batches=100000, tanks=200, concurrency=8,
+                   requests_per_route=200, repeat=5, startup_runs=5):
+    '''
+    Runs every benchmark and returns the report as a dict
+    '''
+    results = benchmark_startup(startup_runs)
+    results += benchmark_sales(sizes, repeat)
+    results += benchmark_tanks(tanks, repeat)
+    results += benchmark_batch_memory(batches)
+    state = generate_brewery_state(batches, tanks)
+    brewhouse = setup_brewhouse(state, generate_sales_file(min(sizes)))
+    results += benchmark_brew_status(brewhouse, batches, repeat)
+    results += benchmark_routes(brewhouse, concurrency, requests_per_route)
+    return {'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'results': results
+           }
+
+def test_benchmark(directory='benchmark_test_data'):
+    '''
+    Unit test, a small run of every benchmark
+    '''
+    import shutil
+    path = generate_sales_file(1000, directory)
+    orders = sp.read_sales_orders(path)
+    assert len(orders) == 1000 and set(orders['Recipe']) == set(SALES_RECIPES)
+    _, df, _ = sp.get_predicted_sales(path, 'none')
+    assert len(df) == 12
+    # the same seed gives the same file
+    with open(path) as f:
+        first = f.read()
+    os.remove(path)
+    with open(generate_sales_file(1000, directory)) as f:
+        assert f.read() == first
+    shutil.rmtree(directory, ignore_errors=True)
+
+    legacy, current = benchmark_batch_memory(10000)
+    assert current['bytes_per_batch'] < legacy['bytes_per_batch']
+
+    state = generate_brewery_state(1000, 20)
+    assert len(state.batches) == 1000
+    assert state.find_gyles(stage=bh.BREW_STAGE_BOTTLING)
+
+    eager, lazy, warm = benchmark_startup(1)
+    assert lazy['params'] == {'mode': 'lazy', 'warm_up': False}
+    assert all(r['first_response'] > 0 and r['first_sales_prediction'] > 0
+               for r in (eager, lazy, warm))
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        test_benchmark()
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='Brewhouse benchmarks')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated sales file sizes in rows')
+    parser.add_argument('--batches', type=int, default=100000)
+    parser.add_argument('--tanks', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--startup-runs', type=int, default=5, help='server starts per mode')
+    parser.add_argument('--output', help='JSON results file, printed if not given')
+    args = parser.parse_args()
+    report = run_benchmarks([int(s) for s in args.sizes.split(',')], args.batches, args.tanks,
+                            args.concurrency, args.requests, args.repeat, args.startup_runs)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
@@ -0,0 +1,221 @@
+'''Brew API
+
+JSON interface to the brewery for machine clients such as the MES. A bulk
+request carries a list of stage transitions which are validated and applied
+in one pass through the same Brewery_state logic as the web pages, with a
+result for each transition.
+
+A transition is a dict:
+    gyle: batch number
+    stage: stage to start, 'Hot Brew', 'Fermentation', 'Conditioning' or
+           'Bottling'
+    tank: tank name, 'auto' for the planner's suggestion or None for any
+          suitable free tank
+    duration: duration of the stage, see brewery.stage_duration_unit
+    recipe: the recipe, hot brew only
+    volume: litres in the batch, optional
+'''
+from datetime import datetime
+import brewery as bh
+import tank_planner as tp
+
+# Stage -> (stage the batch must be in, needs a tank, needs a fermenter)
+stage_transitions = {bh.BREW_STAGE_FERMENTATION : (bh.BREW_STAGE_HOT_BREW, True, True),
+                     bh.BREW_STAGE_CONDITIONING : (bh.BREW_STAGE_FERMENTATION, True, False),
+                     bh.BREW_STAGE_BOTTLING     : (bh.BREW_STAGE_CONDITIONING, False, False)
+                    }
+
+# Error messages of the failed transition results
+transition_errors = {bh.TRANSITION_NO_BATCH    : 'Batch not found',
+                     bh.TRANSITION_WRONG_STAGE : 'Batch is not in the previous stage',
+                     bh.TRANSITION_NO_TANK     : 'No free available tank'
+                    }
+
+
+def batch_as_dict(b):
+    '''
+    JSON friendly status of a batch
+    '''
+    record = b.brew_stage.get(b.current_brew_stage)
+    start = record.start_time if record is not None else None
+    return {'gyle': b.gyle,
+            'recipe': b.product.recipe,
+            'stage': bh.brew_stage[b.current_brew_stage],
+            'start_time': start.strftime("%Y-%m-%dT%H:%M") if isinstance(start, datetime) else None,
+            'volume': b.volume,
+            'tanks': [tank.name for tank in b.brew_tanks]
+           }
+
+def parse_stage(stage):
+    '''
+    Returns the BREW_STAGE_xxx for a stage name or number, None if unknown
+    '''
+    if isinstance(stage, str):
+        names = [name.lower() for name in bh.brew_stage]
+        stage = names.index(stage.lower()) if stage.lower() in names else None
+    if isinstance(stage, int) and not isinstance(stage, bool) and \
+       (stage == bh.BREW_STAGE_HOT_BREW or stage in stage_transitions):
+        return stage
+    return None
+
+def validate_transition(item):
+    '''
+    Checks the shape of a transition. Returns (stage, error message), the
+    message is None if the transition is valid.
+    '''
+    if not isinstance(item, dict):
+        return None, 'Transition must be an object'
+    gyle = item.get('gyle')
+    if not isinstance(gyle, (str, int)) or isinstance(gyle, bool) or str(gyle) == '':
+        return None, 'Missing gyle'
+    stage = parse_stage(item.get('stage'))
+    if stage is None:
+        return None, 'Unknown stage'
+    if bh.stage_duration(stage, item.get('duration')) is None:
+        return stage, 'Invalid duration'
+    recipe = item.get('recipe')
+    if stage == bh.BREW_STAGE_HOT_BREW and (not isinstance(recipe, str) or recipe == ''):
+        return stage, 'Hot brew requires a recipe'
+    volume = item.get('volume', 0)
+    if not isinstance(volume, (int, float)) or isinstance(volume, bool) or volume < 0:
+        return stage, 'Invalid volume'
+    tank = item.get('tank')
+    if tank is not None and not isinstance(tank, str):
+        return stage, 'Invalid tank'
+    return stage, None
+
+def apply_transitions(state, transitions, now=None):
+    '''
+    Validates and applies a list of transitions in order.
+
+    state: Brewery_state
+    transitions: list of transition dicts, see the module docstring
+    now: start time of the stages, defaults to the current time
+
+    Returns a list with a result dict for each transition, holding the
+    gyle, stage, 'ok' and either the batch status or an error message
+    '''
+    if now is None:
+        now = datetime.now()
+    plan = None
+    results = []
+    for item in transitions:
+        stage, error = validate_transition(item)
+        if error is not None:
+            results.append({'gyle': item.get('gyle') if isinstance(item, dict) else None,
+                            'stage': item.get('stage') if isinstance(item, dict) else None,
+                            'ok': False,
+                            'error': error})
+            continue
+
+        gyle = str(item['gyle'])
+        duration = item['duration']
+        volume = item.get('volume', 0)
+        if stage == bh.BREW_STAGE_HOT_BREW:
+            p = bh.Product(item['recipe'], hot_brew_time=duration)
+            b = state.new_batch(gyle, p, now, duration, volume)
+            if b is None:
+                result, error = None, 'Gyle Number Already in Use'
+        else:
+            from_stage, need_tank, fermenter = stage_transitions[stage]
+            tank = item.get('tank')
+            if tank == 'auto':
+                # one plan serves every 'auto' transition in the request
+                if plan is None:
+                    plan = tp.plan_tank_assignment(state)
+                tank = plan.suggest(gyle)
+                if tank not in state.tank_pool.tanks:
+                    # planned for later, take the best fitting free tank now
+                    tank = None
+            result, b = state.transition(gyle, from_stage, stage, now, duration,
+                                         tank_name=tank,
+                                         volume=volume,
+                                         fermenter=fermenter,
+                                         need_tank=need_tank)
+            error = transition_errors.get(result)
+            if error is None:
+                if stage == bh.BREW_STAGE_FERMENTATION:
+                    b.product.fermentation_duration = duration
+                elif stage == bh.BREW_STAGE_CONDITIONING:
+                    b.product.conditioning_duration = duration
+                else:
+                    b.product.bottling_duration = duration
+
+        if error is None:
+            results.append({'gyle': gyle, 'stage': bh.brew_stage[stage], 'ok': True,
+                            'batch': batch_as_dict(b)})
+        else:
+            results.append({'gyle': gyle, 'stage': bh.brew_stage[stage], 'ok': False,
+                            'error': error})
+    return results
+
+def test_apply_transitions():
+    '''
+    Unit test
+    '''
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    results = apply_transitions(state, [
+        {'gyle': '1', 'stage': 'Hot Brew', 'recipe': 'Pilsner', 'duration': 3, 'volume': 900},
+        {'gyle': '1', 'stage': 'Fermentation', 'tank': None, 'duration': 4},
+        {'gyle': '1', 'stage': 'Hot Brew', 'recipe': 'Pilsner', 'duration': 3},
+        {'gyle': '2', 'stage': 'hot brew', 'recipe': 'Dunkel', 'duration': 3},
+        {'gyle': '2', 'stage': 'Conditioning', 'tank': 'Gertrude', 'duration': 2},
+        {'gyle': '2', 'stage': 'Fermentation', 'tank': 'auto', 'duration': 4},
+        {'gyle': '9', 'stage': 'Bottling', 'duration': 3},
+        {'gyle': '3', 'stage': 'Storage', 'duration': 1},
+        {'gyle': '3', 'stage': 'Fermentation', 'duration': 'soon'},
+        'not a transition',
+        {'gyle': '1', 'stage': 'Conditioning', 'duration': 2, 'volume': 700},
+        {'gyle': '4', 'stage': 'Hot Brew', 'recipe': 'Pilsner', 'duration': 3},
+        {'gyle': '4', 'stage': 'Fermentation', 'duration': 4},
+        {'gyle': '2', 'stage': 'Bottling', 'duration': 3, 'volume': 300}
+    ])
+    assert [r['ok'] for r in results] == [True, True, False, True, False, True,
+                                          False, False, False, False, True, True, True, False]
+    # best fit for 900 L is a 1000 L fermenter
+    assert results[1]['batch']['tanks'][0] in ('Albert', 'Camilla', 'Emily')
+    assert results[1]['batch']['stage'] == 'Fermentation'
+    assert state.batches['1'].product.fermentation_duration == 4
+    assert results[2]['error'] == 'Gyle Number Already in Use'
+    assert results[4]['error'] == 'Batch is not in the previous stage'
+    assert results[5]['batch']['tanks']
+    assert results[6]['error'] == 'Batch not found'
+    assert results[7]['error'] == 'Unknown stage'
+    assert results[8]['error'] == 'Invalid duration'
+    assert results[9]['error'] == 'Transition must be an object'
+    # the volume is set before the stage listeners run and kept on failure
+    assert results[10]['batch']['volume'] == 700 and results[0]['batch']['volume'] == 900
+    assert results[13]['error'] == 'Batch is not in the previous stage'
+    assert state.batches['2'].volume == 0
+    # without a tank or volume any free fermenter will do
+    assert results[12]['batch']['tanks']
+
+    seen = []
+    listener = lambda event, batch, stage: seen.append(batch.volume)
+    bh.add_stage_listener(listener)
+    try:
+        apply_transitions(state, [{'gyle': '5', 'stage': 'Hot Brew', 'recipe': 'Pilsner',
+                                   'duration': 3, 'volume': 650}])
+    finally:
+        bh.remove_stage_listener(listener)
+    assert seen == [650]
+
+    # a recipe that is not a name is rejected and the rest still apply
+    counts = state.status_counts['batches']
+    results = apply_transitions(state, [
+        {'gyle': '6', 'stage': 'Hot Brew', 'recipe': ['Pilsner'], 'duration': 3},
+        {'gyle': '7', 'stage': 'Hot Brew', 'recipe': 'Dunkel', 'duration': 3}])
+    assert results[0]['error'] == 'Hot brew requires a recipe' and results[1]['ok']
+    assert '6' not in state.batches and state.status_counts['batches'] == counts + 1
+    try:
+        state.new_batch('6', bh.Product(['Pilsner']), datetime.now(), 3)
+        assert False
+    except TypeError:
+        pass
+    assert '6' not in state.batches
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_apply_transitions()
@@ -0,0 +1,241 @@
+'''Brew Scheduler
+
+Advances batches through the brewing stages without operator input. Every
+stage start is queued on a heap keyed by the stage's end time
+(start_time + duration). A background thread sleeps until the earliest end
+time, ends the stage, returns its tanks to the pool and starts the next stage
+as soon as a suitable tank is free.
+'''
+from collections import deque
+from datetime import datetime
+import heapq
+import itertools
+import threading
+import brewery as bh
+
+# Stage that follows each scheduled stage, None ends the batch
+next_brew_stage = {bh.BREW_STAGE_HOT_BREW     : bh.BREW_STAGE_FERMENTATION,
+                   bh.BREW_STAGE_FERMENTATION : bh.BREW_STAGE_CONDITIONING,
+                   bh.BREW_STAGE_CONDITIONING : bh.BREW_STAGE_BOTTLING,
+                   bh.BREW_STAGE_BOTTLING     : None
+                  }
+
+# Stage durations used when the product does not give one, in the units of
+# brewery.stage_duration_unit
+default_stage_duration = {bh.BREW_STAGE_FERMENTATION : 4,
+                          bh.BREW_STAGE_CONDITIONING : 2,
+                          bh.BREW_STAGE_BOTTLING     : 3
+                         }
+
+
+def product_stage_duration(product, stage):
+    '''
+    Returns the product's duration for a stage, or the default duration if
+    the product does not give a valid one
+    '''
+    duration = {bh.BREW_STAGE_FERMENTATION : product.fermentation_duration,
+                bh.BREW_STAGE_CONDITIONING : product.conditioning_duration,
+                bh.BREW_STAGE_BOTTLING     : product.bottling_duration
+               }[stage]
+    if bh.stage_duration(stage, duration) is None or not float(duration):
+        duration = default_stage_duration[stage]
+    return duration
+
+class Brew_scheduler:
+    '''
+    Event queue of stage completions for the batches of a Brewery_state
+    '''
+    def __init__(self, state, clock=datetime.now):
+        self.state = state
+        self.clock = clock
+        self.events_fired = 0
+        # heap of (end_time, sequence, batch, stage, start_time)
+        self._queue = []
+        self._sequence = itertools.count()
+        # (batch, stage) whose next stage is waiting for a free tank
+        self._waiting = deque()
+        self._retry_waiting = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        return
+
+    def start(self):
+        '''
+        Starts listening for stage changes and firing events in a background
+        thread
+        '''
+        bh.add_stage_listener(self.stage_changed)
+        for b in self.state.batch_list():
+            self.schedule(b, b.current_brew_stage)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='brew-scheduler', daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self):
+        bh.remove_stage_listener(self.stage_changed)
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def stage_changed(self, event, batch, stage):
+        '''
+        Stage listener, queues the end of every stage that starts. A stage
+        ending may free a tank, so wakes the thread to retry waiting batches.
+        '''
+        if not self.state.owns(batch):
+            return
+        if event == bh.STAGE_START:
+            self.schedule(batch, stage)
+        elif self._waiting:
+            with self._cond:
+                self._retry_waiting = True
+                self._cond.notify()
+        return
+
+    def schedule(self, batch, stage):
+        '''
+        Queues the end of a batch's stage. O(log n) in the number of queued
+        events.
+        '''
+        record = batch.brew_stage.get(stage)
+        if record is None or not isinstance(record.start_time, datetime):
+            return
+        duration = bh.stage_duration(stage, record.duration)
+        if duration is None:
+            return
+        end_time = record.start_time + duration
+        with self._cond:
+            sequence = next(self._sequence)
+            heapq.heappush(self._queue, (end_time, sequence, batch, stage, record.start_time))
+            if self._queue[0][1] == sequence:
+                # new earliest event, wake the thread to shorten its sleep
+                self._cond.notify()
+        return
+
+    def pending(self):
+        '''
+        Number of queued stage completions
+        '''
+        with self._cond:
+            return len(self._queue)
+
+    def run_pending(self, now=None):
+        '''
+        Fires every event due at or before now. Returns the number fired.
+        '''
+        if now is None:
+            now = self.clock()
+        due = []
+        with self._cond:
+            while self._queue and self._queue[0][0] <= now:
+                due.append(heapq.heappop(self._queue))
+        for end_time, _, batch, stage, start_time in due:
+            self._fire(batch, stage, start_time, end_time)
+        return len(due)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._retry_waiting:
+                    if self._queue:
+                        delay = (self._queue[0][0] - self.clock()).total_seconds()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+                self._retry_waiting = False
+            self.run_pending()
+            self._retry()
+
+    def _fire(self, batch, stage, start_time, end_time):
+        '''
+        Ends a stage and starts the next one
+        '''
+        # ignore events for batches that have moved on since they were queued
+        if self.state.batches.get(batch.gyle) is not batch or \
+           batch.current_brew_stage != stage or \
+           batch.brew_stage[stage].start_time != start_time:
+            return
+        self.events_fired += 1
+
+        if next_brew_stage[stage] is None:
+            self.state.finish(batch.gyle, stage)
+        elif not self._advance(batch, stage, end_time):
+            self._waiting.append((batch, stage))
+
+        # tanks may have been freed
+        self._retry()
+        return
+
+    def _retry(self):
+        '''
+        Retries the batches waiting for a tank, oldest first
+        '''
+        for _ in range(len(self._waiting)):
+            b, s = self._waiting.popleft()
+            if b.current_brew_stage == s and not self._advance(b, s, self.clock()):
+                self._waiting.append((b, s))
+        return
+
+    def _advance(self, batch, stage, start):
+        '''
+        Moves a batch into its next stage. Returns False if no tank is free.
+        '''
+        to_stage = next_brew_stage[stage]
+        duration = product_stage_duration(batch.product, to_stage)
+        result, _ = self.state.transition(batch.gyle,
+                                          stage,
+                                          to_stage,
+                                          start,
+                                          duration,
+                                          fermenter=to_stage == bh.BREW_STAGE_FERMENTATION,
+                                          need_tank=to_stage != bh.BREW_STAGE_BOTTLING)
+        return result != bh.TRANSITION_NO_TANK
+
+
+
+def test_brew_scheduler():
+    '''
+    Unit test
+    '''
+    start = datetime(2020, 1, 1)
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    scheduler = Brew_scheduler(state, clock=lambda: start)
+    bh.add_stage_listener(scheduler.stage_changed)
+    try:
+        # more batches than fermenters, so some wait for a tank
+        for gyle in range(9):
+            p = bh.Product('Pilsner', hot_brew_time=3, fermentation_time=1, conditioning_time=1)
+            state.new_batch(str(gyle), p, start, 3)
+        assert scheduler.pending() == 9
+
+        scheduler.run_pending(start + bh.stage_duration(bh.BREW_STAGE_HOT_BREW, 3))
+        stages = [b.current_brew_stage for b in state.batch_list()]
+        assert stages.count(bh.BREW_STAGE_FERMENTATION) == 7
+        assert stages.count(bh.BREW_STAGE_HOT_BREW) == 2
+
+        # run everything to completion
+        now = start
+        while scheduler.pending():
+            now = scheduler._queue[0][0]
+            scheduler.run_pending(now)
+        assert all(b.current_brew_stage == bh.BREW_STAGE_BOTTLING for b in state.batch_list())
+        assert all(b.brew_stage[bh.BREW_STAGE_BOTTLING].end_time for b in state.batch_list())
+        assert len(state.tank_pool.tank_pool) == 9
+    finally:
+        bh.remove_stage_listener(scheduler.stage_changed)
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_brew_scheduler()
@@ -1,6 +1,9 @@
 '''Brewery'''
-from datetime import datetime
-import sales_predictor
+import bisect
+from datetime import datetime, timedelta
+import itertools
+import threading
+import metrics
 
 # Brew Stages
 BREW_STAGE_NONE = 0
@@ -20,25 +23,54 @@ brew_stage = ['None',
               'Dispatch'
              ]
 
+# Unit of the stage durations entered by the operator
+stage_duration_unit = {BREW_STAGE_HOT_BREW     : timedelta(hours=1),
+                       BREW_STAGE_FERMENTATION : timedelta(weeks=1),
+                       BREW_STAGE_CONDITIONING : timedelta(weeks=1),
+                       BREW_STAGE_BOTTLING     : timedelta(hours=1)
+                      }
+
+# Called with (event, batch, stage) when a batch starts or ends a stage
+STAGE_START = 'start'
+STAGE_END = 'end'
+stage_listeners = []
+
+# Called with the Brewery_state once a change has been indexed
+state_listeners = []
+
 recipe = ['None',
           'Pilsner',
           'Dunkel',
           'Red Helles'
          ]
 
+# Tank capabilities
+TANK_FERMENTER = 'fermenter'
+TANK_CONDITIONER = 'conditioner'
+TANK_FERMENTER_CONDITIONER = 'fermenter/conditioner'
+
 class Gyle:
+    __slots__ = ('id',)
+
     def __init__(self, id):
         self.id = id
         return
 
 class Product:
-    def __init__(self, recipe, hot_brew_time=0, fermentation_time=0, conditioning_time=0):
+    __slots__ = ('recipe', 'hot_brew_duration', 'fermentation_duration',
+                 'conditioning_duration', 'bottling_duration')
+
+    def __init__(self, recipe, hot_brew_time=0, fermentation_time=0, conditioning_time=0,
+                 bottling_time=0):
         self.recipe = recipe
         self.hot_brew_duration = hot_brew_time
         self.fermentation_duration = fermentation_time
         self.conditioning_duration = conditioning_time
+        self.bottling_duration = bottling_time
 
 class Brew_tank:
+    __slots__ = ('name', 'volume', 'fermenter', 'conditioner')
+
     def __init__(self, name, volume, fermenter, conditioner):
         self.name = name
         self.volume = volume
@@ -46,45 +78,129 @@ class Brew_tank:
         self.conditioner = conditioner
         return
 
+def tank_capability(tank):
+    '''
+    Returns the capability of a tank, or None if it can neither ferment
+    nor condition
+    '''
+    if tank.fermenter and tank.conditioner:
+        return TANK_FERMENTER_CONDITIONER
+    if tank.fermenter:
+        return TANK_FERMENTER
+    if tank.conditioner:
+        return TANK_CONDITIONER
+    return None
+
 class Brewery_tank_pool:
+    '''
+    Pool of free brewing tanks.
+
+    Tanks are indexed by name, and by capability (fermenter only, conditioner
+    only or both) in lists ordered by volume, so the best fitting tank for a
+    minimum volume is found with a binary search instead of a scan.
+
+    Taking and returning tanks is thread-safe: the lock is only held for the
+    index update, so a tank can never be handed out twice.
+    '''
     def __init__(self, name):
         self.tank_pool_name = name
-        self.tank_pool = []
+        # name -> tank, in the order tanks were added to the pool
+        self.tanks = {}
+        # capability -> sorted list of (volume, sequence, name)
+        self.tanks_by_volume = {TANK_FERMENTER: [],
+                                TANK_CONDITIONER: [],
+                                TANK_FERMENTER_CONDITIONER: []
+                               }
+        self._tank_keys = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
         return
 
+    @property
+    def tank_pool(self):
+        '''
+        List of the free tanks
+        '''
+        with self._lock:
+            return list(self.tanks.values())
+
+    def free_tank_count(self):
+        '''
+        Number of free tanks, read without the lock for status views
+        '''
+        return len(self.tanks)
+
+    @metrics.timed('get_free_tank')
     def get_free_tank(self, name=None, volume=0, fermenter=True):
         '''
         Gets a tank from tank_pool if it is available of the given name
 
-        name: name of tank to get from the pool
-        volume: the minimum tank volume
-        fermenter: allows you to choose a tank with that ability
-        '''
-        for tank in self.tank_pool:
-            if name is not None:
-                if name == tank.name:
-                    self.tank_pool.remove(tank)
-                    return tank
-
-            if (tank.volume >= volume and volume != 0):
-                if fermenter:
-                    if tank.fermenter:
-                        self.tank_pool.remove(tank)
-                        return tank
-                else:
-                    if tank.conditioner:
-                        self.tank_pool.remove(tank)
-                        return tank
+        name: name of tank to get from the pool. None if it is not free, too
+              small or lacks the ability.
+        volume: the minimum tank volume, picks the smallest tank that fits
+                when no name is given
+        fermenter: allows you to choose a tank with that ability, a
+                   conditioner if False
+        '''
+        with self._lock:
+            return self._get_free_tank(name, volume, fermenter)
+
+    def _get_free_tank(self, name, volume, fermenter):
+        if name is not None:
+            tank = self.tanks.get(name)
+            if (tank is None or tank.volume < volume
+                    or not (tank.fermenter if fermenter else tank.conditioner)):
+                return None
+            return self._remove(name)
+
+        if volume != 0:
+            if fermenter:
+                capabilities = (TANK_FERMENTER, TANK_FERMENTER_CONDITIONER)
+            else:
+                capabilities = (TANK_CONDITIONER, TANK_FERMENTER_CONDITIONER)
+
+            # best fit, preferring single purpose tanks on equal volume
+            best = None
+            for capability in capabilities:
+                tanks = self.tanks_by_volume[capability]
+                i = bisect.bisect_left(tanks, (volume,))
+                if i < len(tanks) and (best is None or tanks[i][0] < best[0]):
+                    best = tanks[i]
+            if best is not None:
+                return self._remove(best[2])
         return None
 
     def add(self, tank):
         '''
         Add a new tank to the pool
         '''
-        self.tank_pool.append(tank)
+        with self._lock:
+            if tank.name in self.tanks:
+                return
+            self.tanks[tank.name] = tank
+            capability = tank_capability(tank)
+            if capability is not None:
+                key = (tank.volume, self._sequence, tank.name)
+                self._sequence += 1
+                bisect.insort(self.tanks_by_volume[capability], key)
+                self._tank_keys[tank.name] = key
         return
 
+    def _remove(self, name):
+        '''
+        Takes the named tank out of the pool and its indexes, the caller
+        holds the lock
+        '''
+        tank = self.tanks.pop(name)
+        key = self._tank_keys.pop(name, None)
+        if key is not None:
+            tanks = self.tanks_by_volume[tank_capability(tank)]
+            del tanks[bisect.bisect_left(tanks, key)]
+        return tank
+
 class Brew_stage:
+    __slots__ = ('stage', 'gyle', 'duration', 'start_time', 'end_time')
+
     def __init__(self, stage, gyle, start=0, duration=0):
         self.stage = stage
         self.gyle = gyle
@@ -92,52 +208,85 @@ class Brew_stage:
         self.start_time = start
         self.end_time = 0
 
-class Bottling:
+class Bottling(Brew_stage):
+    __slots__ = ('bottles', 'kegs')
+
     def __init__(self, stage, gyle, start=0, duration=0):
-        self.stage = stage
-        self.gyle = gyle
-        self.duration = duration
-        self.start_time = start
-        self.end_time = 0
+        Brew_stage.__init__(self, stage, gyle, start, duration)
         self.bottles = 0
+        self.kegs = 0
 
-class Storage:
-    def __init__(self, stage, gyle, start=0, duration=0):
-        self.stage = stage
-        self.gyle = gyle
-        self.duration = duration
-        self.start_time = start
-        self.end_time = 0
+class Storage(Brew_stage):
+    __slots__ = ()
 
-class Dispatch:
-    def __init__(self, stage, gyle, start=0, duration=0):
-        self.stage = stage
+class Dispatch(Brew_stage):
+    __slots__ = ()
+
+# Record class of each stage
+stage_record_class = {BREW_STAGE_HOT_BREW     : Brew_stage,
+                      BREW_STAGE_FERMENTATION : Brew_stage,
+                      BREW_STAGE_CONDITIONING : Brew_stage,
+                      BREW_STAGE_BOTTLING     : Bottling,
+                      BREW_STAGE_STORAGE      : Storage,
+                      BREW_STAGE_DISPACTH     : Dispatch
+                     }
+
+class Stage_records(dict):
+    '''
+    Stage -> stage record of a batch. A record is only created the first
+    time its stage is looked up with [], get() returns None for stages that
+    have not been looked up yet.
+    '''
+    __slots__ = ('gyle',)
+
+    def __init__(self, gyle):
+        dict.__init__(self)
         self.gyle = gyle
-        self.duration = duration
-        self.start_time = start
-        self.end_time = 0
+
+    def __missing__(self, stage):
+        record = stage_record_class[stage](stage, self.gyle)
+        self[stage] = record
+        return record
 
 class Batch:
     '''
     Used to record the current state of the batch
+
+    Batches are kept for the whole production history, so they use slots and
+    only create the records of the stages the batch has been through.
     '''
+    __slots__ = ('gyle', 'product', 'volume', 'brew_tanks', 'current_brew_stage',
+                 '_brew_stage')
+
     def __init__(self, gyle, product):
         self.gyle = gyle
         self.product = product
         self.volume = 0
         self.brew_tanks = []
         self.current_brew_stage = BREW_STAGE_NONE
-        # Array of stages
-        self.brew_stage_log = [BREW_STAGE_NONE,]
-        self.brew_stage = {BREW_STAGE_HOT_BREW     : Brew_stage(BREW_STAGE_HOT_BREW, gyle),
-                           BREW_STAGE_FERMENTATION : Brew_stage(BREW_STAGE_FERMENTATION, gyle),
-                           BREW_STAGE_CONDITIONING : Brew_stage(BREW_STAGE_CONDITIONING, gyle),
-                           BREW_STAGE_BOTTLING     : Bottling(BREW_STAGE_BOTTLING, gyle),
-                           BREW_STAGE_STORAGE      : Storage(BREW_STAGE_STORAGE, gyle),
-                           BREW_STAGE_DISPACTH     : Dispatch(BREW_STAGE_DISPACTH, gyle)
-                          }
+        self._brew_stage = None
         return
 
+    @property
+    def brew_stage(self):
+        '''
+        Stage -> stage record, see Stage_records
+        '''
+        if self._brew_stage is None:
+            self._brew_stage = Stage_records(self.gyle)
+        return self._brew_stage
+
+    @property
+    def brew_stage_log(self):
+        '''
+        Array of stages the batch has been through
+        '''
+        stages = [BREW_STAGE_NONE,]
+        if self._brew_stage is not None:
+            stages += sorted(stage for stage, record in self._brew_stage.items()
+                             if record.start_time)
+        return stages
+
     def start_brew_stage(self, stage, gyle, start, duration, tank=None):
         '''
         Used to record the start of stage infomation
@@ -156,7 +305,8 @@ class Batch:
             if tank is not None:
                 self.brew_tanks.append(tank)
 
-            # schedule brew! add event to scheduler queue
+            # let the brew scheduler and other listeners know
+            notify_stage_listeners(STAGE_START, self, stage.stage)
 
         return
 
@@ -174,8 +324,280 @@ class Batch:
                 for tank in self.brew_tanks:
                     tank_pool.add(tank)
                 self.brew_tanks = []
+            notify_stage_listeners(STAGE_END, self, stage.stage)
+        return
+
+def add_stage_listener(listener):
+    '''
+    Registers listener(event, batch, stage) to be called when any batch
+    starts (STAGE_START) or ends (STAGE_END) a stage
+    '''
+    stage_listeners.append(listener)
+    return
+
+def remove_stage_listener(listener):
+    if listener in stage_listeners:
+        stage_listeners.remove(listener)
+    return
+
+def notify_stage_listeners(event, batch, stage):
+    for listener in list(stage_listeners):
+        listener(event, batch, stage)
+    return
+
+def add_state_listener(listener):
+    '''
+    Registers listener(state) to be called after any Brewery_state change,
+    once the state's indexes are up to date
+    '''
+    state_listeners.append(listener)
+    return
+
+def remove_state_listener(listener):
+    if listener in state_listeners:
+        state_listeners.remove(listener)
+    return
+
+def notify_state_listeners(state):
+    for listener in list(state_listeners):
+        listener(state)
+    return
+
+def stage_duration(stage, duration):
+    '''
+    Converts a stage duration entered by the operator into a timedelta.
+    Returns None if the duration is not a number.
+    '''
+    try:
+        return float(duration) * stage_duration_unit[stage]
+    except (TypeError, ValueError, KeyError):
+        return None
+
+# Stage transition results
+TRANSITION_OK = 0
+TRANSITION_NO_BATCH = 1
+TRANSITION_WRONG_STAGE = 2
+TRANSITION_NO_TANK = 3
+
+class Brewery_state:
+    '''
+    Thread-safe record of the batches in production and their tanks.
+
+    Each gyle has its own lock, so a stage transition is atomic for that
+    batch without holding up requests for other batches. Tanks are taken
+    from the pool atomically, so concurrent transitions can not be given
+    the same tank.
+
+    Secondary indexes of recipe -> gyles, current stage -> gyles and
+    tank name -> gyle are kept up to date by every change made through the
+    state, so filtered status queries cost O(result) rather than O(batches).
+    Gyle sets are dicts, keeping the order batches joined them.
+
+    The number of batches, per stage and per recipe are published in
+    status_counts. Each change replaces the dict rather than updating it, so
+    it can be read without any lock.
+    '''
+    def __init__(self, tank_pool):
+        self.tank_pool = tank_pool
+        self.batches = {}
+        self.gyles_by_recipe = {}
+        self.gyles_by_stage = {}
+        self.gyle_by_tank = {}
+        self.status_counts = {'batches': 0, 'stages': {}, 'recipes': {}}
+        self._index_lock = threading.Lock()
+        self._gyle_locks = {}
+        self._gyle_locks_lock = threading.Lock()
+        return
+
+    def gyle_lock(self, gyle):
+        '''
+        Returns the lock of a gyle, creating it on first use
+        '''
+        with self._gyle_locks_lock:
+            lock = self._gyle_locks.get(gyle)
+            if lock is None:
+                lock = self._gyle_locks[gyle] = threading.Lock()
+            return lock
+
+    def owns(self, batch):
+        '''
+        True if batch is one of this state's batches, stage listeners are
+        called for the batches of every state
+        '''
+        return self.batches.get(batch.gyle) is batch
+
+    def batch_list(self):
+        '''
+        Snapshot of the batches, safe to iterate while batches are added
+        '''
+        return list(self.batches.values())
+
+    def _index(self, b, old_stage=None, old_tanks=()):
+        '''
+        Moves a batch from the index entries of its old stage and tanks to
+        those of its current stage and tanks
+        '''
+        with self._index_lock:
+            if old_stage is None:
+                self.gyles_by_recipe.setdefault(b.product.recipe, {})[b.gyle] = None
+            else:
+                self.gyles_by_stage[old_stage].pop(b.gyle, None)
+            for name in old_tanks:
+                if self.gyle_by_tank.get(name) == b.gyle:
+                    del self.gyle_by_tank[name]
+            self.gyles_by_stage.setdefault(b.current_brew_stage, {})[b.gyle] = None
+            for tank in b.brew_tanks:
+                self.gyle_by_tank[tank.name] = b.gyle
+            self._count(b, old_stage)
+        notify_state_listeners(self)
         return
 
+    def _count(self, b, old_stage):
+        '''
+        Publishes new status_counts for a batch moving from old_stage, the
+        caller holds the index lock
+        '''
+        counts = self.status_counts
+        stages = dict(counts['stages'])
+        recipes = counts['recipes']
+        batches = counts['batches']
+        if old_stage is None:
+            recipes = dict(recipes)
+            recipes[b.product.recipe] = recipes.get(b.product.recipe, 0) + 1
+            batches += 1
+        else:
+            stages[old_stage] -= 1
+        stages[b.current_brew_stage] = stages.get(b.current_brew_stage, 0) + 1
+        self.status_counts = {'batches': batches, 'stages': stages, 'recipes': recipes}
+        return
+
+    def add_batch(self, b):
+        '''
+        Adds an existing batch, e.g. one restored from disk, and indexes it
+        '''
+        with self.gyle_lock(b.gyle):
+            self.batches[b.gyle] = b
+            self._index(b)
+        return
+
+    def find_gyles(self, recipe=None, stage=None, tank=None, start=0, count=None):
+        '''
+        Returns the gyles matching every filter given, in the order they were
+        added to the brewery.
+
+        recipe: product recipe
+        stage: current BREW_STAGE_xxx
+        tank: name of a tank the batch is in
+        start, count: the slice of the matches to return, for paging
+
+        Only the smallest index is walked, so the cost is proportional to the
+        matches rather than to the number of batches.
+        '''
+        with self._index_lock:
+            candidates = []
+            if recipe is not None:
+                candidates.append(self.gyles_by_recipe.get(recipe, {}))
+            if stage is not None:
+                candidates.append(self.gyles_by_stage.get(stage, {}))
+            if tank is not None:
+                gyle = self.gyle_by_tank.get(tank)
+                candidates.append({} if gyle is None else {gyle: None})
+            if not candidates:
+                candidates.append(self.batches)
+            smallest = min(candidates, key=len)
+            others = [c for c in candidates if c is not smallest]
+            matches = (g for g in smallest if all(g in c for c in others))
+            stop = None if count is None else start + count
+            return list(itertools.islice(matches, start, stop))
+
+    def new_batch(self, gyle, product, start, duration, volume=0):
+        '''
+        Creates a batch of volume litres and starts its hot brew. Returns
+        None if the gyle is already in use. Raises TypeError, with nothing
+        changed, if the recipe cannot be indexed.
+        '''
+        # checked before the batch is published, as _index cannot fail after
+        hash(product.recipe)
+        with self.gyle_lock(gyle):
+            if gyle in self.batches:
+                return None
+            b = Batch(gyle, product)
+            b.volume = volume
+            # added first so stage listeners see the batch is owned
+            self.batches[gyle] = b
+            b.start_brew_stage(BREW_STAGE_HOT_BREW, gyle, start, duration)
+            self._index(b)
+            return b
+
+    def transition(self, gyle, from_stage, to_stage, start, duration,
+                   tank_name=None, volume=0, fermenter=None, need_tank=True, update=None):
+        '''
+        Atomically ends a batch's current stage and starts the next one,
+        moving the batch to a free tank if the next stage needs one.
+
+        gyle: The unique batch number
+        from_stage: the stage the batch must currently be in
+        to_stage: the stage to start
+        start: The start date of the next stage
+        duration: How long the next stage will last
+        tank_name, fermenter: tank to take, see get_free_tank. The best
+                              fitting free tank if tank_name is None, and a
+                              conditioner for conditioning if fermenter is
+                              None.
+        volume: litres in the batch from now on, 0 keeps the batch's volume.
+                The tank taken must hold the batch, any tank if its volume
+                is not known.
+        need_tank: the next stage runs in a tank
+        update: called with the batch under the gyle lock once the
+                transition is valid, before the stage changes, so the change
+                it makes is part of the transition
+
+        The volume is set before the stage listeners are told about the
+        new stage.
+
+        Returns (TRANSITION_xxx result, batch)
+        '''
+        with self.gyle_lock(gyle):
+            b = self.batches.get(gyle)
+            if b is None:
+                return TRANSITION_NO_BATCH, None
+            if b.current_brew_stage != from_stage:
+                return TRANSITION_WRONG_STAGE, b
+
+            tank = None
+            if need_tank:
+                if fermenter is None:
+                    fermenter = to_stage != BREW_STAGE_CONDITIONING
+                tank = self.tank_pool.get_free_tank(name=tank_name, volume=volume or b.volume or 1,
+                                                    fermenter=fermenter)
+                if tank is None:
+                    return TRANSITION_NO_TANK, b
+            if volume:
+                b.volume = volume
+            if update is not None:
+                update(b)
+
+            old_tanks = [t.name for t in b.brew_tanks]
+            b.end_brew_stage(from_stage, gyle, tank_pool=self.tank_pool)
+            b.start_brew_stage(to_stage, gyle, start, duration, tank)
+            self._index(b, from_stage, old_tanks)
+            return TRANSITION_OK, b
+
+    def finish(self, gyle, stage):
+        '''
+        Ends the final stage of a batch, returning any tanks to the pool
+        '''
+        with self.gyle_lock(gyle):
+            b = self.batches.get(gyle)
+            if b is None:
+                return TRANSITION_NO_BATCH, None
+            if b.current_brew_stage != stage:
+                return TRANSITION_WRONG_STAGE, b
+            old_tanks = [t.name for t in b.brew_tanks]
+            b.end_brew_stage(stage, gyle, tank_pool=self.tank_pool)
+            self._index(b, stage, old_tanks)
+            return TRANSITION_OK, b
+
 
 def init_brew_tank_pool(pool_name):
     '''
@@ -213,7 +635,138 @@ def test_fncs():
     print(brewery_tank_pool)
     #test_tank()
     #test_gyle()
-    #test_batch()
+    test_batch()
+    test_tank_pool()
+    test_concurrent_transitions()
+    test_status_indexes()
+    return
+
+def test_batch():
+    '''
+    Unit test
+    '''
+    b = Batch('1', Product('Pilsner'))
+    assert b.brew_stage.get(BREW_STAGE_FERMENTATION) is None
+    assert b.brew_stage_log == [BREW_STAGE_NONE]
+    b.start_brew_stage(BREW_STAGE_HOT_BREW, '1', datetime.now(), 3)
+    assert b.brew_stage[BREW_STAGE_HOT_BREW].duration == 3
+    assert isinstance(b.brew_stage[BREW_STAGE_BOTTLING], Bottling)
+    assert b.brew_stage_log == [BREW_STAGE_NONE, BREW_STAGE_HOT_BREW]
+    assert not hasattr(b, '__dict__')
+    return
+
+def test_tank_pool():
+    '''
+    Unit test
+    '''
+    tank_pool = init_brew_tank_pool('barnabys')
+    # best fit: the smallest tank that holds the volume
+    assert tank_pool.get_free_tank(volume=700).name == 'R2D2'
+    assert tank_pool.get_free_tank(volume=700).name == 'Brigadier'
+    assert tank_pool.get_free_tank(volume=600, fermenter=False).name == 'Gertrude'
+    assert tank_pool.get_free_tank(volume=2000) is None
+    tank = tank_pool.get_free_tank(name='Albert')
+    assert tank.name == 'Albert' and 'Albert' not in tank_pool.tanks
+    assert tank_pool.get_free_tank(name='Albert') is None
+    tank_pool.add(tank)
+    assert tank_pool.get_free_tank(volume=900).name == 'Camilla'
+    assert len(tank_pool.tank_pool) == 5
+    # a named tank is only taken if it is free, fits and has the ability
+    assert tank_pool.get_free_tank(name='NoSuchTank', volume=500) is None
+    assert tank_pool.get_free_tank(name='Harry', volume=500) is None
+    assert tank_pool.get_free_tank(name='Gertrude', volume=700, fermenter=False) is None
+    assert tank_pool.get_free_tank(name='Dylon', volume=900) is None
+    assert len(tank_pool.tank_pool) == 5
+
+    # a named tank that cannot be taken is not swapped for another
+    state = Brewery_state(init_brew_tank_pool('barnabys'))
+    state.new_batch('1', Product('Pilsner'), datetime.now(), 3, volume=500)
+    assert state.transition('1', BREW_STAGE_HOT_BREW, BREW_STAGE_FERMENTATION, datetime.now(), 4,
+                            tank_name='NoSuchTank')[0] == TRANSITION_NO_TANK
+    assert state.transition('1', BREW_STAGE_HOT_BREW, BREW_STAGE_FERMENTATION, datetime.now(), 4,
+                            tank_name='Gertrude')[0] == TRANSITION_NO_TANK
+    state.transition('1', BREW_STAGE_HOT_BREW, BREW_STAGE_FERMENTATION, datetime.now(), 4,
+                     tank_name='R2D2')
+    # conditioning never picks a fermenter only tank
+    for tank in list(state.tank_pool.tank_pool):
+        state.tank_pool.get_free_tank(name=tank.name, fermenter=tank.fermenter)
+    state.tank_pool.add(Brew_tank('R2D3', 800, True, False))
+    assert state.transition('1', BREW_STAGE_FERMENTATION, BREW_STAGE_CONDITIONING,
+                            datetime.now(), 2)[0] == TRANSITION_NO_TANK
+    return
+
+def test_concurrent_transitions():
+    '''
+    Stress test: many threads racing to create the same gyles and to move
+    batches into tanks must never double allocate a gyle or a tank
+    '''
+    state = Brewery_state(init_brew_tank_pool('barnabys'))
+    gyles = [str(g) for g in range(40)]
+    created = []
+    allocated = []
+    barrier = threading.Barrier(16)
+
+    def worker():
+        barrier.wait()
+        for gyle in gyles:
+            if state.new_batch(gyle, Product('Pilsner'), datetime.now(), 3) is not None:
+                created.append(gyle)
+        for gyle in gyles:
+            result, b = state.transition(gyle, BREW_STAGE_HOT_BREW, BREW_STAGE_FERMENTATION,
+                                         datetime.now(), 4, volume=500)
+            if result == TRANSITION_OK:
+                allocated.append((gyle, b.brew_tanks[0].name))
+
+    threads = [threading.Thread(target=worker) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(created) == sorted(gyles)
+    # 7 fermenters, each given to exactly one batch
+    assert len(allocated) == 7
+    assert len({tank for _, tank in allocated}) == 7
+    assert len({gyle for gyle, _ in allocated}) == 7
+    assert len(state.tank_pool.tank_pool) == 2
+    assert sorted(state.find_gyles(stage=BREW_STAGE_FERMENTATION)) == sorted(g for g, _ in allocated)
+    assert len(state.find_gyles(stage=BREW_STAGE_HOT_BREW)) == 33
+    assert all(state.find_gyles(tank=tank) == [gyle] for gyle, tank in allocated)
+    return
+
+def test_status_indexes():
+    '''
+    Unit test
+    '''
+    state = Brewery_state(init_brew_tank_pool('barnabys'))
+    for gyle in range(10):
+        state.new_batch(str(gyle), Product(('Pilsner', 'Dunkel')[gyle % 2]), datetime.now(), 3)
+    assert state.find_gyles(recipe='Dunkel') == ['1', '3', '5', '7', '9']
+    assert state.find_gyles(recipe='Dunkel', start=1, count=2) == ['3', '5']
+    assert state.find_gyles(recipe='Stout') == []
+    assert state.find_gyles(start=8) == ['8', '9']
+
+    state.transition('3', BREW_STAGE_HOT_BREW, BREW_STAGE_FERMENTATION, datetime.now(), 4,
+                     tank_name='Albert')
+    assert state.find_gyles(recipe='Dunkel', stage=BREW_STAGE_FERMENTATION) == ['3']
+    assert state.find_gyles(tank='Albert') == ['3']
+    assert '3' not in state.find_gyles(stage=BREW_STAGE_HOT_BREW)
+
+    state.transition('3', BREW_STAGE_FERMENTATION, BREW_STAGE_CONDITIONING, datetime.now(), 2,
+                     tank_name='Gertrude')
+    assert state.find_gyles(tank='Albert') == []
+    assert state.find_gyles(tank='Gertrude', stage=BREW_STAGE_CONDITIONING) == ['3']
+    state.transition('3', BREW_STAGE_CONDITIONING, BREW_STAGE_BOTTLING, datetime.now(), 3,
+                     need_tank=False)
+    state.finish('3', BREW_STAGE_BOTTLING)
+    assert state.find_gyles(tank='Gertrude') == []
+    assert state.find_gyles(stage=BREW_STAGE_BOTTLING) == ['3']
+
+    counts = state.status_counts
+    assert counts['batches'] == 10 and counts['recipes'] == {'Pilsner': 5, 'Dunkel': 5}
+    assert counts['stages'] == {BREW_STAGE_HOT_BREW: 9, BREW_STAGE_FERMENTATION: 0,
+                                BREW_STAGE_CONDITIONING: 0, BREW_STAGE_BOTTLING: 1}
+    assert state.owns(state.batches['3']) and not state.owns(Batch('3', Product('Pilsner')))
     return
 
 
@@ -0,0 +1,270 @@
+'''Brewery Sites
+
+Brewery state sharded by site. Each site has its own tank pool, batches,
+inventory and persistence, so requests for one site never wait on the locks
+of another. The tank pools are loaded from the 'sites' section of
+config.json, and a worker process only loads the sites it owns:
+
+    "sites": {
+        "default_site": "barnabys",
+        "owned_sites": "",
+        "tank_pools": {
+            "barnabys": [{"name": "Albert", "volume": "1000",
+                          "use": "fermenter/conditioner"}, ...]
+        }
+    }
+
+owned_sites is a comma separated list, empty for every site. The
+BREWHOUSE_SITES environment variable overrides it, so several workers can
+share one config file.
+
+The cross-site status reads the counts each Brewery_state publishes, so it
+takes no shard's lock.
+'''
+import os
+import brewery as bh
+import brew_scheduler as bs
+import batch_store as bst
+import inventory as inv
+import production_planner as pp
+
+# Overrides owned_sites for this process
+SITES_ENVIRONMENT = 'BREWHOUSE_SITES'
+
+# Site used when there is no sites section
+DEFAULT_SITE = 'barnabys'
+
+
+def tank_pool_from_config(name, tanks):
+    '''
+    Creates a Brewery_tank_pool from a list of {name, volume, use} tanks,
+    use being one of the TANK_xxx capabilities
+    '''
+    tank_pool = bh.Brewery_tank_pool(name)
+    for tank in tanks:
+        use = tank.get('use', bh.TANK_FERMENTER_CONDITIONER)
+        if use not in (bh.TANK_FERMENTER, bh.TANK_CONDITIONER, bh.TANK_FERMENTER_CONDITIONER):
+            raise ValueError('Tank {} of site {} has unknown use {}'.format(tank['name'], name, use))
+        tank_pool.add(bh.Brew_tank(tank['name'],
+                                   int(tank['volume']),
+                                   use != bh.TANK_CONDITIONER,
+                                   use != bh.TANK_FERMENTER))
+    return tank_pool
+
+class Brewery_site:
+    '''
+    One shard: a site's tanks, batches and stock, and the services that
+    follow its stage changes
+    '''
+    def __init__(self, name, tank_pool, state=None):
+        self.name = name
+        self.tank_pool = tank_pool
+        self.state = state if state is not None else bh.Brewery_state(tank_pool)
+        self.inventory_ledger = inv.Inventory_ledger()
+        self.batch_store = None
+        self.production_planner = None
+        self.scheduler = None
+        return
+
+    def open(self, persistence=None):
+        '''
+        Restores the site's batches and stock from its own directory under
+        the persistence directory and starts planning its production
+
+        persistence: the 'persistence' section of config.json, or None
+        '''
+        if persistence is not None:
+            self.batch_store = bst.Batch_store(os.path.join(persistence['directory'], self.name),
+                                               int(persistence['group_commit_ms']) / 1000,
+                                               int(persistence['snapshot_interval']))
+            self.batch_store.open(self.state)
+            self.inventory_ledger.open(os.path.join(persistence['directory'], self.name,
+                                                    inv.LEDGER_FILE))
+            inv.restock(self.state, self.inventory_ledger)
+        # follows the stage changes of the restored batches from now on
+        self.production_planner = pp.Production_planner(self.state)
+        self.production_planner.start()
+        return
+
+    def start_scheduler(self):
+        '''
+        Advances the site's batches automatically as their stages complete
+        '''
+        self.scheduler = bs.Brew_scheduler(self.state)
+        self.scheduler.start()
+        return
+
+    def close(self):
+        for service in (self.scheduler, self.production_planner):
+            if service is not None:
+                service.stop()
+        if self.batch_store is not None:
+            self.batch_store.close()
+        self.inventory_ledger.close()
+        self.scheduler = self.production_planner = self.batch_store = None
+        return
+
+    def status(self):
+        '''
+        Batches per stage and recipe and free tanks, without taking a lock
+        '''
+        counts = self.state.status_counts
+        return {'batches': counts['batches'],
+                'stages': {bh.brew_stage[stage]: n for stage, n in counts['stages'].items() if n},
+                'recipes': dict(counts['recipes']),
+                'free_tanks': self.tank_pool.free_tank_count()
+               }
+
+class Brewery_sites:
+    '''
+    The sites owned by this process, by site key
+
+    sites: dict of site name -> Brewery_site
+    default: name of the site used when a request names none
+    '''
+    def __init__(self, sites, default=None):
+        if not sites:
+            raise ValueError('No brewery sites')
+        self.sites = sites
+        self.default = self.sites[default] if default in sites else next(iter(sites.values()))
+        return
+
+    def get(self, name=None):
+        '''
+        Returns the named site, the default site if name is None, or None if
+        this process does not own it
+        '''
+        if name is None or name == '':
+            return self.default
+        return self.sites.get(name)
+
+    def names(self):
+        return list(self.sites)
+
+    def open(self, persistence=None):
+        for site in self.sites.values():
+            site.open(persistence)
+        return
+
+    def start_schedulers(self):
+        for site in self.sites.values():
+            site.start_scheduler()
+        return
+
+    def close(self):
+        for site in self.sites.values():
+            site.close()
+        return
+
+    def status(self):
+        '''
+        Status of every site and their totals. Each site's counts are read
+        as one published snapshot, so no shard is locked.
+        '''
+        sites = {name: site.status() for name, site in self.sites.items()}
+        total = {'batches': 0, 'stages': {}, 'recipes': {}, 'free_tanks': 0}
+        for status in sites.values():
+            total['batches'] += status['batches']
+            total['free_tanks'] += status['free_tanks']
+            for key in ('stages', 'recipes'):
+                for name, n in status[key].items():
+                    total[key][name] = total[key].get(name, 0) + n
+        return {'sites': sites, 'total': total}
+
+def owned_site_names(config, owned=None):
+    '''
+    Site names this process owns: owned, else BREWHOUSE_SITES, else
+    owned_sites from config. None means every site.
+    '''
+    if owned is None:
+        owned = os.environ.get(SITES_ENVIRONMENT, config.get('owned_sites', ''))
+    names = [name.strip() for name in owned.split(',') if name.strip()]
+    return names or None
+
+def load_sites(config=None, owned=None):
+    '''
+    Creates the Brewery_sites owned by this process
+
+    config: the 'sites' section of config.json. Without it there is one
+            site with the tanks of init_brew_tank_pool.
+    owned: comma separated site names, see owned_site_names
+    '''
+    if not config:
+        return Brewery_sites({DEFAULT_SITE: Brewery_site(DEFAULT_SITE,
+                                                         bh.init_brew_tank_pool(DEFAULT_SITE))})
+    tank_pools = config['tank_pools']
+    names = owned_site_names(config, owned)
+    if names is None:
+        names = list(tank_pools)
+    unknown = [name for name in names if name not in tank_pools]
+    if unknown:
+        raise ValueError('Unknown sites: ' + ', '.join(unknown))
+    sites = {name: Brewery_site(name, tank_pool_from_config(name, tank_pools[name]))
+             for name in names}
+    return Brewery_sites(sites, config.get('default_site'))
+
+def test_brewery_sites():
+    '''
+    Unit test
+    '''
+    import threading
+    from datetime import datetime
+    config = {'default_site': 'north',
+              'owned_sites': '',
+              'tank_pools': {
+                  'north': [{'name': 'Albert', 'volume': '1000', 'use': bh.TANK_FERMENTER_CONDITIONER},
+                            {'name': 'Gertrude', 'volume': '680', 'use': bh.TANK_CONDITIONER}],
+                  'south': [{'name': 'Albert', 'volume': '800', 'use': bh.TANK_FERMENTER}]
+              }}
+    sites = load_sites(config)
+    assert sites.names() == ['north', 'south'] and sites.get().name == 'north'
+    assert load_sites(config, 'south').names() == ['south']
+    assert sites.get('west') is None
+    south = sites.get('south').tank_pool.get_free_tank(volume=500)
+    assert south.volume == 800 and south.fermenter and not south.conditioner
+    sites.get('south').tank_pool.add(south)
+
+    sites.open()
+    try:
+        # the same gyle at two sites are two batches, each followed by its
+        # own site's planner only
+        now = datetime(2020, 1, 1)
+        for name in ('north', 'south'):
+            state = sites.get(name).state
+            state.new_batch('1', bh.Product('Pilsner'), now, 3)
+            state.transition('1', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, now, 4,
+                             tank_name='Albert')
+        assert sites.get('north').state.batches['1'] is not sites.get('south').state.batches['1']
+        assert list(sites.get('south').production_planner._held) == ['Albert']
+        sites.get('north').state.new_batch('2', bh.Product('Dunkel'), now, 3)
+
+        status = sites.status()
+        assert status['sites']['north'] == {'batches': 2,
+                                            'stages': {'Hot Brew': 1, 'Fermentation': 1},
+                                            'recipes': {'Pilsner': 1, 'Dunkel': 1},
+                                            'free_tanks': 1}
+        assert status['sites']['south']['free_tanks'] == 0
+        assert status['total']['batches'] == 3 and status['total']['stages']['Fermentation'] == 2
+
+        # the status does not wait for a site's locks
+        state = sites.get('north').state
+        with state._index_lock, state.gyle_lock('1'):
+            t = threading.Thread(target=sites.status)
+            t.start()
+            t.join(1)
+            assert not t.is_alive()
+    finally:
+        sites.close()
+
+    try:
+        tank_pool_from_config('x', [{'name': 'A', 'volume': '1', 'use': 'kettle'}])
+        assert False
+    except ValueError:
+        pass
+    assert load_sites().names() == [DEFAULT_SITE]
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_brewery_sites()
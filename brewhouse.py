@@ -1,20 +1,44 @@
 '''Barnaby's Brewhouse'''
 from datetime import datetime
-from time import strftime
+import atexit
 import json
 import logging
-from logging.handlers import RotatingFileHandler
+import socket
+import threading
+import time
 import traceback
-from flask import Flask, render_template, request, redirect
+from flask import Flask, Response, g, render_template, request, redirect, jsonify
+from werkzeug.serving import is_running_from_reloader
+import brew_api as api
 import brewery as bh
-import sales_predictor as sp
+import brewery_sites as bsite
+import inventory as inv
+import log_writer as lw
+import production_simulator as psim
+import metrics
+import response_cache as rc
+import stage_feed as sf
+import tank_planner as tp
 
 
 config_file: str = "config.json"
 config_dict: dict = {}
+sales_file: str = 'Barnabys_sales_fabricated_data.csv'
+sales_chunk_size: int = 0
 
-batches = {}
-brewery_tank_pool = bh.Brewery_tank_pool('')
+# Rows per page of the brewing status
+BREW_STATUS_PAGE_SIZE = 50
+
+# Sites owned by this process, requests pick one with ?site=
+brewery_sites = bsite.Brewery_sites({'': bsite.Brewery_site('', bh.Brewery_tank_pool(''))})
+stage_feed = sf.Stage_feed()
+response_cache = rc.Response_cache()
+
+# Longest wait of a long-poll request, in seconds
+LONG_POLL_TIMEOUT = 60
+
+# Longest wait for the server to start listening before warming up, in seconds
+WARM_UP_TIMEOUT = 60
 
 
 # Display user error message
@@ -30,6 +54,35 @@ def user_error(error_msg):
 app = Flask(__name__)
 
 
+def metrics_route():
+    '''
+    Route label of the current request, the rule rather than the path so
+    query strings and gyles do not create new series
+    '''
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def before_request():
+    g.metrics_start = metrics.metrics.request_started(metrics_route())
+    # the site the request is for, other sites may be owned by other workers
+    g.site = brewery_sites.get(request.values.get('site'))
+    if g.site is None:
+        return user_error('Unknown site'), 404
+
+
+@app.context_processor
+def site_context():
+    # forms pass the site on to the next request
+    return {'site': g.site.name if 'site' in g else ''}
+
+
+@app.teardown_request
+def teardown_request(e):
+    if 'metrics_start' in g:
+        metrics.metrics.request_ended(metrics_route())
+
+
 # Functions to integrate with flask logging.
 @app.after_request
 def after_request(response):
@@ -38,15 +91,21 @@ def after_request(response):
     of every registry in the log since 500 is already logged via
     @app.errorhandler
     '''
+    if 'metrics_start' in g:
+        metrics.metrics.request_finished(metrics_route(), request.method,
+                                         response.status_code, g.metrics_start)
     if response.status_code != 500:
-        time_stamp = strftime('[%Y-%b-%d %H:%M]')
-        logger.info('%s %s %s %s %s %s',
-                    time_stamp,
+        # queued, the log file is written by the log writer thread
+        logger.info('%s %s %s %s %s',
                     request.remote_addr,
                     request.method,
                     request.scheme,
                     request.full_path,
-                    response.status)
+                    response.status,
+                    extra={'remote_addr': request.remote_addr,
+                           'method': request.method,
+                           'path': request.full_path,
+                           'status': response.status_code})
     return response
 
 
@@ -64,38 +123,159 @@ def exceptions(e) -> [str, int]:
     Logging after every expection.
     Handle program crash exception. Logs stack back trace
     '''
-    time_stamp = strftime('[%Y-%b-%d %H:%M]')
     trace_back = traceback.format_exc()
-    logger.info('%s %s %s %s %s 5xx INTERNAL SERVER ERROR\n%s',
-                time_stamp,
-                request.remote_addr,
-                request.method,
-                request.scheme,
-                request.full_path,
-                trace_back)
+    logger.error('%s %s %s %s 5xx INTERNAL SERVER ERROR',
+                 request.remote_addr,
+                 request.method,
+                 request.scheme,
+                 request.full_path,
+                 extra={'remote_addr': request.remote_addr,
+                        'method': request.method,
+                        'path': request.full_path,
+                        'status': 500,
+                        'trace_back': trace_back})
     return "Internal Server Error", 500
 
 
-def brew_status(beer=None):
+def predictor():
+    '''
+    The sales_predictor module, imported on first use rather than at start
+    up as it loads pandas
+    '''
+    import sales_predictor
+    return sales_predictor
+
+
+def forecaster():
+    '''
+    The sales_forecaster module, imported on first use, see predictor
+    '''
+    import sales_forecaster
+    return sales_forecaster
+
+
+def warm_up(host='127.0.0.1', port=5000):
+    '''
+    Waits for the server to start listening, then loads pandas and works out
+    the sales prediction and forecast, so the first sales page does not wait
+    for them
+    '''
+    deadline = time.monotonic() + WARM_UP_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                return
+            time.sleep(0.05)
+    begin = time.perf_counter()
+    try:
+        predictor().prediction_cache.get(sales_file, 'html', sales_chunk_size)
+        forecaster().forecast_cache.get(sales_file, sales_chunk_size)
+    except Exception:
+        logger.exception('Warm up failed')
+        return
+    elapsed = time.perf_counter() - begin
+    logger.info('Warm up took %.2fs', elapsed, extra={'warm_up_seconds': elapsed})
+
+
+def start_warm_up(host='127.0.0.1', port=5000):
+    thread = threading.Thread(target=warm_up, args=(host, port), name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def production_plan():
+    '''
+    Plan of gyles to brew to meet the predicted sales, and the predicted
+    sales dataframe it is for
+    '''
+    _, df, _ = predictor().prediction_cache.get(sales_file, 'html', sales_chunk_size)
+    planner = g.site.production_planner
+    planner.set_demand(psim.demand_from_predicted_sales(df))
+    return planner.plan(), df
+
+
+def planned_tank(gyle, tank):
+    '''
+    Returns the tank the planner suggests for a gyle moving now when the
+    user asked for 'auto', otherwise the tank the user chose. The suggestion
+    is a tank that is free now, or None to take the best fitting free tank.
+    '''
+    if tank != 'auto':
+        return tank
+    return tp.plan_tank_assignment(g.site.state, immediate=gyle).suggest(gyle)
+
+
+@metrics.timed('brew_status')
+def brew_status(beer=None, stage=None, tank=None, page=None, page_size=BREW_STATUS_PAGE_SIZE,
+                state=None):
     '''
     Allows the user to view the brewing status of the currently brewing recipes
+
+    beer: only batches of this recipe
+    stage: only batches currently in this BREW_STAGE_xxx
+    tank: only the batch in this tank
+    page: 1 based page of page_size rows to return, all rows if None
+    state: Brewery_state to view, the request's site if None
     '''
+    start, count = 0, None
+    if page is not None:
+        start, count = (page - 1) * page_size, page_size
+
     view_brewing = []
-    for b in batches.values():
+    if state is None:
+        state = g.site.state
+    for gyle in state.find_gyles(beer, stage, tank, start, count):
+        b = state.batches[gyle]
         recipe = b.product.recipe
-        if beer is None or beer == recipe:
-            batch_number = b.gyle
-            stage = bh.brew_stage[b.current_brew_stage]
-            time = b.brew_stage[b.current_brew_stage].start_time.strftime("%Y-%m-%dT%H:%M")
-            if len(b.brew_tanks) > 0:
-                name = b.brew_tanks[0].name
-            else:
-                name = ''
-            row = '{} {} {} {} {}'.format(batch_number, stage, recipe, time, name)
-            view_brewing.append(row)
+        batch_number = b.gyle
+        stage_name = bh.brew_stage[b.current_brew_stage]
+        time = b.brew_stage[b.current_brew_stage].start_time.strftime("%Y-%m-%dT%H:%M")
+        if len(b.brew_tanks) > 0:
+            name = b.brew_tanks[0].name
+        else:
+            name = ''
+        row = '{} {} {} {} {}'.format(batch_number, stage_name, recipe, time, name)
+        view_brewing.append(row)
     return view_brewing
 
 
+def cached_response(render, sales=False):
+    '''
+    Returns the response of render() for this request, reusing the one
+    rendered at the current state version if there is one. Sets the ETag and
+    Last-Modified headers and answers conditional requests with a 304.
+
+    render: the route function that builds the response
+    sales: the response depends on the sales data, so is rendered again when
+           the sales file changes
+    '''
+    if request.method != 'GET':
+        return render()
+    if sales and sales_file:
+        try:
+            response_cache.check_source(predictor().source_signature(sales_file))
+        except OSError:
+            pass
+
+    key = request.full_path
+    entry = response_cache.get(key)
+    if entry is None:
+        version, etag, modified = response_cache.current()
+        response = app.make_response(render())
+        if response.status_code != 200 or response.is_streamed:
+            return response
+        response_cache.put(key, version, response.get_data(), response.mimetype, modified)
+    else:
+        body, mimetype, etag, modified = entry
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = modified
+    return response.make_conditional(request)
+
+
 @app.route('/', methods=['POST', 'GET'])
 def main_page():
     return render_template('home.html')
@@ -103,15 +283,42 @@ def main_page():
 
 @app.route('/salesprediction', methods=['POST', 'GET'])
 def sales_predicition():
-    sp.get_predicted_sales('Barnabys_sales_fabricated_data.csv', 'html')
-    return render_template('predicted_sales.html')
+    return cached_response(render_sales_prediction, sales=True)
+
+
+def render_sales_prediction():
+    # the prediction is cached until the sales file changes
+    _, _, html_str = predictor().prediction_cache.get(sales_file, 'html', sales_chunk_size)
+    return html_str
 
 
 @app.route('/viewbrewing', methods=['POST', 'GET'])
 def view_brewing():
-    brewing_list = brew_status()
+    return cached_response(render_view_brewing)
+
+
+def render_view_brewing():
+    # optional filters, e.g. /viewbrewing?recipe=Pilsner&stage=Fermentation&page=2
+    stage = request.args.get('stage')
+    if stage in bh.brew_stage:
+        stage = bh.brew_stage.index(stage)
+    elif stage is not None:
+        return user_error('Unknown brewing stage')
+    page = request.args.get('page', type=int)
+    page_size = request.args.get('page_size', BREW_STATUS_PAGE_SIZE, type=int)
+    if (page is not None and page < 1) or page_size < 1:
+        return user_error('Invalid page')
+    recipe = request.args.get('recipe')
+    tank = request.args.get('tank')
+    # read before the status, so the page's feed resumes from a change no
+    # later than the ones it shows
+    since = stage_feed.sequence
+    brewing_list = brew_status(recipe, stage, tank, page, page_size)
     if brewing_list is not None:
-        return render_template('brew_status.html', brew_status=brewing_list)
+        # the unfiltered view is kept up to date from the stage feed
+        live = recipe is None and stage is None and tank is None and page is None
+        return render_template('brew_status.html', brew_status=brewing_list, live=live,
+                               since=since)
     return render_template('viewbrewing.html')
 
 
@@ -120,7 +327,7 @@ def hot_brew():
     ''''
     Allows the user to input a new recipe into the hot brew stage
     '''
-    global batches
+    state = g.site.state
 
     query = request.args.get("home")
     if query is not None and query == 'hot_brew':
@@ -136,12 +343,11 @@ def hot_brew():
     # makes sure user inputs a valid gyle number
     if gyle is not None and \
        gyle != '' and \
-       gyle not in batches:
+       gyle not in state.batches:
         p = bh.Product(recipe, hot_brew_time=duration)
-        b = bh.Batch(gyle, p)
-        b.start_brew_stage(bh.BREW_STAGE_HOT_BREW, gyle, datetime.now(), duration)
-        batches[gyle] = b
-        return render_template('home.html')
+        # the gyle may have been taken by a concurrent request since the check
+        if state.new_batch(gyle, p, datetime.now(), duration) is not None:
+            return render_template('home.html')
     return user_error('Gyle Number Already in Use, Please Try Again')
 
 
@@ -150,12 +356,12 @@ def fermentation():
     ''''
     Allows the user to input a new recipe into the fermentation stage
     '''
-    global batches
+    state = g.site.state
     # import pdb;pdb.set_trace()
     query = request.args.get("home")
     if query is not None and query == 'fermentation':
         # makes a list of all the namesof the fermenting tanks
-        tank_pool = [x.name for x in brewery_tank_pool.tank_pool if x.fermenter == True]
+        tank_pool = [x.name for x in g.site.tank_pool.tank_pool if x.fermenter == True]
         datetime_now = datetime.now().strftime("%Y-%m-%dT%H:%M")
         return render_template('fermentation.html', tankpool=tank_pool, datetime_now=datetime_now)
 
@@ -167,19 +373,19 @@ def fermentation():
     # makes sure user inputs a valid gyle number
     if gyle is not None and \
        gyle != '' and \
-       gyle in batches:
-        b = batches[gyle]
-
-        if b.current_brew_stage != bh.BREW_STAGE_HOT_BREW:
+       gyle in state.batches:
+        result, b = state.transition(gyle,
+                                     bh.BREW_STAGE_HOT_BREW,
+                                     bh.BREW_STAGE_FERMENTATION,
+                                     datetime.now(),
+                                     duration,
+                                     tank_name=planned_tank(gyle, tank))
+        if result == bh.TRANSITION_WRONG_STAGE:
             return user_error('Batch first requires Hot Brew')
-
-        tank = brewery_tank_pool.get_free_tank(name=tank)
-        if tank is None:
+        if result == bh.TRANSITION_NO_TANK:
             return user_error('No free available fermentation tanks')
 
-        b.end_brew_stage(bh.BREW_STAGE_HOT_BREW, gyle, tank_pool=brewery_tank_pool)
         b.product.fermentation_duration = duration
-        b.start_brew_stage(bh.BREW_STAGE_FERMENTATION, gyle, datetime.now(), duration, tank)
         return render_template('home.html')
 
     return user_error('Batch not found')
@@ -190,12 +396,12 @@ def conditioning():
     ''''
     Allows the user to input a new recipe into the conditioning stage
     '''
-    global batches
+    state = g.site.state
 
     query = request.args.get("home")
     if query is not None and query == 'conditioning':
         # composed list of conditoner tank pool names
-        tank_pool = [x.name for x in brewery_tank_pool.tank_pool if x.conditioner == True]
+        tank_pool = [x.name for x in g.site.tank_pool.tank_pool if x.conditioner == True]
         datetime_now = datetime.now().strftime("%Y-%m-%dT%H:%M")
         return render_template('conditioning.html', tankpool=tank_pool, datetime_now=datetime_now)
 
@@ -208,19 +414,20 @@ def conditioning():
     # makes sure user inputs a valid gyle number
     if gyle is not None and \
        gyle != '' and \
-       gyle in batches:
-        b = batches[gyle]
-
-        if b.current_brew_stage != bh.BREW_STAGE_FERMENTATION:
+       gyle in state.batches:
+        result, b = state.transition(gyle,
+                                     bh.BREW_STAGE_FERMENTATION,
+                                     bh.BREW_STAGE_CONDITIONING,
+                                     datetime.now(),
+                                     duration,
+                                     tank_name=planned_tank(gyle, tank),
+                                     fermenter=False)
+        if result == bh.TRANSITION_WRONG_STAGE:
             return user_error('Batch requires fermentation')
-
-        tank = brewery_tank_pool.get_free_tank(name=tank)
-        if tank is None:
+        if result == bh.TRANSITION_NO_TANK:
             return user_error('No free available conditoning tanks')
 
-        b.end_brew_stage(bh.BREW_STAGE_FERMENTATION, gyle, tank_pool=brewery_tank_pool)
         b.product.conditioning_duration = duration
-        b.start_brew_stage(bh.BREW_STAGE_CONDITIONING, gyle, datetime.now(), duration, tank)
         return render_template('home.html')
 
     return user_error('Batch not found')
@@ -231,7 +438,7 @@ def bottling():
     ''''
     Allows the user to input a new recipe into the bottling stage
     '''
-    global batches
+    state = g.site.state
 
     query = request.args.get("home")
     if query is not None and query == 'bottling':
@@ -246,30 +453,276 @@ def bottling():
     # makes sure user inputs a valid gyle number
     if gyle is not None and \
        gyle != '' and \
-       gyle in batches:
-        b = batches[gyle]
-
-        if b.current_brew_stage != bh.BREW_STAGE_CONDITIONING:
+       gyle in state.batches:
+        result, b = state.transition(gyle,
+                                     bh.BREW_STAGE_CONDITIONING,
+                                     bh.BREW_STAGE_BOTTLING,
+                                     datetime.now(),
+                                     duration,
+                                     need_tank=False)
+        if result == bh.TRANSITION_WRONG_STAGE:
             return user_error('Batch requires conditioning')
 
-        b.end_brew_stage(bh.BREW_STAGE_CONDITIONING, gyle, brewery_tank_pool)
         b.product.bottling_duration = duration
-        b.start_brew_stage(bh.BREW_STAGE_BOTTLING, gyle, datetime.now(), duration)
         return render_template('home.html')
 
     return user_error('Batch not found')
 
 
+@app.route('/storage', methods=['POST', 'GET'])
+def storage():
+    ''''
+    Allows the user to move a bottled batch into storage, adding its bottles
+    and kegs to the stock
+    '''
+    query = request.args.get("home")
+    if query is not None and query == 'storage':
+        datetime_now = datetime.now().strftime("%Y-%m-%dT%H:%M")
+        return render_template('storage.html', datetime_now=datetime_now)
+
+    state = g.site.state
+    gyle = request.args.get('BatchNumber')
+    bottles = request.args.get('Bottles', 0, type=int)
+    kegs = request.args.get('Kegs', 0, type=int)
+
+    # makes sure user inputs a valid gyle number
+    if gyle is not None and \
+       gyle != '' and \
+       gyle in state.batches:
+        if bottles < 0 or kegs < 0 or bottles + kegs == 0:
+            return user_error('Enter the number of bottles and kegs')
+        result, b = inv.store_batch(state, g.site.inventory_ledger, gyle, bottles, kegs)
+        if result == bh.TRANSITION_WRONG_STAGE:
+            return user_error('Batch requires bottling')
+        return render_template('home.html')
+
+    return user_error('Batch not found')
+
+
+@app.route('/dispatch', methods=['POST', 'GET'])
+def dispatch():
+    ''''
+    Allows the user to dispatch an order from stock, oldest gyles first
+    '''
+    query = request.args.get("home")
+    if query is not None and query == 'dispatch':
+        return render_template('dispatch.html', stock=g.site.inventory_ledger.stock_levels())
+
+    order = {'order': request.args.get('Order'),
+             'recipe': request.args.get('Recipe'),
+             'package': request.args.get('Package'),
+             'units': request.args.get('Units', 0, type=int)}
+    result = inv.dispatch_orders(g.site.state, g.site.inventory_ledger, [order])[0]
+    if not result['ok']:
+        return user_error(result['error'])
+    return render_template('home.html')
+
+
+@app.route('/api/stock', methods=['GET'])
+def api_stock():
+    '''
+    Stock of every recipe and package, or of one recipe with ?recipe=
+    '''
+    ledger = g.site.inventory_ledger
+    recipe = request.args.get('recipe')
+    if recipe is not None:
+        return jsonify({'recipe': recipe,
+                        'units': ledger.stock_level(recipe),
+                        'packages': {package: ledger.stock_level(recipe, package)
+                                     for package in inv.PACKAGES}})
+    return jsonify(ledger.stock_levels())
+
+
+@app.route('/api/dispatch', methods=['POST'])
+def api_dispatch():
+    '''
+    Dispatches a JSON array of {order, recipe, package, units} orders in one
+    request, see inventory. Returns a result for each order.
+    '''
+    orders = request.get_json(silent=True)
+    if isinstance(orders, dict):
+        orders = orders.get('orders')
+    if not isinstance(orders, list):
+        return jsonify({'error': 'Expected a JSON array of orders'}), 400
+    return jsonify(inv.dispatch_orders(g.site.state, g.site.inventory_ledger, orders))
+
+
+@app.route('/productionplan', methods=['GET'])
+def production_plan_json():
+    return cached_response(render_production_plan, sales=True)
+
+
+def render_production_plan():
+    '''
+    Returns the dated schedule of gyles to brew to meet the predicted
+    sales, as JSON
+    '''
+    plan, _ = production_plan()
+    return jsonify(plan.as_dict())
+
+
+@app.route('/tankplan', methods=['GET'])
+def tank_plan():
+    '''
+    Returns the planned tank for every batch waiting for a fermenter or
+    conditioner, as JSON
+    '''
+    return jsonify(tp.plan_tank_assignment(g.site.state).as_dict())
+
+
+@app.route('/api/batches', methods=['GET'])
+def api_batches():
+    return cached_response(render_api_batches)
+
+
+def render_api_batches():
+    '''
+    Brewing status as JSON, with the same filters and paging as /viewbrewing
+    '''
+    stage = request.args.get('stage')
+    if stage is not None:
+        stage = api.parse_stage(stage)
+        if stage is None:
+            return jsonify({'error': 'Unknown stage'}), 400
+    page = request.args.get('page', type=int)
+    page_size = request.args.get('page_size', BREW_STATUS_PAGE_SIZE, type=int)
+    if (page is not None and page < 1) or page_size < 1:
+        return jsonify({'error': 'Invalid page'}), 400
+    start, count = 0, None
+    if page is not None:
+        start, count = (page - 1) * page_size, page_size
+    state = g.site.state
+    gyles = state.find_gyles(request.args.get('recipe'), stage,
+                             request.args.get('tank'), start, count)
+    return jsonify([api.batch_as_dict(state.batches[gyle]) for gyle in gyles])
+
+
+@app.route('/api/transitions', methods=['POST'])
+def api_transitions():
+    '''
+    Applies a JSON array of {gyle, stage, tank, duration} transitions in one
+    request, see brew_api. Returns a result for each transition.
+    '''
+    transitions = request.get_json(silent=True)
+    if isinstance(transitions, dict):
+        transitions = transitions.get('transitions')
+    if not isinstance(transitions, list):
+        return jsonify({'error': 'Expected a JSON array of transitions'}), 400
+    results = api.apply_transitions(g.site.state, transitions)
+    # volumes and durations are set after the stage events
+    response_cache.bump()
+    return jsonify(results)
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    '''
+    Server-sent event stream of the site's stage changes, see stage_feed.
+    Reconnecting browsers resume after the Last-Event-ID they were sent.
+    '''
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        since = None
+    # the stream outlives the request context, so is given the state
+    return Response(stage_feed.event_stream(since, state=g.site.state),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    '''
+    Long poll for the site's stage changes after the sequence number since.
+    Returns the latest sequence number and the deltas, an empty list on
+    timeout.
+    '''
+    since = request.args.get('since', stage_feed.sequence, type=int)
+    timeout = min(request.args.get('timeout', 25, type=float), LONG_POLL_TIMEOUT)
+    deltas = stage_feed.wait(since, timeout, g.site.state)
+    sequence = deltas[-1][0] if deltas else since
+    # the deltas are already JSON, so are joined rather than re-encoded
+    body = '{{"seq": {}, "deltas": [{}]}}'.format(sequence, ', '.join(d for _, d in deltas))
+    return Response(body, mimetype='application/json')
+
+
+@app.route('/api/forecast', methods=['GET'])
+def api_forecast():
+    return cached_response(render_api_forecast, sales=True)
+
+
+def render_api_forecast():
+    '''
+    Seasonal sales forecast as JSON, see sales_forecaster. Either one recipe
+    for one month, /api/forecast?recipe=Pilsner&month=2020-03, or a table of
+    every recipe for the next horizon months, /api/forecast?horizon=18
+    '''
+    model = forecaster().forecast_cache.get(sales_file, sales_chunk_size)
+    recipe = request.args.get('recipe')
+    month = request.args.get('month')
+    if recipe is not None and month is not None:
+        try:
+            month = datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return jsonify({'error': 'Month must be YYYY-MM'}), 400
+        recipe = predictor().PREDICTED_RECIPES.get(recipe, recipe)
+        if recipe not in model.recipes:
+            return jsonify({'error': 'Unknown recipe'}), 400
+        return jsonify({'recipe': recipe,
+                        'month': month.strftime('%Y-%m'),
+                        'quantity': model.forecast_month(recipe, month.year, month.month)})
+
+    horizon = request.args.get('horizon', 12, type=int)
+    if not 1 <= horizon <= 120:
+        return jsonify({'error': 'Invalid horizon'}), 400
+    table = model.table(horizon)
+    table['Month'] = table['Month'].dt.strftime('%Y-%m')
+    return jsonify(table.to_dict(orient='records'))
+
+
+@app.route('/api/sites', methods=['GET'])
+def api_sites():
+    '''
+    Batches per stage and recipe and free tanks of every site this process
+    owns, and their totals. Reads each site's published counts, so never
+    waits for a site's locks.
+    '''
+    return jsonify(brewery_sites.status())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    '''
+    Request and timing metrics in the Prometheus text format
+    '''
+    return Response(metrics.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/profile', methods=['GET'])
+def slow_request_profile():
+    '''
+    Collapsed stacks sampled from slow requests, empty unless the profiler
+    is enabled in config.json
+    '''
+    profiler = metrics.metrics.profiler
+    return Response(profiler.collapsed() if profiler is not None else '',
+                    mimetype='text/plain')
+
+
 @app.route('/recommendation', methods=['POST', 'GET'])
 def beer_recommendation():
+    return cached_response(render_beer_recommendation, sales=True)
+
+
+def render_beer_recommendation():
     '''
     User can see the algorithms recommended beer brewing suggestion based on
     sales prediciton for the month. It also displays which current other brewings
     are being produced so the user can decide if brewing another batch is
     necessary
     '''
-    global batches
-    sales_data, df, _ = sp.get_predicted_sales('Barnabys_sales_fabricated_data.csv', 'html')
+    sales_data, df, _ = predictor().prediction_cache.get(sales_file, 'html', sales_chunk_size)
     months = [d.date().strftime("%Y-%b") for d in df['Month']]
 
     query = request.args.get("home")
@@ -294,29 +747,59 @@ def beer_recommendation():
         red_helles = df['Red Helles'][m]
         total_quant = df['Total'][m]
 
-        # recommend beer recipe to brew
-        recommend = pilsner
-        recipe = 'Pilsner'
-        if dunkel > recommend:
-            recommend = dunkel
-            recipe = 'Dunkel'
-        if red_helles > recommend:
-            recommend = red_helles
-            recipe = 'Red Helles'
+        # recommend the next gyle the production plan has for the month,
+        # taking the tanks and the batches already brewing into account
+        plan, _ = production_plan()
+        planned = plan.for_month(df['Month'][m].to_pydatetime())
+        if planned:
+            recipe = planned[0].recipe
+        else:
+            # the month's demand is already being brewed
+            recommend = pilsner
+            recipe = 'Pilsner'
+            if dunkel > recommend:
+                recommend = dunkel
+                recipe = 'Dunkel'
+            if red_helles > recommend:
+                recommend = red_helles
+                recipe = 'Red Helles'
 
         brewing_list = brew_status(recipe)
+        planned_list = ['{} {} {}L start {} fermenter {} ready {}'.format(
+                            gyle.gyle, gyle.recipe, int(gyle.volume),
+                            gyle.hot_brew_start.strftime("%Y-%m-%dT%H:%M"), gyle.fermenter,
+                            gyle.ready_time.strftime("%Y-%m-%dT%H:%M"))
+                        if gyle.scheduled else
+                        '{} {} {}L no conditioner holds it'.format(
+                            gyle.gyle, gyle.recipe, int(gyle.volume))
+                        for gyle in planned]
         return render_template('recommendation_beer.html',
                                months=months,
                                recommend=recipe,
-                               brew_status=brewing_list
+                               brew_status=brewing_list,
+                               production_plan=planned_list
                                )
 
     return redirect('/')
 
 
 def init_brewery():
-    global brewery_tank_pool
-    brewery_tank_pool = bh.init_brew_tank_pool('barnabys')
+    global brewery_sites
+    brewery_sites.close()
+    # only the sites this worker owns, see brewery_sites
+    brewery_sites = bsite.load_sites(config_dict.get('sites'))
+
+    # push stage changes to the floor displays
+    stage_feed.stop()
+    stage_feed.start()
+    # pages are rendered again once any batch changes
+    response_cache.stop()
+    response_cache.start()
+    response_cache.bump()
+
+    # restore each site's batches, log every change from now on and plan
+    # their production
+    brewery_sites.open(config_dict.get('persistence'))
 
 
 def load_config(filename):
@@ -337,18 +820,36 @@ if __name__ == '__main__':
     # Load config
     config_dict = load_config(config_file)
 
-    # Initialize logger
-    log_file = config_dict['logging']['log_file']
-    log_level = int(config_dict['logging']['log_level'])
-    handler = RotatingFileHandler(log_file,
-                                  maxBytes=100000,
-                                  backupCount=3)
+    # Initialize logger, records are queued and written by a background thread
     logger = logging.getLogger(__name__)
-    logger.setLevel(log_level)
-    logger.addHandler(handler)
+    log_writer = lw.init_logging(logger, config_dict['logging'])
+    atexit.register(log_writer.stop)
+
+    # Sales data source, streamed in chunks when a chunk size is configured
+    sales_file = config_dict['sales']['sales_file']
+    sales_chunk_size = int(config_dict['sales']['chunk_size'])
 
     # start brewery
     init_brewery()
 
+    # sample the stacks of slow requests, 0 disables the profiler
+    profile_slow_ms = int(config_dict['metrics']['profile_slow_ms'])
+    if profile_slow_ms > 0:
+        profiler = metrics.Slow_request_profiler(metrics.metrics,
+                                                 profile_slow_ms / 1000,
+                                                 int(config_dict['metrics']['profile_interval_ms']) / 1000)
+        profiler.start()
+
+    # advance batches automatically as their stages complete, off by default
+    # as it moves batches without an operator
+    if int(config_dict['scheduler']['auto_advance']):
+        brewery_sites.start_schedulers()
+
+    # load pandas and the sales prediction once the server is listening, in
+    # the reloader's child process when debugging as that is the server
+    debug = True
+    if int(config_dict['sales']['warm_up']) and (not debug or is_running_from_reloader()):
+        start_warm_up()
+
     # Start up flask framework
-    app.run(debug=True, threaded=True)
+    app.run(debug=debug, threaded=True)
@@ -0,0 +1,455 @@
+'''Inventory
+
+Finished goods ledger for the batches that go into storage after bottling.
+Each batch in storage is a lot of bottles and/or kegs. Orders are dispatched
+from the lots of their recipe and package in first-in first-out order by
+gyle. Once every unit of a gyle has been dispatched, the batch moves to the
+dispatch stage.
+
+Stock levels are running totals per recipe and package, updated with each
+receipt and dispatch, so stock queries cost O(1) however many units have
+been dispatched. A dispatch only touches the lots it empties plus one.
+
+A ledger opened on a file appends each receipt and dispatch to it before
+returning, and replays it on start up. restock then squares the ledger with
+the recovered batches, finishing any store or dispatch cut short before its
+stage change was logged, and compacts the file down to the lots in stock.
+Only the latest entries of the journal are kept in memory.
+'''
+from collections import deque
+from datetime import datetime
+import json
+import os
+import threading
+import brewery as bh
+
+# Package types
+PACKAGE_BOTTLE = 'bottle'
+PACKAGE_KEG = 'keg'
+PACKAGES = (PACKAGE_BOTTLE, PACKAGE_KEG)
+
+# Ledger entry kinds
+LEDGER_RECEIPT = 'receipt'
+LEDGER_DISPATCH = 'dispatch'
+
+# Ledger file in a site's persistence directory
+LEDGER_FILE = 'ledger.log'
+
+# Most recent journal entries kept in memory
+JOURNAL_LENGTH = 10000
+
+
+class Inventory_ledger:
+    '''
+    Stock of each recipe and package, the lots it is made of and a journal
+    of every receipt and dispatch
+    '''
+    def __init__(self, journal_length=JOURNAL_LENGTH):
+        # (recipe, package) -> units in stock
+        self.stock = {}
+        # recipe -> units in stock over all packages
+        self.recipe_stock = {}
+        # (recipe, package) -> deque of [gyle, units left], oldest first
+        self.lots = {}
+        # gyle -> units left over all its lots
+        self.gyle_stock = {}
+        # gyle -> (recipe, package -> units) of every gyle received
+        self.received = {}
+        # latest (time, kind, gyle or order, recipe, package, units)
+        self.journal = deque(maxlen=journal_length)
+        self.path = None
+        self._file = None
+        self._lock = threading.Lock()
+        return
+
+    def open(self, path):
+        '''
+        Replays the ledger file, then appends every change to it
+        '''
+        with self._lock:
+            self.path = path
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # torn write at the end of the file
+                            break
+                        self._replay(entry)
+            self._file = open(path, 'a')
+        return
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        return
+
+    def _replay(self, entry):
+        kind, time = entry[0], datetime.fromisoformat(entry[1])
+        if kind == LEDGER_RECEIPT:
+            self._receive(entry[2], entry[3], entry[4], time)
+        else:
+            self._dispatch(entry[2], time)
+        return
+
+    def _write(self, entry):
+        '''
+        Appends an entry to the ledger file, the caller holds the lock
+        '''
+        if self._file is not None:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        return
+
+    def compact(self):
+        '''
+        Rewrites the ledger file as one receipt per gyle in stock
+        '''
+        with self._lock:
+            if self.path is None:
+                return
+            gyles = {}
+            for (recipe, package), lots in self.lots.items():
+                for gyle, left in lots:
+                    gyles.setdefault(gyle, (recipe, {}))[1][package] = left
+            now = datetime.now().isoformat()
+            with open(self.path + '.tmp', 'w') as f:
+                for gyle, (recipe, units) in gyles.items():
+                    f.write(json.dumps([LEDGER_RECEIPT, now, gyle, recipe, units]) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if self._file is not None:
+                self._file.close()
+            os.replace(self.path + '.tmp', self.path)
+            self._file = open(self.path, 'a')
+        return
+
+    def stock_level(self, recipe, package=None):
+        '''
+        Units of a recipe in stock, of one package or all of them. O(1).
+        '''
+        if package is None:
+            return self.recipe_stock.get(recipe, 0)
+        return self.stock.get((recipe, package), 0)
+
+    def receive(self, gyle, recipe, units, time=None):
+        '''
+        Adds the lots of a gyle to the stock.
+
+        units: package -> units, e.g. {'bottle': 2000, 'keg': 10}
+        '''
+        time = time or datetime.now()
+        with self._lock:
+            self._write([LEDGER_RECEIPT, time.isoformat(), gyle, recipe, units])
+            self._receive(gyle, recipe, units, time)
+        return
+
+    def _receive(self, gyle, recipe, units, time):
+        self.received[gyle] = (recipe, dict(units))
+        for package, count in units.items():
+            if count <= 0:
+                continue
+            key = (recipe, package)
+            self.lots.setdefault(key, deque()).append([gyle, count])
+            self.stock[key] = self.stock.get(key, 0) + count
+            self.recipe_stock[recipe] = self.recipe_stock.get(recipe, 0) + count
+            self.gyle_stock[gyle] = self.gyle_stock.get(gyle, 0) + count
+            self.journal.append((time, LEDGER_RECEIPT, gyle, recipe, package, count))
+        return
+
+    def dispatch(self, orders, time=None):
+        '''
+        Allocates a list of orders against the stock, oldest lots first. An
+        order that can not be met in full is rejected and allocates nothing.
+
+        orders: list of dicts of order, recipe, package and units
+
+        Returns (results, emptied gyles). Each result holds the order, 'ok'
+        and either the allocations as (gyle, units) pairs or an error.
+        '''
+        time = time or datetime.now()
+        with self._lock:
+            results, emptied = self._dispatch(orders, time)
+            met = [order for order, result in zip(orders, results) if result['ok']]
+            if met:
+                self._write([LEDGER_DISPATCH, time.isoformat(),
+                             [{key: order[key] for key in ('order', 'recipe', 'package', 'units')}
+                              for order in met]])
+        return results, emptied
+
+    def _dispatch(self, orders, time):
+        # allocate every order before changing anything, so an order that
+        # fails leaves the ledger as it was
+        results = []
+        allocated = []
+        # (recipe, package) -> [lot being taken from, units left in it, units taken]
+        cursors = {}
+        for order in orders:
+            key = (order['recipe'], order['package'])
+            units = order['units']
+            cursor = cursors.get(key)
+            available = self.stock.get(key, 0)
+            if cursor is not None:
+                available -= cursor[2]
+            if available < units:
+                results.append({'order': order['order'], 'ok': False,
+                                'error': 'Insufficient stock'})
+                continue
+
+            lots = self.lots[key]
+            if cursor is None:
+                cursor = cursors[key] = [0, lots[0][1], 0]
+            allocations = []
+            left = units
+            while left > 0:
+                if cursor[1] == 0:
+                    cursor[0] += 1
+                    cursor[1] = lots[cursor[0]][1]
+                taken = min(left, cursor[1])
+                cursor[1] -= taken
+                cursor[2] += taken
+                left -= taken
+                allocations.append((lots[cursor[0]][0], taken))
+            allocated.append((order, key, allocations))
+            results.append({'order': order['order'], 'ok': True, 'allocations': allocations})
+
+        emptied = []
+        for order, key, allocations in allocated:
+            lots = self.lots[key]
+            for gyle, taken in allocations:
+                lot = lots[0]
+                lot[1] -= taken
+                self.journal.append((time, LEDGER_DISPATCH, order['order'], key[0], key[1], taken))
+                self.gyle_stock[gyle] -= taken
+                if lot[1] == 0:
+                    lots.popleft()
+                    if self.gyle_stock[gyle] == 0:
+                        del self.gyle_stock[gyle]
+                        emptied.append(gyle)
+            self.stock[key] -= order['units']
+            self.recipe_stock[key[0]] -= order['units']
+        return results, emptied
+
+    def stock_levels(self):
+        '''
+        Returns a list of {recipe, package, units} for everything in stock
+        '''
+        with self._lock:
+            return [{'recipe': recipe, 'package': package, 'units': units}
+                    for (recipe, package), units in sorted(self.stock.items()) if units]
+
+def validate_order(order):
+    '''
+    Returns an error message for a malformed order, None if it is valid
+    '''
+    if not isinstance(order, dict):
+        return 'Order must be an object'
+    number = order.get('order')
+    if not isinstance(number, (str, int)) or isinstance(number, bool) or str(number) == '':
+        return 'Missing order'
+    recipe = order.get('recipe')
+    if not isinstance(recipe, str) or recipe == '':
+        return 'Missing recipe'
+    if order.get('package') not in PACKAGES:
+        return 'Package must be one of ' + ', '.join(PACKAGES)
+    units = order.get('units')
+    if not isinstance(units, int) or isinstance(units, bool) or units <= 0:
+        return 'Units must be a positive whole number'
+    return None
+
+def store_batch(state, ledger, gyle, bottles, kegs, start=None):
+    '''
+    Moves a bottled batch into storage and adds its bottles and kegs to the
+    stock. Returns (TRANSITION_xxx result, batch).
+    '''
+    start = start or datetime.now()
+
+    def stock(b):
+        # part of the transition, so the listeners that log storage see the
+        # bottles and kegs and the stock is never ahead of the stage
+        record = b.brew_stage[bh.BREW_STAGE_BOTTLING]
+        record.bottles = bottles
+        record.kegs = kegs
+        ledger.receive(gyle, b.product.recipe, {PACKAGE_BOTTLE: bottles, PACKAGE_KEG: kegs}, start)
+
+    return state.transition(gyle, bh.BREW_STAGE_BOTTLING, bh.BREW_STAGE_STORAGE, start, 0,
+                            need_tank=False, update=stock)
+
+def restock(state, ledger, time=None):
+    '''
+    Squares a replayed ledger with the recovered batches. A receipt logged
+    before its storage stage finishes the store, a stored batch the ledger
+    never received is received from its bottling record, and a stored gyle
+    dispatched in full moves to the dispatch stage. The ledger file is then
+    compacted.
+    '''
+    time = time or datetime.now()
+    for gyle, b in list(state.batches.items()):
+        stage = b.current_brew_stage
+        if stage == bh.BREW_STAGE_BOTTLING and gyle in ledger.received:
+            units = ledger.received[gyle][1]
+
+            def stored(b, units=units):
+                record = b.brew_stage[bh.BREW_STAGE_BOTTLING]
+                record.bottles = units.get(PACKAGE_BOTTLE, 0)
+                record.kegs = units.get(PACKAGE_KEG, 0)
+
+            state.transition(gyle, bh.BREW_STAGE_BOTTLING, bh.BREW_STAGE_STORAGE, time, 0,
+                             need_tank=False, update=stored)
+        elif stage == bh.BREW_STAGE_STORAGE and gyle not in ledger.received:
+            record = b.brew_stage[bh.BREW_STAGE_BOTTLING]
+            ledger.receive(gyle, b.product.recipe,
+                           {PACKAGE_BOTTLE: record.bottles, PACKAGE_KEG: record.kegs}, time)
+        if (b.current_brew_stage == bh.BREW_STAGE_STORAGE and gyle in ledger.received
+                and not ledger.gyle_stock.get(gyle)):
+            state.transition(gyle, bh.BREW_STAGE_STORAGE, bh.BREW_STAGE_DISPACTH, time, 0,
+                             need_tank=False)
+    ledger.compact()
+    return
+
+def dispatch_orders(state, ledger, orders, time=None):
+    '''
+    Validates and dispatches a list of orders, moving every gyle that has
+    been dispatched in full to the dispatch stage. Returns a result for each
+    order.
+    '''
+    time = time or datetime.now()
+    results = [None] * len(orders)
+    valid = []
+    for i, order in enumerate(orders):
+        error = validate_order(order)
+        if error is not None:
+            results[i] = {'order': order.get('order') if isinstance(order, dict) else None,
+                          'ok': False, 'error': error}
+        else:
+            valid.append(i)
+    dispatched, emptied = ledger.dispatch([orders[i] for i in valid], time)
+    for i, result in zip(valid, dispatched):
+        results[i] = result
+    for gyle in emptied:
+        state.transition(gyle, bh.BREW_STAGE_STORAGE, bh.BREW_STAGE_DISPACTH, time, 0,
+                         need_tank=False)
+    return results
+
+def test_inventory():
+    '''
+    Unit test
+    '''
+    import time as timer
+    now = datetime(2020, 1, 1)
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    ledger = Inventory_ledger()
+    for gyle in ('1', '2'):
+        state.new_batch(gyle, bh.Product('Pilsner'), now, 3)
+        state.transition(gyle, bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_BOTTLING, now, 3,
+                         need_tank=False)
+    assert store_batch(state, ledger, '1', 100, 2)[0] == bh.TRANSITION_OK
+    assert store_batch(state, ledger, '2', 50, 0)[0] == bh.TRANSITION_OK
+    assert store_batch(state, ledger, '9', 50, 0)[0] == bh.TRANSITION_NO_BATCH
+    assert state.batches['1'].brew_stage[bh.BREW_STAGE_BOTTLING].bottles == 100
+    assert ledger.stock_level('Pilsner') == 152
+    assert ledger.stock_level('Pilsner', PACKAGE_BOTTLE) == 150
+
+    results = dispatch_orders(state, ledger, [
+        {'order': 'A', 'recipe': 'Pilsner', 'package': 'bottle', 'units': 120},
+        {'order': 'B', 'recipe': 'Pilsner', 'package': 'bottle', 'units': 40},
+        {'order': 'C', 'recipe': 'Pilsner', 'package': 'keg', 'units': 2},
+        {'order': 'D', 'recipe': 'Pilsner', 'package': 'crate', 'units': 1}])
+    # oldest gyle first
+    assert results[0]['allocations'] == [('1', 100), ('2', 20)]
+    assert results[1]['error'] == 'Insufficient stock'
+    assert results[2]['allocations'] == [('1', 2)]
+    assert not results[3]['ok']
+    assert ledger.stock_level('Pilsner', PACKAGE_BOTTLE) == 30
+    assert state.batches['1'].current_brew_stage == bh.BREW_STAGE_DISPACTH
+    assert state.batches['2'].current_brew_stage == bh.BREW_STAGE_STORAGE
+
+    # malformed orders are rejected and the rest are dispatched
+    results = dispatch_orders(state, ledger, [
+        {'recipe': 'Pilsner', 'package': 'bottle', 'units': 10},
+        {'order': 'E', 'recipe': ['Pilsner'], 'package': 'bottle', 'units': 10},
+        {'order': 'F', 'recipe': 'Pilsner', 'package': 'bottle', 'units': 10}])
+    assert [r['error'] for r in results[:2]] == ['Missing order', 'Missing recipe']
+    assert results[2]['ok'] and ledger.stock_level('Pilsner', PACKAGE_BOTTLE) == 20
+    # an order that fails part way leaves the ledger untouched
+    try:
+        ledger.dispatch([{'order': 'G', 'recipe': 'Pilsner', 'package': 'bottle', 'units': 20},
+                         {'recipe': 'Pilsner', 'package': 'bottle', 'units': 1}])
+        assert False
+    except KeyError:
+        pass
+    assert ledger.stock_level('Pilsner', PACKAGE_BOTTLE) == 20 and ledger.gyle_stock == {'2': 20}
+
+    # stock queries do not slow down as dispatches grow
+    ledger = Inventory_ledger()
+    for gyle in range(1000):
+        ledger.receive(str(gyle), 'Dunkel', {PACKAGE_BOTTLE: 10000})
+    orders = [{'order': str(i), 'recipe': 'Dunkel', 'package': 'bottle', 'units': 100}
+              for i in range(50000)]
+    begin = timer.perf_counter()
+    results, emptied = ledger.dispatch(orders)
+    assert timer.perf_counter() - begin < 2.0
+    assert all(r['ok'] for r in results) and len(emptied) == 500
+    begin = timer.perf_counter()
+    for _ in range(10000):
+        ledger.stock_level('Dunkel', PACKAGE_BOTTLE)
+    assert timer.perf_counter() - begin < 0.1
+    assert ledger.stock_level('Dunkel') == 5000000
+    # only the latest journal entries are kept
+    assert len(ledger.journal) == JOURNAL_LENGTH
+
+    # the ledger file replays the stock, and restock squares it with the
+    # recovered batches
+    import tempfile
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, LEDGER_FILE)
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    ledger = Inventory_ledger()
+    ledger.open(path)
+    for gyle in ('1', '2', '3', '4'):
+        state.new_batch(gyle, bh.Product('Pilsner'), now, 3)
+        state.transition(gyle, bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_BOTTLING, now, 3,
+                         need_tank=False)
+    store_batch(state, ledger, '1', 100, 0)
+    store_batch(state, ledger, '2', 50, 1)
+    dispatch_orders(state, ledger, [{'order': 'A', 'recipe': 'Pilsner', 'package': 'bottle',
+                                     'units': 120}])
+    # gyle 3 stored without its receipt, gyle 4 received without its stage
+    # change, gyle 2 emptied without its stage change
+    state.transition('3', bh.BREW_STAGE_BOTTLING, bh.BREW_STAGE_STORAGE, now, 0,
+                     need_tank=False, update=lambda b: setattr(b.brew_stage[bh.BREW_STAGE_BOTTLING],
+                                                               'bottles', 70))
+    ledger.receive('4', 'Pilsner', {PACKAGE_BOTTLE: 40, PACKAGE_KEG: 3})
+    ledger.dispatch([{'order': 'B', 'recipe': 'Pilsner', 'package': 'bottle', 'units': 30},
+                     {'order': 'C', 'recipe': 'Pilsner', 'package': 'keg', 'units': 1}])
+    ledger.close()
+    with open(path, 'a') as f:
+        f.write('["receipt", "2020')
+
+    recovered = Inventory_ledger()
+    recovered.open(path)
+    assert recovered.stock == ledger.stock and recovered.gyle_stock == ledger.gyle_stock
+    restock(state, recovered)
+    assert state.batches['1'].current_brew_stage == bh.BREW_STAGE_DISPACTH
+    assert state.batches['2'].current_brew_stage == bh.BREW_STAGE_DISPACTH
+    assert state.batches['3'].current_brew_stage == bh.BREW_STAGE_STORAGE
+    assert state.batches['4'].current_brew_stage == bh.BREW_STAGE_STORAGE
+    assert state.batches['4'].brew_stage[bh.BREW_STAGE_BOTTLING].kegs == 3
+    assert recovered.stock_level('Pilsner', PACKAGE_BOTTLE) == 110
+    recovered.close()
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+    compacted = Inventory_ledger()
+    compacted.open(path)
+    assert compacted.stock == recovered.stock
+    compacted.close()
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_inventory()
@@ -0,0 +1,247 @@
+'''Log Writer
+
+Moves log output off the request threads. Loggers hand their records to a
+bounded queue through a Drop_queue_handler, which never waits on the disk.
+A background Batch_log_writer drains the queue, formats the records as JSON
+lines and writes whatever has queued up with a single write and flush,
+rotating the file when it grows past its size limit.
+
+When the queue is full the 'drop' policy drops the new record, while
+'block' makes the logging thread wait up to a timeout for space before
+dropping it. Dropped records are counted and reported in the log.
+'''
+from datetime import datetime
+import json
+import logging
+from logging.handlers import QueueHandler
+import os
+import queue
+import threading
+
+# Queue full policies
+QUEUE_FULL_DROP = 'drop'
+QUEUE_FULL_BLOCK = 'block'
+
+# Attributes every LogRecord has, anything else was passed in extra
+_record_attributes = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | \
+                     {'message', 'asctime'}
+
+
+class Json_formatter(logging.Formatter):
+    '''
+    Formats a record as one JSON object holding its time, level, logger,
+    message and any fields passed with extra
+    '''
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()
+                }
+        for key, value in record.__dict__.items():
+            if key not in _record_attributes:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class Drop_queue_handler(QueueHandler):
+    '''
+    Queue handler that applies a policy instead of blocking forever when
+    the queue is full
+
+    log_queue: bounded queue.Queue read by a Batch_log_writer
+    policy: QUEUE_FULL_DROP or QUEUE_FULL_BLOCK
+    block_timeout: seconds QUEUE_FULL_BLOCK waits for space
+    '''
+    def __init__(self, log_queue, policy=QUEUE_FULL_DROP, block_timeout=0.1):
+        super().__init__(log_queue)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        return
+
+    def enqueue(self, record):
+        try:
+            if self.policy == QUEUE_FULL_BLOCK:
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+        return
+
+    def take_dropped(self):
+        '''
+        Returns the number of records dropped since the last call
+        '''
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+class Batch_log_writer:
+    '''
+    Background thread writing queued records to a rotating JSON lines file
+
+    log_queue: queue filled by a Drop_queue_handler
+    filename: log file
+    max_bytes: size at which the file is rotated, 0 never rotates
+    backup_count: rotated files kept as filename.1 .. filename.n
+    batch_size: most records written with one write
+    '''
+    def __init__(self, log_queue, filename, max_bytes=10000000, backup_count=5, batch_size=256):
+        self.queue = log_queue
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.formatter = Json_formatter()
+        self.handler = None
+        self.batches_written = 0
+        self._stop = object()
+        self._stream = None
+        self._thread = None
+        return
+
+    def start(self):
+        self._stream = open(self.filename, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self):
+        '''
+        Writes out the records queued so far and stops the thread
+        '''
+        if self._thread is not None:
+            self.queue.put(self._stop)
+            self._thread.join()
+            self._thread = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        return
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # take whatever else has queued up, without waiting for more
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._stop in batch
+            self.write([r for r in batch if r is not self._stop])
+            if stop:
+                return
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                # a record that can not be formatted must not stop the writer
+                continue
+        dropped = self.handler.take_dropped() if self.handler is not None else 0
+        if dropped:
+            lines.append(json.dumps({'time': datetime.now().isoformat(timespec='milliseconds'),
+                                     'level': 'WARNING',
+                                     'logger': __name__,
+                                     'message': 'log queue full, {} records dropped'.format(dropped),
+                                     'dropped': dropped}))
+        if not lines:
+            return
+        self._stream.write('\n'.join(lines) + '\n')
+        self._stream.flush()
+        self.batches_written += 1
+        if self.max_bytes and self._stream.tell() >= self.max_bytes:
+            self.rotate()
+        return
+
+    def rotate(self):
+        '''
+        Renames filename.n-1 .. filename to filename.n .. filename.1 and
+        starts a new file
+        '''
+        self._stream.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = '{}.{}'.format(self.filename, i)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.filename, i + 1))
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self._stream = open(self.filename, 'a', encoding='utf-8')
+        return
+
+def init_logging(logger, config):
+    '''
+    Connects logger to a queue and starts a writer for it.
+
+    config: the 'logging' section of config.json
+
+    Returns the Batch_log_writer, stop it to flush the log at exit
+    '''
+    log_queue = queue.Queue(int(config.get('queue_size', 10000)))
+    handler = Drop_queue_handler(log_queue,
+                                 config.get('queue_full', QUEUE_FULL_DROP),
+                                 int(config.get('block_timeout_ms', 100)) / 1000)
+    writer = Batch_log_writer(log_queue,
+                              config['log_file'],
+                              int(config.get('max_bytes', 10000000)),
+                              int(config.get('backup_count', 5)),
+                              int(config.get('batch_size', 256)))
+    writer.handler = handler
+    writer.start()
+    logger.setLevel(int(config['log_level']))
+    logger.addHandler(handler)
+    return writer
+
+def test_log_writer(filename='log_writer_test.log'):
+    '''
+    Unit test
+    '''
+    import glob
+    for f in glob.glob(filename + '*'):
+        os.remove(f)
+    logger = logging.getLogger('log_writer_test')
+    logger.propagate = False
+    writer = init_logging(logger, {'log_file': filename, 'log_level': '20',
+                                   'max_bytes': '2000', 'backup_count': '2', 'batch_size': '10'})
+    try:
+        for i in range(100):
+            logger.info('request %d', i, extra={'path': '/viewbrewing', 'status': 200})
+        logger.debug('not logged')
+    finally:
+        writer.stop()
+        logger.handlers = []
+
+    # rotated, with older files dropped beyond backup_count
+    assert os.path.exists(filename + '.1') and os.path.exists(filename + '.2')
+    assert not os.path.exists(filename + '.3')
+    lines = []
+    for name in (filename + '.1', filename):
+        with open(name) as f:
+            lines += [json.loads(line) for line in f]
+    last = lines[-1]
+    assert last['message'] == 'request 99' and last['path'] == '/viewbrewing'
+    assert last['level'] == 'INFO' and last['status'] == 200
+
+    # a full queue drops rather than blocking the caller
+    handler = Drop_queue_handler(queue.Queue(1))
+    handler.handle(logging.LogRecord('x', logging.INFO, '', 0, 'a', None, None))
+    handler.handle(logging.LogRecord('x', logging.INFO, '', 0, 'b', None, None))
+    assert handler.take_dropped() == 1 and handler.dropped == 0
+    for f in glob.glob(filename + '*'):
+        os.remove(f)
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_log_writer()
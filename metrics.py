@@ -0,0 +1,297 @@
+'''Metrics
+
+Request and timing metrics for the brewhouse in the Prometheus text format:
+per-route latency histograms, request counters, in-flight gauges and timing
+spans around the expensive functions.
+
+An opt-in sampling profiler watches requests that run longer than a
+threshold and samples their thread's stack, so the stacks where slow
+requests spend their time can be read from /metrics/profile in the collapsed
+format used by flame graph tools.
+'''
+import bisect
+from collections import Counter
+import functools
+import os
+import sys
+import threading
+import time
+
+# Latency histogram upper bounds in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''
+    Distribution of observed values over fixed buckets
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        return
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        return
+
+    def cumulative(self):
+        '''
+        Returns (upper bound, count of values <= bound) pairs, ending with
+        ('+Inf', count)
+        '''
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+def label_string(labels):
+    '''
+    Formats (name, value) label pairs as {name="value",...}
+    '''
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, v in labels)
+    return '{' + ','.join('{}="{}"'.format(k, v) for (k, _), v in zip(labels, escaped)) + '}'
+
+class Metrics:
+    '''
+    Registry of the brewhouse metrics
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # route -> Histogram of request seconds
+        self.request_latency = {}
+        # (route, method, status) -> requests
+        self.request_count = Counter()
+        # route -> requests being served
+        self.in_flight = Counter()
+        # span name -> Histogram of seconds
+        self.span_latency = {}
+        # thread id -> (route, start time) of the requests being served
+        self.active_requests = {}
+        self.profiler = None
+        self._lock = threading.Lock()
+        return
+
+    def request_started(self, route):
+        '''
+        Counts a request in flight. Returns its start time.
+        '''
+        start = time.perf_counter()
+        with self._lock:
+            self.in_flight[route] += 1
+            self.active_requests[threading.get_ident()] = (route, start)
+        return start
+
+    def request_finished(self, route, method, status, start):
+        '''
+        Records the latency and status of a request started by request_started
+        '''
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            histogram = self.request_latency.get(route)
+            if histogram is None:
+                histogram = self.request_latency[route] = Histogram(self.buckets)
+            histogram.observe(elapsed)
+            self.request_count[(route, method, str(status))] += 1
+        return elapsed
+
+    def request_ended(self, route):
+        '''
+        Removes a request from the in-flight gauge, whether or not it
+        completed
+        '''
+        with self._lock:
+            self.in_flight[route] -= 1
+            self.active_requests.pop(threading.get_ident(), None)
+        return
+
+    def observe_span(self, name, seconds):
+        with self._lock:
+            histogram = self.span_latency.get(name)
+            if histogram is None:
+                histogram = self.span_latency[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        return
+
+    def timed(self, name):
+        '''
+        Decorator recording each call of a function as a timing span
+        '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe_span(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def render(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format
+        '''
+        with self._lock:
+            lines = []
+            self._render_histograms(lines, 'brewhouse_request_duration_seconds',
+                                    'Request latency by route', 'route', self.request_latency)
+            lines += ['# HELP brewhouse_requests_total Requests served',
+                      '# TYPE brewhouse_requests_total counter']
+            for (route, method, status), count in sorted(self.request_count.items()):
+                lines.append('brewhouse_requests_total{} {}'.format(
+                    label_string((('route', route), ('method', method), ('status', status))),
+                    count))
+            lines += ['# HELP brewhouse_requests_in_flight Requests being served',
+                      '# TYPE brewhouse_requests_in_flight gauge']
+            for route, count in sorted(self.in_flight.items()):
+                lines.append('brewhouse_requests_in_flight{} {}'.format(
+                    label_string((('route', route),)), count))
+            self._render_histograms(lines, 'brewhouse_span_duration_seconds',
+                                    'Time spent in instrumented functions', 'span',
+                                    self.span_latency)
+        return '\n'.join(lines) + '\n'
+
+    def _render_histograms(self, lines, name, help_text, label, histograms):
+        lines += ['# HELP {} {}'.format(name, help_text),
+                  '# TYPE {} histogram'.format(name)]
+        for key, histogram in sorted(histograms.items()):
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(
+                    name, label_string(((label, key), ('le', bound))), count))
+            labels = label_string(((label, key),))
+            lines.append('{}_sum{} {}'.format(name, labels, histogram.sum))
+            lines.append('{}_count{} {}'.format(name, labels, histogram.count))
+        return
+
+class Slow_request_profiler:
+    '''
+    Samples the stacks of requests that have been running longer than
+    threshold seconds, every interval seconds. Stacks are counted in the
+    collapsed format 'route;module:function;...'.
+    '''
+    def __init__(self, metrics, threshold=0.5, interval=0.01, max_depth=64):
+        self.metrics = metrics
+        self.threshold = threshold
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        return
+
+    def start(self):
+        self.metrics.profiler = self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='slow-request-profiler',
+                                        daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        '''
+        Takes one sample of every slow request. Returns the number sampled.
+        '''
+        now = time.perf_counter()
+        with self.metrics._lock:
+            slow = [(ident, route) for ident, (route, start) in self.metrics.active_requests.items()
+                    if now - start >= self.threshold]
+        if not slow:
+            return 0
+        frames = sys._current_frames()
+        sampled = 0
+        for ident, route in slow:
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.samples[';'.join([route] + stack[::-1])] += 1
+            sampled += 1
+        return sampled
+
+    def collapsed(self):
+        '''
+        Returns the samples as collapsed stack lines, most frequent first
+        '''
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.samples.most_common())
+
+
+# Metrics of this process
+metrics = Metrics()
+timed = metrics.timed
+
+
+def test_metrics():
+    '''
+    Unit test
+    '''
+    m = Metrics(buckets=(0.01, 0.1))
+    start = m.request_started('/viewbrewing')
+    assert m.in_flight['/viewbrewing'] == 1
+    m.request_finished('/viewbrewing', 'GET', 200, start)
+    m.request_ended('/viewbrewing')
+    assert m.in_flight['/viewbrewing'] == 0
+
+    @m.timed('work')
+    def work(seconds):
+        time.sleep(seconds)
+        return seconds
+    assert work(0.02) == 0.02
+    assert m.span_latency['work'].counts == [0, 1, 0]
+
+    text = m.render()
+    assert 'brewhouse_requests_total{route="/viewbrewing",method="GET",status="200"} 1' in text
+    assert 'brewhouse_request_duration_seconds_bucket{route="/viewbrewing",le="+Inf"} 1' in text
+    assert 'brewhouse_span_duration_seconds_bucket{span="work",le="0.01"} 0' in text
+    assert 'brewhouse_span_duration_seconds_bucket{span="work",le="0.1"} 1' in text
+    assert 'brewhouse_requests_in_flight{route="/viewbrewing"} 0' in text
+
+    # a slow request is sampled, a fast one is not
+    profiler = Slow_request_profiler(m, threshold=0.05, interval=0.005)
+    profiler.start()
+    try:
+        def slow_request():
+            start = m.request_started('/slow')
+            time.sleep(0.2)
+            m.request_finished('/slow', 'GET', 200, start)
+            m.request_ended('/slow')
+        t = threading.Thread(target=slow_request)
+        t.start()
+        t.join()
+    finally:
+        profiler.stop()
+    assert profiler.samples
+    assert all(stack.startswith('/slow;') and 'slow_request' in stack
+               for stack in profiler.samples)
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_metrics()
@@ -0,0 +1,431 @@
+'''Production Planner
+
+Plans the gyles to brew so bottled beer meets the predicted monthly demand
+per recipe. Batches already in production count towards the demand of the
+month they will be bottled in. The demand left over is split into batches
+no larger than the largest volume both a fermenter and a conditioner hold.
+Batches in hot brew hold no tank yet, so each has a fermenter reserved for
+when its hot brew ends. Each batch is given the hot brew
+slot, fermenter and conditioner that get it bottled soonest, given the tank
+capacities, the stage durations and when each tank will next be free. The
+hot brew slots booked so far are kept as intervals, so a batch can take a
+free slot ahead of one booked for a later fermenter. A batch no conditioner
+can hold is left unscheduled and counted as late.
+
+The planner is a stage listener. It keeps the batches in production, and the
+tanks they hold, up to date one stage change at a time, so replanning never
+rescans the batch history. Plans are cached until the next stage change.
+'''
+from bisect import insort
+from datetime import datetime, timedelta
+import threading
+import brewery as bh
+import brew_scheduler as bs
+
+# Stages of a batch in production, in order
+PRODUCTION_STAGES = [bh.BREW_STAGE_HOT_BREW,
+                     bh.BREW_STAGE_FERMENTATION,
+                     bh.BREW_STAGE_CONDITIONING,
+                     bh.BREW_STAGE_BOTTLING
+                    ]
+
+# Hot brew duration used for planned batches, in hours
+DEFAULT_HOT_BREW_DURATION = 3
+
+
+class Planned_gyle:
+    '''
+    A batch the plan says to brew
+    '''
+    def __init__(self, gyle, recipe, volume, month_end, deadline):
+        self.gyle = gyle
+        self.recipe = recipe
+        self.volume = volume
+        # demand month the batch is for, and the time it must be bottled by
+        self.month_end = month_end
+        self.deadline = deadline
+        self.hot_brew_start = None
+        self.fermenter = None
+        self.fermentation_start = None
+        self.conditioner = None
+        self.conditioning_start = None
+        self.ready_time = None
+
+    @property
+    def scheduled(self):
+        return self.ready_time is not None
+
+    @property
+    def late(self):
+        return not self.scheduled or self.ready_time > self.deadline
+
+    def as_dict(self):
+        def fmt(time):
+            return time.strftime("%Y-%m-%dT%H:%M") if time is not None else None
+
+        return {'gyle': self.gyle,
+                'recipe': self.recipe,
+                'volume': self.volume,
+                'month': self.month_end.strftime('%Y-%m'),
+                'hot_brew_start': fmt(self.hot_brew_start),
+                'fermenter': self.fermenter,
+                'fermentation_start': fmt(self.fermentation_start),
+                'conditioner': self.conditioner,
+                'conditioning_start': fmt(self.conditioning_start),
+                'ready_time': fmt(self.ready_time),
+                'scheduled': self.scheduled,
+                'late': self.late
+               }
+
+class Production_plan:
+    def __init__(self, now, gyles, covered):
+        self.now = now
+        self.gyles = gyles
+        # (month end, recipe) -> volume met by batches already in production
+        self.covered = covered
+
+    def for_month(self, month_end):
+        return [g for g in self.gyles if g.month_end == month_end]
+
+    def as_dict(self):
+        return {'now': self.now.strftime("%Y-%m-%dT%H:%M"),
+                'gyles': [g.as_dict() for g in self.gyles],
+                'late': sum(1 for g in self.gyles if g.late)
+               }
+
+class Production_planner:
+    '''
+    Incremental production planner for a Brewery_state
+
+    state: Brewery_state with the batches in production
+    litres_per_unit: litres brewed for each unit of predicted sales
+    batch_volume: litres assumed for batches in production without a volume,
+                  defaults to the largest fermenter
+    '''
+    def __init__(self, state, litres_per_unit=1.0, batch_volume=None):
+        self.state = state
+        self.litres_per_unit = litres_per_unit
+        self.batch_volume = batch_volume
+        self.demand = []
+        self.version = 0
+        # gyle -> (recipe, volume, stage, expected end of the stage or None)
+        self._in_production = {}
+        # tank name -> tank, every tank of the brewery
+        self._tanks = {}
+        # tank name -> (gyle holding it, expected end of the stage or None)
+        self._held = {}
+        self._plan = None
+        self._plan_key = None
+        self._lock = threading.Lock()
+        return
+
+    def start(self):
+        '''
+        Loads the batches in production, then follows their stage changes
+        '''
+        bh.add_stage_listener(self.stage_changed)
+        self.rebuild()
+        return
+
+    def stop(self):
+        bh.remove_stage_listener(self.stage_changed)
+        return
+
+    def rebuild(self):
+        '''
+        Scans every batch, only needed at start up
+        '''
+        with self._lock:
+            self._in_production.clear()
+            self._held.clear()
+            self._tanks = {t.name: t for t in self.state.tank_pool.tank_pool}
+            for b in self.state.batch_list():
+                self._track(b)
+            self.version += 1
+        return
+
+    def set_demand(self, demand):
+        '''
+        Sets the demand to plan for, a list of (month end, {recipe: quantity})
+        as returned by production_simulator.demand_from_predicted_sales
+        '''
+        with self._lock:
+            if demand != self.demand:
+                self.demand = demand
+                self.version += 1
+        return
+
+    def stage_changed(self, event, batch, stage):
+        '''
+        Stage listener, updates the one batch that changed
+        '''
+        if not self.state.owns(batch):
+            return
+        with self._lock:
+            self._track(batch, finished=event == bh.STAGE_END and stage == bh.BREW_STAGE_BOTTLING)
+            self.version += 1
+        return
+
+    def _track(self, b, finished=False):
+        old = self._in_production.pop(b.gyle, None)
+        for name, (gyle, _) in list(self._held.items()):
+            if gyle == b.gyle:
+                del self._held[name]
+        if old is None and finished:
+            return
+
+        stage = b.current_brew_stage
+        record = b.brew_stage.get(stage)
+        if finished or stage not in PRODUCTION_STAGES or record is None or record.end_time:
+            return
+        end = None
+        duration = bh.stage_duration(stage, record.duration)
+        if duration is not None and isinstance(record.start_time, datetime):
+            end = record.start_time + duration
+        self._in_production[b.gyle] = (b.product.recipe, b.volume, stage, end)
+        for tank in b.brew_tanks:
+            self._tanks[tank.name] = tank
+            self._held[tank.name] = (b.gyle, end)
+        return
+
+    def stage_durations(self):
+        '''
+        Stage -> timedelta used for planned batches and the rest of the
+        batches in production
+        '''
+        durations = {bh.BREW_STAGE_HOT_BREW:
+                     bh.stage_duration(bh.BREW_STAGE_HOT_BREW, DEFAULT_HOT_BREW_DURATION)}
+        for stage, duration in bs.default_stage_duration.items():
+            durations[stage] = bh.stage_duration(stage, duration)
+        return durations
+
+    def plan(self, now=None):
+        '''
+        Returns the Production_plan for the current demand, reusing the last
+        plan until a stage changes, the demand changes or the time moves on
+        '''
+        if now is None:
+            now = datetime.now().replace(second=0, microsecond=0)
+        with self._lock:
+            key = (self.version, now)
+            if self._plan_key != key:
+                self._plan = self._make_plan(now)
+                self._plan_key = key
+            return self._plan
+
+    def _make_plan(self, now):
+        durations = self.stage_durations()
+        fermenters = [t for t in self._tanks.values() if t.fermenter]
+        conditioners = [t for t in self._tanks.values() if t.conditioner]
+        if not fermenters or not conditioners or not self.demand:
+            return Production_plan(now, [], {})
+        # the largest gyle that fits a fermenter and then a conditioner
+        max_volume = min(max(t.volume for t in fermenters), max(t.volume for t in conditioners))
+        default_volume = self.batch_volume or max_volume
+
+        # when each tank is next free
+        free_at = {name: now for name in self._tanks}
+        for name, (_, end) in self._held.items():
+            free_at[name] = max(now, end) if end is not None else now
+        self._reserve_fermenters(now, free_at, fermenters, durations)
+
+        # supply from batches in production: recipe -> ready times and volumes
+        supply = {}
+        for recipe, volume, stage, end in self._in_production.values():
+            ready = max(now, end) if end is not None else now
+            for later in PRODUCTION_STAGES[PRODUCTION_STAGES.index(stage) + 1:]:
+                ready += durations[later]
+            supply.setdefault(recipe, []).append([ready, volume or default_volume])
+        for batches in supply.values():
+            batches.sort()
+
+        gyles = []
+        covered = {}
+        # (start, end) of the hot brews booked so far, in order
+        hot_brews = []
+        for month_end, quantities in self.demand:
+            # demand months end at midnight at the end of their last day
+            deadline = datetime(month_end.year, month_end.month, month_end.day) + timedelta(days=1)
+            # largest needs first, so they get the earliest tanks
+            for recipe, quantity in sorted(quantities.items(), key=lambda rq: -rq[1]):
+                need = quantity * self.litres_per_unit
+                met = 0
+                for batch in supply.get(recipe, []):
+                    if need <= 0:
+                        break
+                    if batch[0] <= deadline and batch[1] > 0:
+                        used = min(need, batch[1])
+                        batch[1] -= used
+                        need -= used
+                        met += used
+                covered[(month_end, recipe)] = met
+
+                while need > 0:
+                    g = Planned_gyle('P{}'.format(len(gyles) + 1), recipe,
+                                     min(need, max_volume), month_end, deadline)
+                    need -= g.volume
+                    self._schedule(g, now, hot_brews, free_at, fermenters, conditioners,
+                                   durations)
+                    gyles.append(g)
+        # unscheduled gyles last
+        gyles.sort(key=lambda g: (not g.scheduled, g.hot_brew_start or now, g.gyle))
+        return Production_plan(now, gyles, covered)
+
+    def _reserve_fermenters(self, now, free_at, fermenters, durations):
+        '''
+        Books a fermenter for each batch in hot brew, from the end of its hot
+        brew, in the order the hot brews end
+        '''
+        brewing = sorted((max(now, end) if end is not None else now, volume or 1)
+                         for _, volume, stage, end in self._in_production.values()
+                         if stage == bh.BREW_STAGE_HOT_BREW)
+        for brewed, volume in brewing:
+            candidates = [t for t in fermenters if t.volume >= volume]
+            if not candidates:
+                continue
+            fermenter = min(candidates,
+                            key=lambda t: (max(brewed, free_at[t.name]), t.volume, t.name))
+            start = max(brewed, free_at[fermenter.name])
+            free_at[fermenter.name] = start + durations[bh.BREW_STAGE_FERMENTATION]
+        return
+
+    def _schedule(self, g, now, hot_brews, free_at, fermenters, conditioners, durations):
+        '''
+        Books the hot brew, fermenter and conditioner that bottle g soonest,
+        or leaves g unscheduled if no conditioner can hold it
+        '''
+        candidates = [t for t in conditioners if t.volume >= g.volume]
+        if not candidates:
+            return
+        hot_brew = durations[bh.BREW_STAGE_HOT_BREW]
+
+        def fermentation_start(t):
+            # brew as late as possible before the fermenter is free
+            return free_hot_brew(hot_brews, max(now, free_at[t.name] - hot_brew), hot_brew) + hot_brew
+
+        # soonest start, then the smallest tank that fits
+        fermenter = min((t for t in fermenters if t.volume >= g.volume),
+                        key=lambda t: (fermentation_start(t), t.volume, t.name))
+        g.fermenter = fermenter.name
+        g.fermentation_start = fermentation_start(fermenter)
+        g.hot_brew_start = g.fermentation_start - hot_brew
+        insort(hot_brews, (g.hot_brew_start, g.fermentation_start))
+        fermented = g.fermentation_start + durations[bh.BREW_STAGE_FERMENTATION]
+        free_at[fermenter.name] = fermented
+
+        conditioner = min(candidates,
+                          key=lambda t: (max(fermented, free_at[t.name]), t.volume, t.name))
+        g.conditioner = conditioner.name
+        g.conditioning_start = max(fermented, free_at[conditioner.name])
+        free_at[conditioner.name] = g.conditioning_start + durations[bh.BREW_STAGE_CONDITIONING]
+        g.ready_time = free_at[conditioner.name] + durations[bh.BREW_STAGE_BOTTLING]
+        return
+
+def free_hot_brew(booked, earliest, duration):
+    '''
+    Returns the start of the first free slot of duration at or after earliest
+
+    booked: (start, end) of the booked slots, in order
+    '''
+    start = earliest
+    for slot_start, slot_end in booked:
+        if slot_end <= start:
+            continue
+        if slot_start >= start + duration:
+            break
+        start = slot_end
+    return start
+
+def test_production_planner():
+    '''
+    Unit test
+    '''
+    import time
+    now = datetime(2019, 10, 1)
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    planner = Production_planner(state)
+    planner.start()
+    try:
+        demand = [(datetime(2019, 11, 30), {'Pilsner': 2500, 'Dunkel': 900}),
+                  (datetime(2019, 12, 31), {'Pilsner': 1000, 'Dunkel': 0})]
+        planner.set_demand(demand)
+        plan = planner.plan(now)
+        pilsner = [g for g in plan.gyles if g.recipe == 'Pilsner']
+        assert sum(g.volume for g in pilsner) == 3500
+        assert all(g.volume <= 1000 for g in plan.gyles)
+        # the fermenters are booked without overlaps
+        booked = {}
+        for g in plan.gyles:
+            assert g.fermentation_start >= booked.get(g.fermenter, now)
+            booked[g.fermenter] = g.fermentation_start + timedelta(weeks=4)
+            assert g.hot_brew_start >= now and g.ready_time > g.conditioning_start
+        # and so is the hot brew
+        for first, second in zip(plan.gyles, plan.gyles[1:]):
+            assert second.hot_brew_start >= first.hot_brew_start + timedelta(hours=3)
+        assert planner.plan(now) is plan
+
+        # a batch in production covers part of the demand
+        b = state.new_batch('1', bh.Product('Dunkel'), now, 3)
+        b.volume = 900
+        state.transition('1', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, now, 4,
+                         tank_name='Albert', volume=900)
+        plan = planner.plan(now)
+        assert not [g for g in plan.gyles if g.recipe == 'Dunkel']
+        assert all(g.fermenter != 'Albert' or g.fermentation_start >= now + timedelta(weeks=4)
+                   for g in plan.gyles)
+
+        # replanning does not depend on the batch history
+        for gyle in range(2, 20002):
+            b = bh.Batch(str(gyle), bh.Product('Pilsner'))
+            state.add_batch(b)
+        begin = time.perf_counter()
+        state.new_batch('x', bh.Product('Pilsner'), now, 3)
+        plan = planner.plan(now)
+        assert time.perf_counter() - begin < 0.05
+    finally:
+        planner.stop()
+
+    # a gyle waiting for a busy fermenter does not hold up the hot brew for
+    # a gyle that can ferment now
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    for gyle, tank in (('1', 'Albert'), ('2', 'Camilla'), ('3', 'Emily')):
+        state.new_batch(gyle, bh.Product('Pilsner'), now, 3, volume=1000)
+        state.transition(gyle, bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, now, 4,
+                         tank_name=tank)
+    planner = Production_planner(state)
+    planner.rebuild()
+    planner.set_demand([(datetime(2019, 12, 31), {'Pilsner': 4000, 'Dunkel': 500})])
+    # the batches in production cover 3000 L, leaving one Pilsner gyle
+    plan = {g.recipe: g for g in planner.plan(now).gyles}
+    assert plan['Pilsner'].fermentation_start == now + timedelta(weeks=4)
+    assert plan['Dunkel'].fermenter == 'Brigadier'
+    assert plan['Dunkel'].fermentation_start == now + timedelta(hours=3)
+
+    # with only small conditioners the gyles are sized to fit them, and never
+    # booked into a fermenter that cannot condition
+    tank_pool = bh.Brewery_tank_pool('small')
+    tank_pool.add(bh.Brew_tank('Albert', 1000, True, False))
+    tank_pool.add(bh.Brew_tank('Gertrude', 680, False, True))
+    planner = Production_planner(bh.Brewery_state(tank_pool))
+    planner.rebuild()
+    planner.set_demand([(datetime(2019, 12, 31), {'Pilsner': 1600})])
+    plan = planner.plan(now)
+    assert sorted(g.volume for g in plan.gyles) == [240, 680, 680]
+    assert all(g.scheduled and g.conditioner == 'Gertrude' for g in plan.gyles)
+
+    # a batch in hot brew has a fermenter reserved for when its brew ends
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    for gyle in ('1', '2', '3'):
+        state.new_batch(gyle, bh.Product('Pilsner'), now, 3, volume=1000)
+    planner = Production_planner(state)
+    planner.rebuild()
+    planner.set_demand([(datetime(2019, 12, 31), {'Pilsner': 4000})])
+    plan = planner.plan(now)
+    assert len(plan.gyles) == 1
+    assert plan.gyles[0].fermentation_start >= now + timedelta(hours=3, weeks=4)
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_production_planner()
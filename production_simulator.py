@@ -0,0 +1,305 @@
+'''Production Simulator
+
+Discrete-event simulation of the brewery for capacity planning. Monthly
+demand per recipe, as predicted by sales_predictor.get_predicted_sales, is
+turned into batches that are pushed through hot brew, fermentation,
+conditioning and bottling against a brewery tank pool. Each month's batches
+are released one production lead time (the sum of the stage durations)
+before the month starts, so they can be bottled by the end of the month if
+tanks are free soon enough. Reports tank utilization, time spent queueing for
+tanks, demand not bottled by the end of its month and batches stranded
+because no conditioner can hold them.
+
+Simulation time is kept in hours from the first release.
+'''
+from datetime import timedelta
+import heapq
+import itertools
+import math
+import brewery as bh
+
+HOURS_PER_WEEK = 24 * 7
+
+# Stage durations in hours
+default_durations = {bh.BREW_STAGE_HOT_BREW     : 3,
+                     bh.BREW_STAGE_FERMENTATION : 4 * HOURS_PER_WEEK,
+                     bh.BREW_STAGE_CONDITIONING : 2 * HOURS_PER_WEEK,
+                     bh.BREW_STAGE_BOTTLING     : 3
+                    }
+
+# Simulated stages in order
+SIM_STAGES = [bh.BREW_STAGE_HOT_BREW,
+              bh.BREW_STAGE_FERMENTATION,
+              bh.BREW_STAGE_CONDITIONING,
+              bh.BREW_STAGE_BOTTLING
+             ]
+
+# Event kinds
+EVENT_RELEASE = 0
+EVENT_STAGE_END = 1
+
+
+def demand_from_predicted_sales(df2, recipes=('Pilsner', 'Dunkel', 'Red Helles')):
+    '''
+    Converts a predicted sales dataframe, see sales_predictor.get_predicted_sales,
+    into a list of (month end, {recipe: quantity}) in month order.
+    '''
+    demand = []
+    for i, month_end in enumerate(df2['Month']):
+        demand.append((month_end.to_pydatetime(), {r: int(df2[r].iloc[i]) for r in recipes}))
+    return demand
+
+class Simulation_result:
+    '''
+    Outcome of a production simulation
+    '''
+    def __init__(self, horizon):
+        # hours simulated
+        self.horizon = horizon
+        # tank name -> fraction of the horizon the tank held a batch
+        self.tank_utilization = {}
+        # stage -> hours each batch waited for a tank before the stage started
+        self.queue_delay = {bh.BREW_STAGE_FERMENTATION: [], bh.BREW_STAGE_CONDITIONING: []}
+        # month index -> {recipe: demanded volume not bottled by month end}
+        self.unmet_demand = {}
+        self.batches_brewed = 0
+        self.batches_bottled = 0
+        # gyles of batches larger than every conditioner, never bottled
+        self.stranded = []
+
+    def total_unmet_demand(self):
+        return sum(sum(month.values()) for month in self.unmet_demand.values())
+
+    def mean_queue_delay(self, stage):
+        delays = self.queue_delay[stage]
+        return sum(delays) / len(delays) if delays else 0.0
+
+    def summary(self):
+        return {'batches_brewed': self.batches_brewed,
+                'batches_bottled': self.batches_bottled,
+                'tank_utilization': self.tank_utilization,
+                'mean_fermentation_wait': self.mean_queue_delay(bh.BREW_STAGE_FERMENTATION),
+                'mean_conditioning_wait': self.mean_queue_delay(bh.BREW_STAGE_CONDITIONING),
+                'max_wait': max([0.0] + self.queue_delay[bh.BREW_STAGE_FERMENTATION] +
+                                self.queue_delay[bh.BREW_STAGE_CONDITIONING]),
+                'unmet_demand': self.total_unmet_demand(),
+                'stranded': len(self.stranded)
+               }
+
+class Production_simulator:
+    '''
+    Simulates brewing monthly demand with a tank pool.
+
+    tank_pool: Brewery_tank_pool with the tanks to plan with
+    durations: stage -> duration in hours, defaults to default_durations
+    litres_per_unit: litres brewed for each unit of quantity ordered
+    hot_brew_capacity: number of hot brews that can run at once
+    '''
+    def __init__(self, tank_pool, durations=None, litres_per_unit=1.0, hot_brew_capacity=1):
+        self.tank_pool = tank_pool
+        self.durations = dict(default_durations)
+        if durations is not None:
+            self.durations.update(durations)
+        self.litres_per_unit = litres_per_unit
+        self.hot_brew_capacity = hot_brew_capacity
+        self.max_volume = max(t.volume for t in tank_pool.tank_pool if t.fermenter)
+        self.max_conditioner_volume = max([t.volume for t in tank_pool.tank_pool if t.conditioner],
+                                          default=0)
+        return
+
+    def lead_time(self):
+        '''
+        Hours from the start of hot brew to the end of bottling, without
+        waiting for tanks
+        '''
+        return sum(self.durations[stage] for stage in SIM_STAGES)
+
+    def run(self, demand):
+        '''
+        Runs the simulation over demand, a list of (month end, {recipe: quantity})
+        as returned by demand_from_predicted_sales. Returns a Simulation_result.
+        '''
+        start = demand[0][0].replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        month_ends = [(end + timedelta(days=1) - start).total_seconds() / 3600 for end, _ in demand]
+        # batches are released a lead time before their month starts, so the
+        # simulation starts a lead time before the first month
+        lead_time = self.lead_time()
+        month_ends = [end + lead_time for end in month_ends]
+        result = Simulation_result(month_ends[-1])
+        tanks = {t.name: t for t in self.tank_pool.tank_pool}
+        busy_hours = {name: 0.0 for name in tanks}
+
+        events = []
+        sequence = itertools.count()
+        # batches waiting to start a stage, oldest first
+        waiting = {stage: [] for stage in SIM_STAGES}
+        hot_brews = 0
+        gyles = itertools.count(1)
+        # gyle -> demand month, time it became ready for its next stage and
+        # time it entered its current tank
+        month_of = {}
+        ready_time = {}
+        tank_start = {}
+
+        # release each month's batches a lead time before the month starts
+        release_time = 0.0
+        for month, (_, quantities) in enumerate(demand):
+            result.unmet_demand[month] = {}
+            for recipe, quantity in quantities.items():
+                volume = quantity * self.litres_per_unit
+                result.unmet_demand[month][recipe] = volume
+                for _ in range(math.ceil(volume / self.max_volume)):
+                    b = bh.Batch(next(gyles), bh.Product(recipe))
+                    b.volume = min(volume, self.max_volume)
+                    month_of[b.gyle] = month
+                    ready_time[b.gyle] = release_time
+                    volume -= b.volume
+                    heapq.heappush(events, (release_time, next(sequence), EVENT_RELEASE, b))
+            release_time = month_ends[month] - lead_time
+
+        def start_stage(b, stage, now):
+            b.current_brew_stage = stage
+            record = b.brew_stage[stage]
+            record.start_time = now
+            record.duration = self.durations[stage]
+            heapq.heappush(events, (now + record.duration, next(sequence), EVENT_STAGE_END, b))
+
+        def try_start(stage, now):
+            '''
+            Starts as many waiting batches as resources allow, oldest first
+            '''
+            nonlocal hot_brews
+            queue = waiting[stage]
+            i = 0
+            while i < len(queue):
+                b = queue[i]
+                if stage == bh.BREW_STAGE_HOT_BREW:
+                    if hot_brews >= self.hot_brew_capacity:
+                        return
+                    hot_brews += 1
+                elif stage == bh.BREW_STAGE_CONDITIONING and b.volume > self.max_conditioner_volume:
+                    # would wait for a conditioner forever
+                    del queue[i]
+                    result.stranded.append(b.gyle)
+                    continue
+                elif stage in result.queue_delay:
+                    tank = self.tank_pool.get_free_tank(volume=b.volume,
+                                                        fermenter=stage == bh.BREW_STAGE_FERMENTATION)
+                    if tank is None:
+                        i += 1
+                        continue
+                    b.brew_tanks.append(tank)
+                    tank_start[b.gyle] = now
+                    result.queue_delay[stage].append(now - ready_time[b.gyle])
+                del queue[i]
+                start_stage(b, stage, now)
+
+        while events:
+            now, _, kind, b = heapq.heappop(events)
+
+            if kind == EVENT_RELEASE:
+                result.batches_brewed += 1
+                waiting[bh.BREW_STAGE_HOT_BREW].append(b)
+                try_start(bh.BREW_STAGE_HOT_BREW, now)
+                continue
+
+            # stage end: release resources, then queue for the next stage
+            stage = b.current_brew_stage
+            b.brew_stage[stage].end_time = now
+            if stage == bh.BREW_STAGE_HOT_BREW:
+                hot_brews -= 1
+            for tank in b.brew_tanks:
+                # only time within the horizon counts towards utilization
+                busy_hours[tank.name] += max(0.0, min(now, result.horizon) -
+                                             min(tank_start[b.gyle], result.horizon))
+                self.tank_pool.add(tank)
+            b.brew_tanks = []
+
+            if stage == bh.BREW_STAGE_BOTTLING:
+                result.batches_bottled += 1
+                month = month_of[b.gyle]
+                if now <= month_ends[month]:
+                    result.unmet_demand[month][b.product.recipe] -= b.volume
+            else:
+                next_stage = SIM_STAGES[SIM_STAGES.index(stage) + 1]
+                ready_time[b.gyle] = now
+                waiting[next_stage].append(b)
+
+            # freed tanks go to batches further along the line first
+            for s in reversed(SIM_STAGES):
+                try_start(s, now)
+
+        horizon = max(result.horizon, 1.0)
+        result.tank_utilization = {name: busy_hours[name] / horizon for name in tanks}
+        for month in result.unmet_demand.values():
+            for recipe in month:
+                month[recipe] = max(0.0, month[recipe])
+        return result
+
+def simulate(demand, tank_pool=None, **kwargs):
+    '''
+    Simulates demand with tank_pool, by default the Barnaby's tank pool.
+    kwargs are passed to Production_simulator.
+    '''
+    if tank_pool is None:
+        tank_pool = bh.init_brew_tank_pool('simulation')
+    return Production_simulator(tank_pool, **kwargs).run(demand)
+
+def sweep_tank_configurations(demand, configurations, **kwargs):
+    '''
+    Simulates demand once for each tank configuration.
+
+    configurations: name -> list of (tank name, volume, fermenter, conditioner)
+    Returns name -> Simulation_result
+    '''
+    results = {}
+    for name, tanks in configurations.items():
+        tank_pool = bh.Brewery_tank_pool(name)
+        for tank in tanks:
+            tank_pool.add(bh.Brew_tank(*tank))
+        results[name] = simulate(demand, tank_pool, **kwargs)
+    return results
+
+def test_production_simulator():
+    '''
+    Unit test
+    '''
+    from datetime import datetime
+    import time
+    demand = [(datetime(2019, 11, 30), {'Pilsner': 2000, 'Dunkel': 1500, 'Red Helles': 1000})]
+    for month in range(12, 23):
+        month_end = datetime(2019 + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+        demand.append((month_end, {'Pilsner': 2500, 'Dunkel': 2000, 'Red Helles': 1500}))
+
+    begin = time.perf_counter()
+    result = simulate(demand)
+    elapsed = time.perf_counter() - begin
+    assert elapsed < 1.0
+    assert result.batches_brewed == result.batches_bottled
+    assert all(0.0 <= u <= 1.0 for u in result.tank_utilization.values())
+    # more demand than the tanks can brew in time
+    assert 0 < result.total_unmet_demand() < sum(sum(q.values()) for _, q in demand)
+
+    # doubling the tanks meets more of it
+    tanks = [(t.name + str(i), t.volume, t.fermenter, t.conditioner)
+             for i in range(2) for t in bh.init_brew_tank_pool('x').tank_pool]
+    results = sweep_tank_configurations(demand, {'barnabys x2': tanks})
+    assert results['barnabys x2'].total_unmet_demand() < result.total_unmet_demand()
+
+    # light demand is met in full, from the first month on
+    light = [(month_end, {'Pilsner': 100, 'Dunkel': 100, 'Red Helles': 100})
+             for month_end, _ in demand]
+    assert simulate(light).total_unmet_demand() == 0
+
+    # batches too large for every conditioner are reported, not dropped
+    results = sweep_tank_configurations(light[:1], {'small conditioner': [
+        ('F', 1000, True, False), ('C', 50, False, True)]})
+    assert len(results['small conditioner'].stranded) == 3
+    assert results['small conditioner'].summary()['stranded'] == 3
+    assert results['small conditioner'].total_unmet_demand() == 300
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_production_simulator()
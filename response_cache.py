@@ -0,0 +1,176 @@
+'''Response Cache
+
+Keeps the rendered pages of the brewhouse so steady-state requests skip
+Jinja rendering and pandas to_html. Every entry is tagged with the state
+version it was rendered at. The version is bumped by every change of the
+brewery state, once the change is indexed, and every change of the sales
+data, which makes all entries stale at once. The version also gives each
+page its ETag and Last-Modified time, so browsers that already hold the
+page get a 304.
+'''
+from collections import OrderedDict
+from datetime import datetime, timezone
+import os
+import threading
+import brewery as bh
+
+
+class Response_cache:
+    '''
+    Rendered responses keyed by request path, valid for one state version
+
+    max_entries: most responses kept, the least recently used are dropped
+    '''
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.version = 0
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self.hits = 0
+        self.misses = 0
+        # ETags must not repeat the ones handed out before a restart
+        self._etag_prefix = '{:x}-{:x}'.format(os.getpid(), int(self.last_modified.timestamp()))
+        self._source_signature = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def start(self):
+        bh.add_state_listener(self.state_changed)
+        return
+
+    def stop(self):
+        bh.remove_state_listener(self.state_changed)
+        return
+
+    def bump(self):
+        '''
+        Marks the state as changed, making every cached response stale
+        '''
+        with self._lock:
+            self.version += 1
+            self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+            self._entries.clear()
+        return
+
+    def state_changed(self, state):
+        '''
+        State listener, called after the state's indexes are updated so a
+        page rendered at the new version sees the change
+        '''
+        self.bump()
+        return
+
+    def check_source(self, signature):
+        '''
+        Bumps the version if the sales data signature, see
+        sales_predictor.source_signature, has changed since the last call
+        '''
+        with self._lock:
+            if self._source_signature is None:
+                self._source_signature = signature
+                return
+            changed = signature != self._source_signature
+            self._source_signature = signature
+        if changed:
+            self.bump()
+        return
+
+    def etag(self, version):
+        return '{}-{}'.format(self._etag_prefix, version)
+
+    def current(self):
+        '''
+        Returns (version, etag, last modified time) of the current state
+        '''
+        with self._lock:
+            return self.version, self.etag(self.version), self.last_modified
+
+    def get(self, key):
+        '''
+        Returns the cached (body, mimetype, etag, last modified time) for
+        key, or None if there is none for the current version
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, body, mimetype, last_modified):
+        '''
+        Stores a response rendered at version. Dropped if the state has
+        moved on while it was being rendered.
+        '''
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (body, mimetype, self.etag(version), last_modified)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'version': self.version}
+
+def test_response_cache():
+    '''
+    Unit test
+    '''
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    cache = Response_cache(max_entries=2)
+    cache.start()
+    try:
+        version, etag, modified = cache.current()
+        assert cache.get('/a') is None
+        cache.put('/a', version, 'page a', 'text/html', modified)
+        assert cache.get('/a') == ('page a', 'text/html', etag, modified)
+
+        # stage changes make every entry stale
+        state.new_batch('1', bh.Product('Pilsner'), datetime.now(), 3)
+        assert cache.version > version and cache.get('/a') is None
+        assert cache.current()[1] != etag
+
+        # the version changes once the indexes show the change
+        seen = []
+        listener = lambda s: seen.append((cache.version,
+                                          s.find_gyles(stage=bh.BREW_STAGE_FERMENTATION)))
+        bh.add_state_listener(listener)
+        try:
+            before = cache.version
+            state.transition('1', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION,
+                             datetime.now(), 4, tank_name='Albert')
+        finally:
+            bh.remove_state_listener(listener)
+        assert seen == [(before + 1, ['1'])]
+
+        # responses rendered before a change are not kept
+        cache.put('/a', version, 'stale', 'text/html', modified)
+        assert cache.get('/a') is None
+
+        # sales data changes
+        cache.check_source(('sales.csv', 1, 10))
+        version = cache.version
+        cache.check_source(('sales.csv', 1, 10))
+        assert cache.version == version
+        cache.check_source(('sales.csv', 2, 12))
+        assert cache.version == version + 1
+
+        # least recently used entries are dropped
+        version, _, modified = cache.current()
+        for key in ('/a', '/b', '/c'):
+            cache.put(key, version, key, 'text/html', modified)
+        assert cache.get('/a') is None and cache.get('/c') is not None
+    finally:
+        cache.stop()
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_response_cache()
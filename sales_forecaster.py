@@ -0,0 +1,278 @@
+'''Sales Forecaster
+
+Per-recipe sales forecasts with additive Holt-Winters smoothing (level,
+trend and monthly seasonality). Months missing from the sales data count as
+no sales, so any length of history can be used. With less than two years of
+history there is not enough data for the seasonality, and Holt's linear trend
+is used instead.
+
+The smoothing parameters are fitted by a grid search, with every
+combination and every recipe smoothed together as numpy arrays, one pass
+over the months. The fitted model holds each recipe's final level, trend and
+seasonal offsets, so the forecast for any month is an O(1) lookup. Models
+are saved next to the sales data and reused until the data changes.
+'''
+import itertools
+import json
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import sales_predictor as sp
+
+SEASON_LENGTH = 12
+FORECAST_SUFFIX = '.forecast.json'
+
+# Smoothing parameters tried for the level, trend and seasonality
+DEFAULT_GRID = {'alpha': (0.1, 0.3, 0.5, 0.7, 0.9),
+                'beta': (0.0, 0.05, 0.15, 0.3),
+                'gamma': (0.0, 0.1, 0.3, 0.5)
+               }
+
+
+class Forecast_model:
+    '''
+    Fitted Holt-Winters state of each recipe
+
+    last_month: month code (year * 12 + month - 1) of the last month of sales
+    recipes: recipe -> dict of alpha, beta, gamma, level, trend, seasonal
+             (12 offsets indexed by calendar month, January first) and sse
+    '''
+    def __init__(self, last_month, recipes, signature=None):
+        self.last_month = last_month
+        self.recipes = recipes
+        self.signature = signature
+        return
+
+    def forecast(self, recipe, month_code):
+        '''
+        Forecast quantity of a recipe for a month after the sales data, 0
+        for unknown recipes
+        '''
+        params = self.recipes.get(recipe)
+        if params is None:
+            return 0
+        steps = max(1, month_code - self.last_month)
+        value = params['level'] + steps * params['trend'] + params['seasonal'][month_code % 12]
+        return max(0, int(round(value)))
+
+    def forecast_month(self, recipe, year, month):
+        return self.forecast(recipe, year * 12 + month - 1)
+
+    def table(self, horizon=12, recipes=None):
+        '''
+        Forecast for the horizon months after the sales data, laid out like
+        sales_predictor.get_predicted_sales: one column per recipe, Total and
+        Month (month end dates).
+
+        recipes: see sales_predictor.recipe_columns, all recipes if None
+        '''
+        columns = sp.recipe_columns(recipes if recipes is not None else list(self.recipes))
+        months = range(self.last_month + 1, self.last_month + 1 + horizon)
+        table = {column: np.array([self.forecast(recipe, m) for m in months], dtype=np.int64)
+                 for column, recipe in columns.items()}
+        table['Total'] = sum(table.values()) if table else np.zeros(horizon, dtype=np.int64)
+        df = pd.DataFrame.from_dict(table)
+        first = self.last_month + 1
+        df['Month'] = pd.date_range(datetime(first // 12, first % 12 + 1, 1), periods=horizon,
+                                    freq='M')
+        return df
+
+    def as_dict(self):
+        return {'last_month': self.last_month,
+                'signature': list(self.signature) if self.signature is not None else None,
+                'recipes': self.recipes
+               }
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.as_dict(), f)
+        os.replace(path + '.tmp', path)
+        return
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            d = json.load(f)
+        signature = tuple(d['signature']) if d['signature'] is not None else None
+        return cls(d['last_month'], d['recipes'], signature)
+
+def monthly_series(monthly):
+    '''
+    Returns (first month code, array of months x recipes, recipes) from a
+    monthly sales dataframe, with missing months filled with 0
+    '''
+    monthly = monthly.sort_index()
+    first, last = int(monthly.index[0]), int(monthly.index[-1])
+    monthly = monthly.reindex(range(first, last + 1), fill_value=0)
+    return first, monthly.to_numpy(dtype=float), list(monthly.columns)
+
+def smooth(y, alpha, beta, gamma, season_length=SEASON_LENGTH):
+    '''
+    Runs additive Holt-Winters over y (months x recipes) for every
+    parameter combination at once.
+
+    alpha, beta, gamma: arrays of one value per combination
+
+    Returns (sse, level, trend, season), each with a leading combination
+    axis; season is indexed by position in the season of the first month
+    '''
+    months, recipe_count = y.shape
+    combinations = len(alpha)
+    alpha, beta, gamma = (np.asarray(p, dtype=float)[:, None] for p in (alpha, beta, gamma))
+    seasonal = months >= 2 * season_length
+    if seasonal:
+        first_season = y[:season_length].mean(axis=0)
+        level = np.tile(first_season, (combinations, 1))
+        trend = np.tile((y[season_length:2 * season_length].mean(axis=0) - first_season) /
+                        season_length, (combinations, 1))
+        season = np.tile((y[:season_length] - first_season)[:, None, :], (1, combinations, 1))
+        start = 0
+    else:
+        level = np.tile(y[0], (combinations, 1))
+        trend = np.tile(y[1] - y[0] if months > 1 else np.zeros(recipe_count), (combinations, 1))
+        season = np.zeros((season_length, combinations, recipe_count))
+        gamma = np.zeros_like(gamma)
+        start = 1
+    sse = np.zeros((combinations, recipe_count))
+
+    for t in range(start, months):
+        s = season[t % season_length]
+        error = y[t] - (level + trend + s)
+        if not seasonal or t >= season_length:
+            # the first season was used to start the seasonal offsets
+            sse += error * error
+        new_level = alpha * (y[t] - s) + (1 - alpha) * (level + trend)
+        trend = beta * (new_level - level) + (1 - beta) * trend
+        season[t % season_length] = gamma * (y[t] - new_level) + (1 - gamma) * s
+        level = new_level
+    return sse, level, trend, season.transpose(1, 0, 2)
+
+def fit_holt_winters(monthly, grid=DEFAULT_GRID, season_length=SEASON_LENGTH):
+    '''
+    Fits a Forecast_model to a monthly sales dataframe, see
+    sales_predictor.load_monthly_sales, choosing the parameters with the
+    lowest one-step-ahead squared error for each recipe
+    '''
+    first, y, recipes = monthly_series(monthly)
+    alpha, beta, gamma = (np.array(p) for p in
+                          zip(*itertools.product(grid['alpha'], grid['beta'], grid['gamma'])))
+    sse, level, trend, season = smooth(y, alpha, beta, gamma, season_length)
+    best = sse.argmin(axis=0)
+
+    fitted = {}
+    for r, recipe in enumerate(recipes):
+        c = best[r]
+        # re-index the offsets by calendar month
+        seasonal = [0.0] * 12
+        for position in range(season_length):
+            seasonal[(first + position) % 12] = float(season[c, position, r])
+        fitted[recipe] = {'alpha': float(alpha[c]),
+                          'beta': float(beta[c]),
+                          'gamma': float(gamma[c]),
+                          'level': float(level[c, r]),
+                          'trend': float(trend[c, r]),
+                          'seasonal': seasonal,
+                          'sse': float(sse[c, r])
+                         }
+    return Forecast_model(first + len(y) - 1, fitted)
+
+def forecast_path_for(source):
+    '''
+    Where the model of a sales source is saved
+    '''
+    if os.path.isdir(source):
+        return os.path.join(source, 'forecast.json')
+    return source + FORECAST_SUFFIX
+
+class Forecast_cache:
+    '''
+    Forecast models of the sales sources, loaded from disk or fitted once
+    per version of the sales data
+    '''
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+        return
+
+    def get(self, source, chunksize=None):
+        signature = sp.source_signature(source)
+        with self._lock:
+            model = self._models.get(signature[0])
+            if model is not None and model.signature == signature:
+                return model
+            path = forecast_path_for(source)
+            model = None
+            if os.path.isfile(path):
+                try:
+                    model = Forecast_model.load(path)
+                except (ValueError, KeyError, OSError):
+                    model = None
+            if model is None or model.signature != signature:
+                model = fit_holt_winters(sp.load_monthly_sales(source, chunksize))
+                model.signature = signature
+                model.save(path)
+            self._models[signature[0]] = model
+            return model
+
+# shared forecast models used by the web front end
+forecast_cache = Forecast_cache()
+
+
+def test_sales_forecaster():
+    '''
+    Unit test
+    '''
+    import tempfile
+    # three years of a growing, seasonal recipe and a flat one
+    months = np.arange(36)
+    codes = 2017 * 12 + months
+    seasonal = 200 + 5 * months + 60 * np.sin(2 * np.pi * months / 12)
+    monthly = pd.DataFrame({'Organic Pilsner': np.round(seasonal).astype(np.int64),
+                            'Organic Dunkel': np.full(36, 100)}, index=codes)
+    model = fit_holt_winters(monthly)
+    assert model.last_month == codes[-1]
+    for h in range(1, 13):
+        expected = 200 + 5 * (35 + h) + 60 * np.sin(2 * np.pi * (35 + h) / 12)
+        assert abs(model.forecast('Organic Pilsner', codes[-1] + h) - expected) < 0.1 * expected
+        assert abs(model.forecast('Organic Dunkel', codes[-1] + h) - 100) <= 15
+    assert model.forecast('Stout', codes[-1] + 1) == 0
+
+    table = model.table(horizon=18, recipes=['Organic Pilsner'])
+    assert list(table.columns) == ['Pilsner', 'Total', 'Month'] and len(table) == 18
+    assert table['Month'][0] == pd.Timestamp(2020, 1, 31)
+
+    # missing months count as no sales
+    first, y, _ = monthly_series(monthly.drop(index=codes[10]))
+    assert first == codes[0] and len(y) == 36 and not y[10].any()
+
+    # short history falls back to a trend only
+    short = fit_holt_winters(monthly.iloc[:5])
+    assert short.forecast('Organic Dunkel', codes[4] + 3) == 100
+
+    # persisted models are reused until the sales data changes
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'sales.csv')
+    with open('Barnabys_sales_fabricated_data.csv') as f, open(source, 'w') as o:
+        o.write(f.read())
+    cache = Forecast_cache()
+    model = cache.get(source)
+    assert os.path.isfile(forecast_path_for(source))
+    assert set(model.recipes) == set(sp.PREDICTED_RECIPES.values())
+    assert Forecast_cache().get(source).recipes == model.recipes
+    loaded = Forecast_model.load(forecast_path_for(source))
+    assert loaded.forecast('Organic Pilsner', model.last_month + 1) == \
+           model.forecast('Organic Pilsner', model.last_month + 1)
+    with open(source, 'a') as o:
+        o.write('SO99999,Customer 1,01-Nov-19,Organic Weiss,GYLE99999,500\n')
+    assert 'Organic Weiss' in cache.get(source).recipes
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_sales_forecaster()
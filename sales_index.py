@@ -0,0 +1,212 @@
+'''Sales Index
+
+Persisted monthly aggregate of the sales orders: the quantity ordered in each
+(year, month, recipe) bucket plus a running total. New orders only update
+their own bucket, so forecasts stay live without re-aggregating the order
+history.
+
+Usage: python sales_index.py build <sales csv or store> [index file]
+'''
+from datetime import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import pandas as pd
+import sales_predictor as sp
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.json'
+
+
+def index_path_for(sales_path):
+    '''
+    Returns the index file that sits next to the given sales csv file or store
+    '''
+    return os.path.splitext(sales_path)[0] + INDEX_SUFFIX
+
+class Sales_index:
+    '''
+    (year, month, recipe) -> quantity buckets of the sales orders
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.total = 0
+        self.months = []
+        self.buckets = {}
+        self._lock = threading.Lock()
+        # held from the snapshot to the replace, so saves land in order
+        self._save_lock = threading.Lock()
+        if os.path.isfile(path):
+            self.load()
+        return
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            index = json.load(f)
+        self.total = index['total']
+        self.months = [year * 12 + month - 1 for year, month in index['months']]
+        self.buckets = {(year * 12 + month - 1, recipe): quantity
+                        for year, month, recipe, quantity in index['buckets']}
+        return
+
+    def save(self):
+        '''
+        Atomically replaces the index file. Each save writes its own
+        temporary file, and a later save never lands before an earlier one.
+        '''
+        with self._save_lock:
+            with self._lock:
+                index = {'version': INDEX_VERSION,
+                         'total': self.total,
+                         'months': [[m // 12, m % 12 + 1] for m in self.months],
+                         'buckets': [[m // 12, m % 12 + 1, recipe, quantity]
+                                     for (m, recipe), quantity in self.buckets.items()]
+                        }
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                            dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(index, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return
+
+    def add_orders(self, orders, save=True):
+        '''
+        Adds new orders to the index, updating only the affected buckets.
+
+        orders: iterable of (date, recipe, quantity). date is a datetime or a
+                string in the sales data date format
+        save: write the index file once all orders are added
+
+        Every order is parsed before the index changes, so an order that
+        does not parse leaves the index as it was.
+        '''
+        parsed = []
+        for date, recipe, quantity in orders:
+            if isinstance(date, str):
+                date = datetime.strptime(date, sp.DATE_FORMAT)
+            parsed.append((date.year * 12 + date.month - 1, recipe, int(quantity)))
+        with self._lock:
+            known_months = set(self.months)
+            for month_code, recipe, quantity in parsed:
+                if month_code not in known_months:
+                    known_months.add(month_code)
+                    self.months.append(month_code)
+                self.buckets[(month_code, recipe)] = \
+                    self.buckets.get((month_code, recipe), 0) + quantity
+                self.total += quantity
+        if save:
+            self.save()
+        return
+
+    def add_monthly_sales(self, monthly):
+        '''
+        Adds a monthly sales dataframe, see sales_predictor.get_monthly_sales
+        '''
+        with self._lock:
+            known_months = set(self.months)
+            for month_code, row in monthly.iterrows():
+                month_code = int(month_code)
+                if month_code not in known_months:
+                    known_months.add(month_code)
+                    self.months.append(month_code)
+                for recipe, quantity in row.items():
+                    if quantity:
+                        self.buckets[(month_code, recipe)] = \
+                            self.buckets.get((month_code, recipe), 0) + int(quantity)
+                        self.total += int(quantity)
+        return
+
+    def monthly_sales(self):
+        '''
+        Returns the index as a monthly sales dataframe, see
+        sales_predictor.get_monthly_sales. Costs O(months x recipes).
+        '''
+        with self._lock:
+            table = {}
+            for (month_code, recipe), quantity in self.buckets.items():
+                table.setdefault(recipe, {})[month_code] = quantity
+            months = list(self.months)
+        monthly = pd.DataFrame(table, index=months).fillna(0).astype('int64')
+        monthly.index.name = 'Month'
+        return monthly
+
+def build_sales_index(sales_path, index_path=None):
+    '''
+    Builds the index from a sales csv file or sales store, replacing any
+    existing index file.
+    '''
+    if index_path is None:
+        index_path = index_path_for(sales_path)
+    index = Sales_index(index_path)
+    index.total = 0
+    index.months = []
+    index.buckets = {}
+    index.add_monthly_sales(sp.load_monthly_sales(sales_path))
+    index.save()
+    return index
+
+def get_monthly_sales_from_index(index_path):
+    '''
+    Reads the monthly sales dataframe from an index file
+    '''
+    return Sales_index(index_path).monthly_sales()
+
+def test_sales_index():
+    '''
+    Unit test
+    '''
+    csv_path = 'Barnabys_sales_fabricated_data.csv'
+    index_path = index_path_for(csv_path)
+    index = build_sales_index(csv_path, index_path)
+    monthly = sp.get_monthly_sales(sp.read_sales_orders(csv_path))
+    assert index.total == monthly.values.sum()
+
+    mom_sales_data, df2, _ = sp.get_predicted_sales(csv_path, 'sap')
+    indexed_mom, indexed_df2, _ = sp.get_predicted_sales(index_path, 'sap')
+    assert indexed_mom == mom_sales_data
+    assert indexed_df2.equals(df2)
+
+    first_month = monthly.index[0]
+    date = datetime(first_month // 12, first_month % 12 + 1, 1)
+    index.add_orders([(date, 'Organic Pilsner', 10), (date, 'Organic Dunkel', 5)])
+    index = Sales_index(index_path)
+    assert index.total == monthly.values.sum() + 15
+    assert index.monthly_sales().sum(axis=1).iloc[0] == monthly.sum(axis=1).iloc[0] + 15
+
+    # a bad order leaves the index untouched
+    buckets = dict(index.buckets)
+    try:
+        index.add_orders([(date, 'Organic Pilsner', 10), (date, 'Organic Dunkel', 'five')])
+        assert False
+    except ValueError:
+        pass
+    assert index.buckets == buckets and index.total == monthly.values.sum() + 15
+
+    # concurrent saves each use their own temporary file
+    threads = [threading.Thread(target=index.save) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert Sales_index(index_path).total == index.total
+    directory = os.path.dirname(os.path.abspath(index_path))
+    assert not [name for name in os.listdir(directory)
+                if name.startswith(os.path.basename(index_path) + '.')]
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == 'build':
+        index = build_sales_index(*sys.argv[2:4])
+        print('indexed {} months, {} ordered'.format(len(index.months), index.total))
+    else:
+        # unit tests
+        test_sales_index()
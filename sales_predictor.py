@@ -1,108 +1,343 @@
 '''Sales Predictor'''
+from concurrent.futures import ProcessPoolExecutor
 import csv
-from collections import defaultdict
 from datetime import datetime
 import io
+import os
+import threading
+import numpy as np
 import pandas as pd
+import metrics
 
+# Sales data csv layout
+DATE_COLUMN_INDEX = 2
+DATE_FORMAT = '%d-%b-%y'
+RECIPE_COLUMN = 'Recipe'
+QUANTITY_COLUMN = 'Quantity ordered'
 
-def get_month_on_month_sales(filepath):
+# Default number of orders per chunk when streaming the sales data
+SALES_CHUNK_SIZE = 100000
+
+# Predicted sales table column -> recipe name in the sales data
+PREDICTED_RECIPES = {'Dunkel': 'Organic Dunkel',
+                     'Red Helles': 'Organic Red Helles',
+                     'Pilsner': 'Organic Pilsner'
+                    }
+
+
+def sales_columns(filepath):
     '''
-    This function opens and reads the csv file. It reads through each row and
-    extracts the infomation and records the data of the sales per month and the
-    quantity of the beers ordered each month.
+    Returns the csv column names of the order date, recipe and quantity
     '''
     with open(filepath, 'r', newline='') as f:
-        d_i = defaultdict(int)
-        cvsreader = csv.reader(f, delimiter=',')
-        row_number = 0
-        for row in cvsreader:
-            if row_number != 0:
-                dte = datetime.strptime(row[2], "%d-%b-%y")
-                month = datetime(dte.year, dte.month, 1).strftime("%b")
-                d_i[(dte.year, month)] += int(row[5])
-            row_number += 1
+        header = next(csv.reader(f, delimiter=','))
+    return [header[DATE_COLUMN_INDEX], RECIPE_COLUMN, QUANTITY_COLUMN]
+
+def read_sales_orders(filepath):
+    '''
+    Reads the order date, recipe and quantity columns of the sales csv file
+    into a dataframe with the columns Date, Recipe and Quantity.
+    '''
+    columns = sales_columns(filepath)
+    orders = pd.read_csv(filepath, usecols=columns)
+    return orders[columns].set_axis(['Date', 'Recipe', 'Quantity'], axis=1)
+
+def read_sales_order_chunks(filepath, chunksize=SALES_CHUNK_SIZE):
+    '''
+    Generator that reads the sales csv file in dataframes of at most chunksize
+    orders, with the same columns as read_sales_orders.
+    '''
+    columns = sales_columns(filepath)
+    with pd.read_csv(filepath, usecols=columns, chunksize=chunksize) as reader:
+        for orders in reader:
+            yield orders[columns].set_axis(['Date', 'Recipe', 'Quantity'], axis=1)
+
+def get_monthly_sales(orders):
+    '''
+    Totals the quantity ordered per month and recipe in a single vectorized
+    pass over the orders.
+
+    Returns a dataframe with one row per month, indexed by month code
+    (year * 12 + month - 1) in the order the months first appear in the sales
+    data, and one column per recipe.
+    '''
+    dates = pd.to_datetime(orders['Date'], format=DATE_FORMAT)
+    month_code = (dates.dt.year * 12 + dates.dt.month - 1).rename('Month')
+    monthly = orders['Quantity'].groupby([month_code, orders['Recipe']]).sum()
+    monthly = monthly.unstack(fill_value=0).reindex(pd.unique(month_code))
+    monthly.columns.name = None
+    return monthly
 
-        # init month on month sales data into table
-        d = {'Month': [], 'Quant': []}
+def fold_monthly_sales(monthly, part):
+    '''
+    Adds the monthly sales dataframe part into the running totals monthly,
+    keeping months in the order they first appear.
+    '''
+    if monthly is None:
+        return part
+    combined = pd.concat([monthly, part]).fillna(0)
+    return combined.groupby(level=0, sort=False).sum().astype(np.int64)
 
-        # extract months
-        k = d_i.keys()
-        k = [x for x in k]
-        k = [k[i][1] for i in range(12)]
+def get_monthly_sales_streamed(filepath, chunksize=SALES_CHUNK_SIZE):
+    '''
+    Streams the sales csv file in chunks, folding each chunk into running
+    per-month, per-recipe totals. Memory use is bounded by the chunk size and
+    the number of months, not by the size of the file.
+    '''
+    monthly = None
+    for orders in read_sales_order_chunks(filepath, chunksize):
+        monthly = fold_monthly_sales(monthly, get_monthly_sales(orders))
+    if monthly is None:
+        return pd.DataFrame(dtype=np.int64)
+    return monthly
 
-        # extract corresponding monthly sales
-        v = d_i.values()
-        v = [x for x in v]
-        v = [v[i] for i in range(12)]
+def load_monthly_sales(filepath, chunksize=None):
+    '''
+    Returns the monthly sales dataframe of a sales csv file, sales store or
+    sales index. A csv file is read in one go unless a chunksize is given, in
+    which case it is streamed.
+    '''
+    # sales_store and sales_index build on this module, so are imported on
+    # first use
+    if os.path.isdir(filepath):
+        import sales_store
+        return sales_store.get_monthly_sales_from_store(filepath)
+    if filepath.endswith('.index.json'):
+        import sales_index
+        return sales_index.get_monthly_sales_from_index(filepath)
+    if chunksize:
+        return get_monthly_sales_streamed(filepath, chunksize)
+    return get_monthly_sales(read_sales_orders(filepath))
 
-        # setup month on month sales data table
-        d['Month'] = k
-        d['Quant'] = v
+def month_name(month_code):
+    '''
+    Returns the abbreviated month name of a month code
+    '''
+    return datetime(month_code // 12, month_code % 12 + 1, 1).strftime("%b")
 
-        return d
+def month_on_month_sales(monthly, months=12):
+    '''
+    Builds the month on month sales data table, the month names and total
+    quantity sold, from the latest months of a monthly sales dataframe.
+    '''
+    totals = monthly.sum(axis=1).sort_index()[-months:]
+    return {'Month': [month_name(m) for m in totals.index],
+            'Quant': totals.tolist()
+           }
 
-def get_predicted_sales(filepath, o_p='html'):
+def get_month_on_month_sales(filepath, chunksize=None):
+    '''
+    This function opens and reads the csv file and records the data of the
+    sales per month and the quantity of the beers ordered each month.
+
+    chunksize: stream the file this many orders at a time, see load_monthly_sales
+    '''
+    return month_on_month_sales(load_monthly_sales(filepath, chunksize))
+
+@metrics.timed('get_predicted_sales')
+def get_predicted_sales(filepath, o_p='html', chunksize=None):
     '''
     This function uses the data which is provided from the reading of the csv file
     to predict the sales of the beer, individually and the total sales prediciton
     per month to provide a prediciton for the sales across the upcoming months.
+
+    chunksize: stream the file this many orders at a time, see load_monthly_sales
     '''
-    # extract average percentage sales growth month-in-month from past sales data
     if not filepath:
         return None, None, None
 
-    mom_sales_data = get_month_on_month_sales(filepath)
-    df = pd.DataFrame.from_dict(mom_sales_data)
-    df.reset_index(inplace=True)
-    df.set_index("Month", inplace=True)
-    growth_rate = df.pct_change().describe()['Quant'][1]
+    monthly = load_monthly_sales(filepath, chunksize)
+    return predict_sales(monthly, o_p)
+
+def recipe_columns(recipes, monthly=None):
+    '''
+    Returns the predicted sales column -> recipe name mapping for a recipe
+    list.
+
+    recipes: dict of column -> recipe name, a list of recipe names or None
+             for every recipe in the monthly sales dataframe
+    '''
+    if isinstance(recipes, dict):
+        return recipes
+    if recipes is None:
+        recipes = list(monthly.columns)
+    # the known recipes keep their short column names
+    short_names = {recipe: column for column, recipe in PREDICTED_RECIPES.items()}
+    return {short_names.get(recipe, recipe): recipe for recipe in recipes}
 
-    # extract individual beer quantities and the total sold from past sales data
-    df1 = pd.read_csv('Barnabys_sales_fabricated_data.csv')
-    dunkel = df1.loc[lambda df1: df1['Recipe'] == 'Organic Dunkel', :].sum()['Quantity ordered']
-    red_helles = df1.loc[lambda df1: df1['Recipe'] == 'Organic Red Helles', :].sum()['Quantity ordered']
-    pilsner = df1.loc[lambda df1: df1['Recipe'] == 'Organic Pilsner', :].sum()['Quantity ordered']
-    total_order = df1.sum()['Quantity ordered']
+def predict_sales(monthly, o_p='html', recipes=PREDICTED_RECIPES, html=True):
+    '''
+    Predicts the sales from a monthly sales dataframe, see get_monthly_sales.
+    Returns the month on month sales data, the predicted sales dataframe and
+    the predicted sales as an HTML table.
+
+    recipes: recipes to predict, see recipe_columns
+    html: build the HTML table, None is returned in its place if False
+    '''
+    mom_sales_data = month_on_month_sales(monthly)
+
+    # extract average percentage sales growth month-in-month from past sales data
+    quant = np.array(mom_sales_data['Quant'], dtype=float)
+    growth_rate = np.mean(quant[1:] / quant[:-1] - 1)
+
+    # ratios of individual beers to the total sold from past sales data
+    recipe_totals = monthly.sum(axis=0)
+    total_order = recipe_totals.sum()
 
     # construct predicted sales table based percentage sales growth
     # over past year and ratios of individual beers sold
-    predicted_sales = {'Dunkel': [],
-                       'Red Helles' : [],
-                       'Pilsner' : [],
-                       'Total' : []
-                      }
-    for x in range(12):
-        mon = mom_sales_data['Month'][x]
-        mon_order = round((growth_rate * mom_sales_data['Quant'][x]) + mom_sales_data['Quant'][x])
-        mon_dunkel = round(mon_order * (dunkel/total_order))
-        mon_red_helles = round(mon_order * (red_helles/total_order))
-        mon_pilsner = round(mon_order * (pilsner/total_order))
-        predicted_sales['Total'].append(mon_order)
-        predicted_sales['Dunkel'].append(mon_dunkel)
-        predicted_sales['Red Helles'].append(mon_red_helles)
-        predicted_sales['Pilsner'].append(mon_pilsner)
-
+    mon_order = np.round((growth_rate * quant) + quant)
+    predicted_sales = {}
+    for column, recipe in recipe_columns(recipes, monthly).items():
+        ratio = recipe_totals.get(recipe, 0) / total_order
+        predicted_sales[column] = np.round(mon_order * ratio).astype(np.int64)
+    predicted_sales['Total'] = mon_order.astype(np.int64)
 
     # construct predicted sales dataframe to build HTML and/or CSV output
     df2 = pd.DataFrame.from_dict(predicted_sales)
-    df2['Month'] = pd.date_range('11/01/2019', periods=12, freq='M')
+    # the prediction covers the months after the sales data
+    first_month = int(monthly.index.max()) + 1
+    df2['Month'] = pd.date_range(datetime(first_month // 12, first_month % 12 + 1, 1),
+                                 periods=len(quant), freq='M')
 
-    if o_p == 'csv':
-        df2.to_csv('static\predicted_sales.csv', sep=',')
-
-    if o_p == 'html':
-        df2.to_html('templates\predicted_sales.html')
+    write_predicted_sales(df2, o_p)
+    if not html:
+        return mom_sales_data, df2, None
 
     # get an HTML table in string format of predicted sales suitable
     # for rendering using the flash framework
     str_io = io.StringIO()
-    mstr = df2.to_html(buf=str_io, classes='table table-striped')
+    df2.to_html(buf=str_io, classes='table table-striped')
     html_str = str_io.getvalue()
-    #print(html_str)
 
     return mom_sales_data, df2, html_str
 
+def forecast_sales_source(filepath, recipes=PREDICTED_RECIPES, chunksize=None):
+    '''
+    Predicts the sales of one sales source without writing any output.
+    Returns (mom_sales_data, df2) as get_predicted_sales does.
+    '''
+    mom_sales_data, df2, _ = predict_sales(load_monthly_sales(filepath, chunksize),
+                                           'none', recipes, html=False)
+    return mom_sales_data, df2
+
+def get_predicted_sales_batch(sources, recipes=PREDICTED_RECIPES, processes=None, chunksize=None):
+    '''
+    Predicts the sales of many sales sources, e.g. one per brewhouse, each
+    source being read, aggregated and projected in its own worker process.
+
+    sources: sales files, stores or indexes, see load_monthly_sales
+    recipes: recipes to predict, see recipe_columns
+    processes: worker processes, defaults to one per core. 1 runs in this
+               process.
+
+    Returns source -> (mom_sales_data, df2)
+    '''
+    sources = list(dict.fromkeys(sources))
+    if processes is None:
+        processes = min(len(sources), os.cpu_count() or 1)
+    if processes <= 1 or len(sources) <= 1:
+        return {source: forecast_sales_source(source, recipes, chunksize) for source in sources}
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {source: pool.submit(forecast_sales_source, source, recipes, chunksize)
+                   for source in sources}
+        return {source: future.result() for source, future in futures.items()}
+
+def write_predicted_sales(df2, o_p):
+    '''
+    Writes the predicted sales table to disk in the requested output format.
+
+    df2: predicted sales dataframe
+    o_p: output format, 'csv' or 'html'. Anything else writes nothing
+    '''
+    if o_p == 'csv':
+        df2.to_csv('static\predicted_sales.csv', sep=',')
+
+    if o_p == 'html':
+        df2.to_html('templates\predicted_sales.html')
+    return
+
+def source_signature(filepath):
+    '''
+    Returns the (path, mtime, size) triple that identifies a version of
+    a sales data source. A sales store is identified by its meta file, which
+    is replaced on every import.
+    '''
+    if os.path.isdir(filepath):
+        st = os.stat(os.path.join(filepath, 'meta.json'))
+    else:
+        st = os.stat(filepath)
+    return (os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+class Prediction_cache:
+    '''
+    Caches the result of get_predicted_sales for each sales file. An entry is
+    reused until the file's modification time or size changes, so the csv is
+    only parsed and the output files only rewritten once per version of the
+    sales data.
+    '''
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        return
+
+    def get(self, filepath, o_p='html', chunksize=None):
+        '''
+        Returns (mom_sales_data, df2, html_str) for the given sales file,
+        computing it only if the file has changed since the last call.
+
+        filepath: sales data file
+        o_p: output format written to disk, see write_predicted_sales
+        chunksize: stream the sales file, see load_monthly_sales
+        '''
+        if not filepath:
+            return None, None, None
+
+        signature = source_signature(filepath)
+        with self._lock:
+            entry = self._entries.get(signature[0])
+            if entry is not None and entry['signature'] == signature:
+                self.hits += 1
+                if o_p not in entry['written']:
+                    write_predicted_sales(entry['result'][1], o_p)
+                    entry['written'].add(o_p)
+                return entry['result']
+
+            self.misses += 1
+            result = get_predicted_sales(filepath, o_p, chunksize)
+            self._entries[signature[0]] = {'signature': signature,
+                                           'result': result,
+                                           'written': {o_p}
+                                          }
+            return result
+
+    def invalidate(self, filepath=None):
+        '''
+        Drops the cached prediction for filepath, or every entry if no
+        path is given.
+        '''
+        with self._lock:
+            if filepath is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(filepath), None)
+        return
+
+    def stats(self):
+        '''
+        Returns the cache hit/miss counters
+        '''
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)
+                   }
+
+# shared prediction cache used by the web front end
+prediction_cache = Prediction_cache()
+
 def test_get_predicted_sales():
     '''
     Unit test
@@ -113,7 +348,65 @@ def test_get_predicted_sales():
     mom_sales_data, df2, html_str = get_predicted_sales('Barnabys_sales_fabricated_data.csv', 'sap')
     return
 
+def test_streamed_sales():
+    '''
+    Unit test
+    '''
+    mom_sales_data, df2, _ = get_predicted_sales('Barnabys_sales_fabricated_data.csv', 'sap')
+    streamed_mom, streamed_df2, _ = get_predicted_sales('Barnabys_sales_fabricated_data.csv', 'sap', chunksize=7)
+    assert streamed_mom == mom_sales_data
+    assert streamed_df2.equals(df2)
+    return
+
+def test_prediction_cache():
+    '''
+    Unit test
+    '''
+    cache = Prediction_cache()
+    first = cache.get('Barnabys_sales_fabricated_data.csv', 'sap')
+    second = cache.get('Barnabys_sales_fabricated_data.csv', 'sap')
+    assert first is second
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    cache.invalidate('Barnabys_sales_fabricated_data.csv')
+    cache.get('Barnabys_sales_fabricated_data.csv', 'sap')
+    assert cache.stats()['misses'] == 2
+    return
+
+
+def test_batch_forecast():
+    '''
+    Unit test
+    '''
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        # a second brewhouse with an extra recipe
+        other = os.path.join(directory, 'other_sales.csv')
+        with open('Barnabys_sales_fabricated_data.csv') as f, open(other, 'w') as o:
+            for i, line in enumerate(f):
+                o.write(line.replace('Organic Dunkel', 'Organic Weiss') if i % 2 else line)
+        sources = ['Barnabys_sales_fabricated_data.csv', other]
+
+        results = get_predicted_sales_batch(sources, processes=2)
+        for source in sources:
+            mom_sales_data, df2, _ = get_predicted_sales(source, 'sap')
+            assert results[source][0] == mom_sales_data
+            assert results[source][1].equals(df2)
+
+        results = get_predicted_sales_batch(sources, recipes=None, processes=2)
+        assert 'Organic Weiss' in results[other][1].columns
+        assert 'Organic Weiss' not in results[sources[0]][1].columns
+        assert set(results[sources[0]][1].columns) == {'Dunkel', 'Pilsner', 'Red Helles',
+                                                       'Total', 'Month'}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return
+
 
 if __name__ == "__main__":
     # unit tests
     test_get_predicted_sales()
+    test_streamed_sales()
+    test_prediction_cache()
+    test_batch_forecast()
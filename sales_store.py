@@ -0,0 +1,299 @@
+'''Sales Store
+
+Compact columnar copy of the sales csv file. Each column is a flat binary file
+of fixed width values that is memory mapped when read, so forecasts can be
+built without re-parsing text.
+
+    <name>.store/date.bin      int32  order date, days since 1970-01-01
+    <name>.store/recipe.bin    uint16 recipe code, index into meta recipes
+    <name>.store/quantity.bin  int32  quantity ordered
+    <name>.store/meta.json     row count, recipe names, csv import offset and
+                               the CRC-32 of the csv up to that offset
+
+Usage: python sales_store.py import <sales csv> [store directory]
+'''
+import csv
+import io
+import json
+import os
+import sys
+import zlib
+import numpy as np
+import pandas as pd
+import sales_predictor as sp
+
+STORE_VERSION = 2
+STORE_COLUMNS = {'date': np.int32,
+                 'recipe': np.uint16,
+                 'quantity': np.int32
+                }
+META_FILE = 'meta.json'
+
+# Bytes of csv text parsed at a time while importing
+IMPORT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def store_path_for(csv_path):
+    '''
+    Returns the store directory that sits next to the given sales csv file
+    '''
+    return os.path.splitext(csv_path)[0] + '.store'
+
+class Sales_store:
+    '''
+    Columnar on-disk store of sales orders: order date, recipe code and
+    quantity.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.meta = {'version': STORE_VERSION,
+                     'rows': 0,
+                     'recipes': [],
+                     'source_header': None,
+                     'source_offset': 0,
+                     'source_crc': 0
+                    }
+        meta_file = os.path.join(path, META_FILE)
+        if os.path.isfile(meta_file):
+            with open(meta_file, 'r') as f:
+                self.meta = json.load(f)
+        return
+
+    def column_file(self, column):
+        return os.path.join(self.path, column + '.bin')
+
+    def column(self, column):
+        '''
+        Returns a read-only memory map of a column, without copying the data
+        '''
+        rows = self.meta['rows']
+        if rows == 0:
+            return np.empty(0, dtype=STORE_COLUMNS[column])
+        return np.memmap(self.column_file(column), dtype=STORE_COLUMNS[column],
+                         mode='r', shape=(rows,))
+
+    def save_meta(self):
+        '''
+        Atomically replaces the meta file. The row count in the meta file is
+        what makes appended column data visible to readers.
+        '''
+        meta_file = os.path.join(self.path, META_FILE)
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(meta_file + '.tmp', meta_file)
+        return
+
+    def reset(self):
+        '''
+        Empties the store
+        '''
+        self.meta['rows'] = 0
+        self.meta['recipes'] = []
+        self.meta['source_header'] = None
+        self.meta['source_offset'] = 0
+        self.meta['source_crc'] = 0
+        self.meta['version'] = STORE_VERSION
+        for column in STORE_COLUMNS:
+            open(self.column_file(column), 'wb').close()
+        self.save_meta()
+        return
+
+    def append(self, dates, recipes, quantities):
+        '''
+        Appends orders to the store.
+
+        dates: order dates as days since 1970-01-01
+        recipes: recipe names
+        quantities: quantity ordered
+        '''
+        codes = {name: code for code, name in enumerate(self.meta['recipes'])}
+        for name in pd.unique(recipes):
+            if name not in codes:
+                codes[name] = len(self.meta['recipes'])
+                self.meta['recipes'].append(name)
+
+        values = {'date': dates,
+                  'recipe': pd.Series(recipes).map(codes).to_numpy(),
+                  'quantity': quantities
+                 }
+        rows = self.meta['rows']
+        for column, dtype in STORE_COLUMNS.items():
+            with open(self.column_file(column), 'r+b') as f:
+                # drop anything beyond the committed rows, left by an
+                # interrupted append
+                f.truncate(rows * np.dtype(dtype).itemsize)
+                f.seek(0, os.SEEK_END)
+                np.asarray(values[column], dtype=dtype).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        self.meta['rows'] = rows + len(values['date'])
+        return
+
+def parse_orders(block, header):
+    '''
+    Parses a block of csv text, without a header line, into order dates
+    (days since 1970-01-01), recipe names and quantities.
+    '''
+    date_column = header[sp.DATE_COLUMN_INDEX]
+    orders = pd.read_csv(io.BytesIO(block), header=None, names=header,
+                         usecols=[date_column, sp.RECIPE_COLUMN, sp.QUANTITY_COLUMN])
+    dates = pd.to_datetime(orders[date_column], format=sp.DATE_FORMAT)
+    days = dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+    return days, orders[sp.RECIPE_COLUMN].to_numpy(), orders[sp.QUANTITY_COLUMN].to_numpy()
+
+def prefix_crc(f, length):
+    '''
+    CRC-32 of the first length bytes of a file
+    '''
+    f.seek(0)
+    crc = 0
+    while length > 0:
+        block = f.read(min(length, IMPORT_BLOCK_SIZE))
+        if not block:
+            break
+        crc = zlib.crc32(block, crc)
+        length -= len(block)
+    return crc
+
+def import_sales(csv_path, store_path=None):
+    '''
+    Imports the sales csv file into its store. The first import converts the
+    whole file, later imports only append the rows added to the csv since the
+    last import. If the csv has been rewritten rather than appended to, the
+    store is rebuilt. Rewrites are found by checking the CRC of the part of
+    the csv imported before, which only reads it rather than parsing it.
+    Only lines ending in a newline are imported, a last line without one may
+    still be being written and waits for the next import.
+
+    Returns the number of orders appended.
+    '''
+    if store_path is None:
+        store_path = store_path_for(csv_path)
+    os.makedirs(store_path, exist_ok=True)
+    store = Sales_store(store_path)
+
+    with open(csv_path, 'rb') as f:
+        header_line = f.readline()
+        header = next(csv.reader([header_line.decode()], delimiter=','))
+        size = os.fstat(f.fileno()).st_size
+        offset = store.meta['source_offset']
+        crc = store.meta.get('source_crc')
+        if store.meta.get('version') != STORE_VERSION or \
+           store.meta['source_header'] != header or \
+           offset > size or \
+           prefix_crc(f, offset) != crc:
+            store.reset()
+            store.meta['source_header'] = header
+            offset = len(header_line)
+            crc = zlib.crc32(header_line)
+
+        appended = 0
+        f.seek(offset)
+        pending = b''
+        while True:
+            block = f.read(IMPORT_BLOCK_SIZE)
+            if not block:
+                # a partial last line is left for the next import
+                break
+            block = pending + block
+            # only parse complete lines, the rest waits for the next block
+            end = block.rfind(b'\n') + 1
+            pending = block[end:]
+            if end == 0:
+                continue
+            if block[:end].strip():
+                dates, recipes, quantities = parse_orders(block[:end], header)
+                store.append(dates, recipes, quantities)
+                appended += len(dates)
+            offset += end
+            crc = zlib.crc32(block[:end], crc)
+            store.meta['source_offset'] = offset
+            store.meta['source_crc'] = crc
+            store.save_meta()
+
+    return appended
+
+def get_monthly_sales_from_store(store_path):
+    '''
+    Builds the same monthly sales dataframe as sales_predictor.get_monthly_sales
+    from the memory mapped store columns.
+    '''
+    store = Sales_store(store_path)
+    recipe_names = store.meta['recipes']
+    dates = store.column('date')
+    recipes = store.column('recipe')
+    quantities = store.column('quantity')
+
+    # month code: year * 12 + month - 1
+    months = dates.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64) + 1970 * 12
+    month_codes, first_seen, month_index = np.unique(months, return_index=True,
+                                                     return_inverse=True)
+    table = np.bincount(month_index * len(recipe_names) + recipes,
+                        weights=quantities,
+                        minlength=len(month_codes) * len(recipe_names))
+    table = table.reshape(len(month_codes), len(recipe_names)).astype(np.int64)
+
+    # months in the order they first appear in the sales data
+    order = np.argsort(first_seen, kind='stable')
+    monthly = pd.DataFrame(table[order], index=month_codes[order], columns=recipe_names)
+    monthly.index.name = 'Month'
+    return monthly
+
+def test_sales_store():
+    '''
+    Unit test
+    '''
+    csv_path = 'Barnabys_sales_fabricated_data.csv'
+    store_path = store_path_for(csv_path)
+    import_sales(csv_path, store_path)
+    assert import_sales(csv_path, store_path) == 0
+
+    monthly = sp.get_monthly_sales(sp.read_sales_orders(csv_path))
+    stored = get_monthly_sales_from_store(store_path)
+    assert stored[monthly.columns].equals(monthly)
+
+    mom_sales_data, df2, _ = sp.get_predicted_sales(csv_path, 'sap')
+    stored_mom, stored_df2, _ = sp.get_predicted_sales(store_path, 'sap')
+    assert stored_mom == mom_sales_data
+    assert stored_df2.equals(df2)
+
+    # a last line still being written waits until its newline arrives, and
+    # rewrites of the imported part are found even when the file does not
+    # shrink
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'sales.csv')
+        with open(csv_path, 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        half = len(lines[-1]) // 2
+        with open(path, 'wb') as f:
+            f.write(b''.join(lines[:-1]) + lines[-1][:half])
+        assert import_sales(path) == len(lines) - 2
+        assert import_sales(path) == 0
+        with open(path, 'ab') as f:
+            f.write(lines[-1][half:])
+        assert import_sales(path) == 1
+        stored = get_monthly_sales_from_store(store_path_for(path))
+        assert stored[monthly.columns].equals(monthly)
+        with open(path, 'r+b') as f:
+            f.seek(len(lines[0]))
+            row = lines[1].replace(b'GYLE', b'GYLX')
+            f.write(row)
+        assert import_sales(path) == len(lines) - 1
+        assert Sales_store(store_path_for(path)).meta['rows'] == len(lines) - 1
+    finally:
+        shutil.rmtree(directory)
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == 'import':
+        rows = import_sales(*sys.argv[2:4])
+        print('imported {} orders'.format(rows))
+    else:
+        # unit tests
+        test_sales_store()
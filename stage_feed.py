@@ -0,0 +1,164 @@
+'''Stage Feed
+
+Pushes stage changes to floor displays instead of having them poll
+/viewbrewing. The feed is a stage listener: each stage start or end becomes
+one delta, serialized once and kept in a short ring buffer with a sequence
+number. Waiting clients, whether server-sent event streams or long polls,
+are woken together and read the deltas they have not seen yet, so a change
+costs one fan-out however many screens are watching. The feed is shared by
+every site, and a client given a site's Brewery_state only reads the deltas
+of the batches that state owns.
+'''
+from collections import deque
+import time
+import json
+import threading
+import brewery as bh
+import brew_api as api
+
+# Delta event names
+stage_events = {bh.STAGE_START: 'start', bh.STAGE_END: 'end'}
+
+
+class Stage_feed:
+    '''
+    Recent stage change deltas for push and long-poll clients
+
+    history: deltas kept for clients catching up, older ones are dropped
+    '''
+    def __init__(self, history=1000):
+        self.sequence = 0
+        # (sequence, json delta, batch)
+        self._deltas = deque(maxlen=history)
+        self._cond = threading.Condition()
+        return
+
+    def start(self):
+        bh.add_stage_listener(self.stage_changed)
+        return
+
+    def stop(self):
+        bh.remove_stage_listener(self.stage_changed)
+        return
+
+    def stage_changed(self, event, batch, stage):
+        '''
+        Stage listener, records a delta and wakes every waiting client
+        '''
+        delta = {'event': stage_events.get(event, event),
+                 'stage': bh.brew_stage[stage],
+                 'batch': api.batch_as_dict(batch)}
+        with self._cond:
+            self.sequence += 1
+            delta['seq'] = self.sequence
+            self._deltas.append((self.sequence, json.dumps(delta), batch))
+            self._cond.notify_all()
+        return
+
+    def since(self, sequence, state=None):
+        '''
+        Returns the (sequence, json delta) pairs after sequence. A client
+        that has fallen further behind than the history gets what is left.
+
+        state: only the deltas of batches this Brewery_state owns, every
+               delta if None
+        '''
+        with self._cond:
+            return self._since(sequence, state)
+
+    def _since(self, sequence, state=None):
+        if not self._deltas or sequence >= self._deltas[-1][0]:
+            return []
+        first = self._deltas[0][0]
+        return [(s, delta) for s, delta, batch in list(self._deltas)[max(0, sequence + 1 - first):]
+                if state is None or state.owns(batch)]
+
+    def wait(self, sequence, timeout=None, state=None):
+        '''
+        Blocks until there are deltas after sequence, of batches state owns
+        if given, or timeout seconds pass. Returns the deltas, empty on
+        timeout.
+        '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return []
+                self._cond.wait_for(lambda: self.sequence > sequence, remaining)
+                deltas = self._since(sequence, state)
+                if deltas:
+                    return deltas
+                # only other sites changed
+                sequence = self.sequence
+
+    def event_stream(self, sequence=None, heartbeat=15, state=None):
+        '''
+        Generator of server-sent event messages starting after sequence,
+        the current sequence if None. Sends a comment every heartbeat
+        seconds so dropped connections are noticed.
+
+        state: only the deltas of batches this Brewery_state owns
+        '''
+        if sequence is None:
+            sequence = self.sequence
+        while True:
+            deltas = self.wait(sequence, heartbeat, state)
+            if not deltas:
+                yield ': heartbeat\n\n'
+                continue
+            for sequence, delta in deltas:
+                yield 'id: {}\ndata: {}\n\n'.format(sequence, delta)
+
+def test_stage_feed():
+    '''
+    Unit test
+    '''
+    from datetime import datetime
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    feed = Stage_feed(history=3)
+    feed.start()
+    try:
+        state.new_batch('1', bh.Product('Pilsner'), datetime.now(), 3)
+        deltas = feed.since(0)
+        assert len(deltas) == 1 and json.loads(deltas[0][1])['event'] == 'start'
+
+        # a waiting client is woken by a change on another thread
+        woken = []
+        t = threading.Thread(target=lambda: woken.extend(feed.wait(1, timeout=5)))
+        t.start()
+        state.transition('1', bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION,
+                         datetime.now(), 4, tank_name='Albert')
+        t.join()
+        assert [json.loads(d)['event'] for _, d in woken] in (['end'], ['end', 'start'])
+        assert feed.wait(feed.sequence, timeout=0.01) == []
+
+        # the history is bounded
+        state.transition('1', bh.BREW_STAGE_FERMENTATION, bh.BREW_STAGE_CONDITIONING,
+                         datetime.now(), 2, tank_name='Gertrude')
+        assert [s for s, _ in feed.since(0)] == [3, 4, 5]
+        stream = feed.event_stream(4)
+        message = next(stream)
+        assert message.startswith('id: 5\n') and 'Gertrude' in message
+
+        # a site's clients only see its own batches
+        other = bh.Brewery_state(bh.init_brew_tank_pool('north'))
+        sequence = feed.sequence
+        other.new_batch('1', bh.Product('Dunkel'), datetime.now(), 3)
+        assert feed.since(sequence, state) == [] and len(feed.since(sequence, other)) == 1
+        assert feed.wait(sequence, timeout=0.05, state=state) == []
+        woken = []
+        t = threading.Thread(target=lambda: woken.extend(feed.wait(sequence, 5, state)))
+        t.start()
+        other.new_batch('2', bh.Product('Dunkel'), datetime.now(), 3)
+        state.new_batch('2', bh.Product('Pilsner'), datetime.now(), 3)
+        t.join()
+        assert [json.loads(d)['batch']['recipe'] for _, d in woken] == ['Pilsner']
+    finally:
+        feed.stop()
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_stage_feed()
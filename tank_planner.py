@@ -0,0 +1,250 @@
+'''Tank Planner
+
+Plans which tank each batch should move into next. Unlike first-fit, the
+planner looks at every batch waiting for, or heading towards, a fermenter or
+conditioner together with when each tank will be free. Batches are placed
+greedily in order of when they are ready, each in the tank that lets it
+start soonest, breaking ties by best fit so large tanks are kept for large
+gyles. The greedy plan is then improved by swapping assignments until the
+time budget runs out.
+
+A batch moving now is planned first and only into a tank that is free now,
+so the suggestion for it can always be taken. Batches without a volume are
+planned as 1 L, as the tank pool does.
+'''
+from datetime import datetime, timedelta
+import time
+import brewery as bh
+import brew_scheduler as bs
+
+
+class Tank_request:
+    '''
+    A batch that needs a tank for its next stage
+    '''
+    def __init__(self, gyle, stage, volume, ready_time, duration):
+        self.gyle = gyle
+        self.stage = stage
+        self.volume = volume
+        self.ready_time = ready_time
+        self.duration = duration
+
+class Tank_assignment:
+    def __init__(self, gyle, stage, tank, start_time):
+        self.gyle = gyle
+        self.stage = stage
+        self.tank = tank
+        self.start_time = start_time
+
+    def as_dict(self):
+        return {'gyle': self.gyle,
+                'stage': bh.brew_stage[self.stage],
+                'tank': self.tank,
+                'start_time': self.start_time.strftime("%Y-%m-%dT%H:%M")
+               }
+
+class Tank_plan:
+    '''
+    Planned tank for each waiting batch
+    '''
+    def __init__(self, assignments, unassigned):
+        self.assignments = {a.gyle: a for a in assignments}
+        self.unassigned = unassigned
+
+    def suggest(self, gyle):
+        '''
+        Returns the planned tank name for a gyle, or None
+        '''
+        a = self.assignments.get(gyle)
+        return a.tank if a is not None else None
+
+    def as_dict(self):
+        return {'assignments': [a.as_dict() for a in self.assignments.values()],
+                'unassigned': self.unassigned
+               }
+
+def can_hold(tank, request):
+    if tank.volume < request.volume:
+        return False
+    if request.stage == bh.BREW_STAGE_FERMENTATION:
+        return tank.fermenter
+    return tank.conditioner
+
+def tank_requests(state, now):
+    '''
+    Collects the batches that will need a fermenter or conditioner, and when
+    each tank in use will be free again.
+
+    Returns (requests, tanks, free_at) where tanks maps name -> tank and
+    free_at maps name -> time the tank is free
+    '''
+    requests = []
+    tanks = {t.name: t for t in state.tank_pool.tank_pool}
+    free_at = {name: now for name in tanks}
+    for b in state.batch_list():
+        stage = b.current_brew_stage
+        if stage not in (bh.BREW_STAGE_HOT_BREW,
+                         bh.BREW_STAGE_FERMENTATION,
+                         bh.BREW_STAGE_CONDITIONING):
+            continue
+
+        end = stage_end(b, stage, now)
+        for tank in b.brew_tanks:
+            tanks[tank.name] = tank
+            free_at[tank.name] = end
+        if stage == bh.BREW_STAGE_CONDITIONING:
+            continue
+
+        next_stage = bs.next_brew_stage[stage]
+        duration = bh.stage_duration(next_stage, bs.product_stage_duration(b.product, next_stage))
+        requests.append(Tank_request(b.gyle, next_stage, b.volume or 1, end, duration))
+    return requests, tanks, free_at
+
+def stage_end(b, stage, now):
+    '''
+    Expected end of a batch's current stage, now if it is unknown or overdue
+    '''
+    record = b.brew_stage[stage]
+    duration = bh.stage_duration(stage, record.duration)
+    if duration is None or not isinstance(record.start_time, datetime):
+        return now
+    return max(now, record.start_time + duration)
+
+def schedule_cost(order, tanks, free_at):
+    '''
+    Places requests in order, each in its assigned tank. Returns the total
+    start delay in seconds and the start times.
+    '''
+    free = dict(free_at)
+    cost = 0.0
+    starts = []
+    for request, name in order:
+        start = max(request.ready_time, free[name])
+        free[name] = start + request.duration
+        cost += (start - request.ready_time).total_seconds()
+        starts.append(start)
+    return cost, starts
+
+def plan_tank_assignment(state, time_budget=0.05, now=None, immediate=None):
+    '''
+    Plans a tank for every batch in hot brew (next: fermenter) or
+    fermentation (next: conditioner).
+
+    state: Brewery_state
+    time_budget: seconds allowed for improving the greedy plan
+    now: planning time, defaults to the current time
+    immediate: gyle moving to its next stage now, which is given a tank
+               that is free now, or none
+
+    Returns a Tank_plan
+    '''
+    deadline = time.perf_counter() + time_budget
+    if now is None:
+        now = datetime.now()
+    free_now = {t.name for t in state.tank_pool.tank_pool}
+    requests, tanks, free_at = tank_requests(state, now)
+    for request in requests:
+        if request.gyle == immediate:
+            request.ready_time = now
+
+    # greedy: the immediate gyle, then earliest ready first, larger batches
+    # first on a tie
+    requests.sort(key=lambda r: (r.gyle != immediate, r.ready_time, -r.volume))
+    free = dict(free_at)
+    order = []
+    unassigned = []
+    for request in requests:
+        best = None
+        for name, tank in tanks.items():
+            if not can_hold(tank, request):
+                continue
+            if request.gyle == immediate and name not in free_now:
+                continue
+            start = max(request.ready_time, free[name])
+            # soonest start, then smallest tank that fits, then single purpose
+            key = (start, tank.volume, tank.fermenter and tank.conditioner)
+            if best is None or key < best[0]:
+                best = (key, name)
+        if best is None:
+            unassigned.append(request.gyle)
+            continue
+        name = best[1]
+        free[name] = best[0][0] + request.duration
+        order.append((request, name))
+
+    # improve: swap the tanks of pairs of batches while it lowers the delay
+    cost, starts = schedule_cost(order, tanks, free_at)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(len(order)):
+            for j in range(i + 1, len(order)):
+                if time.perf_counter() >= deadline:
+                    break
+                (ri, ti), (rj, tj) = order[i], order[j]
+                if ti == tj or not can_hold(tanks[tj], ri) or not can_hold(tanks[ti], rj):
+                    continue
+                if (ri.gyle == immediate and tj not in free_now
+                        or rj.gyle == immediate and ti not in free_now):
+                    continue
+                order[i], order[j] = (ri, tj), (rj, ti)
+                new_cost, new_starts = schedule_cost(order, tanks, free_at)
+                if new_cost < cost:
+                    cost, starts = new_cost, new_starts
+                    improved = True
+                else:
+                    order[i], order[j] = (ri, ti), (rj, tj)
+
+    assignments = [Tank_assignment(r.gyle, r.stage, name, start)
+                   for (r, name), start in zip(order, starts)]
+    return Tank_plan(assignments, unassigned)
+
+def test_tank_planner():
+    '''
+    Unit test
+    '''
+    now = datetime(2020, 1, 1)
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    for gyle, volume in (('1', 600), ('2', 950), ('3', 750)):
+        b = state.new_batch(gyle, bh.Product('Pilsner'), now, 3)
+        b.volume = volume
+    plan = plan_tank_assignment(state, now=now)
+    # best fit rather than first fit: the 1000 L tank goes to the 950 L gyle
+    assert plan.suggest('2') in ('Albert', 'Camilla', 'Emily')
+    assert plan.suggest('3') == 'R2D2'
+    assert plan.suggest('1') in ('Brigadier', 'Dylon', 'Florence')
+    assert not plan.unassigned
+
+    # more batches than fermenters: all are planned, some start later
+    for gyle in range(4, 12):
+        state.new_batch(str(gyle), bh.Product('Dunkel'), now, 3)
+    plan = plan_tank_assignment(state, now=now)
+    assert len(plan.assignments) == 11
+    starts = sorted(a.start_time for a in plan.assignments.values())
+    assert starts[0] < starts[-1]
+
+    # a batch moving now is only given a tank that is free now, even if a
+    # better fitting one is free soon
+    state = bh.Brewery_state(bh.init_brew_tank_pool('barnabys'))
+    for gyle, tank in (('1', 'Brigadier'), ('2', 'Dylon'), ('3', 'Florence'), ('4', 'R2D2')):
+        state.new_batch(gyle, bh.Product('Pilsner'), now, 3, volume=800)
+        state.transition(gyle, bh.BREW_STAGE_HOT_BREW, bh.BREW_STAGE_FERMENTATION, now, 4,
+                         tank_name=tank)
+    state.new_batch('5', bh.Product('Dunkel'), now, 3, volume=700)
+    assert plan_tank_assignment(state, now=now).suggest('5') in ('Albert', 'Camilla', 'Emily')
+    later = now + timedelta(weeks=4)
+    assert plan_tank_assignment(state, now=later).suggest('5') in ('Brigadier', 'Dylon',
+                                                                  'Florence', 'R2D2')
+    suggested = plan_tank_assignment(state, now=later, immediate='5').suggest('5')
+    assert suggested in [t.name for t in state.tank_pool.tank_pool]
+
+    # a batch without a volume is planned as 1 L, not as fitting anywhere
+    state.new_batch('6', bh.Product('Dunkel'), now, 3)
+    requests, _, _ = tank_requests(state, now)
+    assert [r.volume for r in requests if r.gyle == '6'] == [1]
+    return
+
+
+if __name__ == "__main__":
+    # unit tests
+    test_tank_planner()